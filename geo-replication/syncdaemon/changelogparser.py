@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+"""columnar parser of processed changelogs
+
+libgfchangelog hands out changelogs as text, one record a line:
+
+  E <gfid> <fop> [<mode> <uid> <gid>] <pgfid>/<bname> [<pgfid>/<bname>]
+  D <gfid>
+  M <gfid> <fop> [<stat fields>]
+
+with spaces, newlines and percent signs of names escaped. parse()
+reads such a file in one go and splits it into columns, names being
+unescaped (only if they have escapes in them) and prefixed as they
+are split. Records are then walked by position, as in
+
+  for ty, fop, gfid, en, en1, mode, uid, gid, args in cl.rows(): ...
+
+The module only depends on the standard library, so that other
+consumers of changelogs, like glusterfind, can use it as is.
+"""
+
+import os
+import mmap
+from itertools import compress
+
+TYPE_ENTRY = 'E'
+TYPE_DATA = 'D'
+TYPE_META = 'M'
+
+SPACE_ESCAPE_CHAR = "%20"
+NEWLINE_ESCAPE_CHAR = "%0A"
+PERCENTAGE_ESCAPE_CHAR = "%25"
+
+# fops having the (source) entry at the third field rather than the
+# last: the deleted path may follow the entry of UNLINK and RMDIR
+# (changelog.capture-del-path), RENAME is followed by the target.
+FIRST_ENTRY_FOPS = ('UNLINK', 'RMDIR', 'RENAME')
+# fops carrying mode, uid and gid of the new entry
+CREATE_FOPS = ('CREATE', 'MKDIR', 'MKNOD')
+
+
+def unescape(s):
+    if '%' not in s:
+        return s
+    return s.replace(SPACE_ESCAPE_CHAR, " ")\
+            .replace(NEWLINE_ESCAPE_CHAR, "\n")\
+            .replace(PERCENTAGE_ESCAPE_CHAR, "%")
+
+
+class Changelog(object):
+
+    """the records of a changelog, column wise
+
+    .types       record type (TYPE_*)
+    .fops        fop of entry and metadata records, None for data
+    .gfids       GFID of the record
+    .entries     prefixed pgfid/bname of entry records (for RENAME,
+                 the source), None for the others
+    .entries1    prefixed target of RENAMEs, None for the others
+    .modes, .uids, .gids
+                 attributes of new entries (CREATE, MKDIR, MKNOD)
+                 as integers, None for the others
+    .args        the fields following the fop of metadata records,
+                 as a tuple, None for the others
+    """
+
+    COLUMNS = ('types', 'fops', 'gfids', 'entries', 'entries1',
+               'modes', 'uids', 'gids', 'args')
+
+    def __init__(self):
+        for col in self.COLUMNS:
+            setattr(self, col, [])
+
+    def __len__(self):
+        return len(self.types)
+
+    def rows(self):
+        return zip(*[getattr(self, col) for col in self.COLUMNS])
+
+    def select(self, keep):
+        """a Changelog of the records for which @keep is true"""
+        cl = Changelog()
+        for col in self.COLUMNS:
+            setattr(cl, col, list(compress(getattr(self, col), keep)))
+        return cl
+
+
+def read_lines(path, use_mmap=False):
+    """lines of the file at @path
+
+    Content is decoded the way the filesystem encodes names. With
+    @use_mmap, it's decoded off a mapping of the file, sparing a copy.
+    """
+    with open(path, 'rb') as f:
+        if use_mmap and os.fstat(f.fileno()).st_size:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = str(mm, 'utf-8', 'surrogateescape')
+            finally:
+                mm.close()
+        else:
+            data = f.read().decode('utf-8', 'surrogateescape')
+    return data.split('\n')
+
+
+def parse(path, prefix='', use_mmap=False):
+    """parse the changelog at @path into a Changelog
+
+    @prefix is put in front of entries, eg. '.gfid/' to get paths
+    on the aux-gfid mount. Empty lines are skipped, records of
+    unknown type are kept, with only their GFID parsed.
+    """
+    cl = Changelog()
+    types, fops, gfids = cl.types, cl.fops, cl.gfids
+    entries, entries1 = cl.entries, cl.entries1
+    modes, uids, gids, args = cl.modes, cl.uids, cl.gids, cl.args
+
+    for line in read_lines(path, use_mmap):
+        line = line.strip()
+        if not line:
+            continue
+        ty = line[0]
+        ec = line[2:].split(' ')
+        types.append(ty)
+        gfids.append(ec[0])
+        fop = en = en1 = mode = uid = gid = arg = None
+        if ty == TYPE_ENTRY:
+            fop = ec[1]
+            if fop in FIRST_ENTRY_FOPS:
+                en = prefix + unescape(ec[2])
+                if fop == 'RENAME':
+                    en1 = prefix + unescape(ec[-1])
+            else:
+                en = prefix + unescape(ec[-1])
+                if fop in CREATE_FOPS:
+                    mode, uid, gid = int(ec[2]), int(ec[3]), int(ec[4])
+        elif ty == TYPE_META:
+            fop = ec[1]
+            arg = tuple(ec[2:])
+        fops.append(fop)
+        entries.append(en)
+        entries1.append(en1)
+        modes.append(mode)
+        uids.append(uid)
+        gids.append(gid)
+        args.append(arg)
+    return cl
@@ -121,6 +121,12 @@ def main():
                    help="Do not lazy umount the secondary volume")
     p.add_argument("--primary-dist-count", type=int,
                    help="Primary Distribution count")
+    p.add_argument("--secondary-repce-engine",
+                   help="RePCe engine serving the Primary")
+    p.add_argument("--secondary-entry-ops-threads", type=int,
+                   help="Threads applying entry operations")
+    p.add_argument("--secondary-meta-ops-threads", type=int,
+                   help="Threads applying metadata operations")
 
     # Status
     p = sp.add_parser("status")
@@ -131,6 +137,32 @@ def main():
     p.add_argument("--debug", action="store_true")
     p.add_argument("--json", action="store_true")
 
+    # RePCe call statistics
+    p = sp.add_parser("repce-stats",
+                      help="Print the RePCe statistics as last saved by "
+                      "the workers, every repce-stats-interval seconds")
+    p.add_argument("primary", help="Primary Volume Name")
+    p.add_argument("secondary", help="Secondary")
+    p.add_argument("-c", "--config-file", help="Config File")
+    p.add_argument("--local-path",
+                   help="Local Brick Path, all bricks of the session if "
+                   "not given")
+    p.add_argument("--debug", action="store_true")
+
+    # Batch timeline
+    p = sp.add_parser("batch-stats")
+    p.add_argument("primary", help="Primary Volume Name")
+    p.add_argument("secondary", help="Secondary")
+    p.add_argument("-c", "--config-file", help="Config File")
+    p.add_argument("--local-path",
+                   help="Local Brick Path, all bricks of the session if "
+                   "not given")
+    p.add_argument("--since", type=float,
+                   help="Only the batches started since this time")
+    p.add_argument("--raw", action="store_true",
+                   help="Print the batch records rather than a summary")
+    p.add_argument("--debug", action="store_true")
+
     # Config-check
     p = sp.add_parser("config-check")
     p.add_argument("name", help="Config Name")
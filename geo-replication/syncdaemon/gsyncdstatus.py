@@ -12,6 +12,10 @@
 from __future__ import print_function
 import fcntl
 import os
+import glob
+import math
+import mmap
+import struct
 import tempfile
 try:
     import urllib.parse as urllib
@@ -19,12 +23,13 @@ except ImportError:
     import urllib
 import json
 import time
+from threading import Lock
 from datetime import datetime
 from errno import EACCES, EAGAIN, ENOENT
 import logging
 
 from syncdutils import (EVENT_GEOREP_ACTIVE, EVENT_GEOREP_PASSIVE, gf_event,
-                        EVENT_GEOREP_CHECKPOINT_COMPLETED, lf)
+                        EVENT_GEOREP_CHECKPOINT_COMPLETED, lf, Thread)
 
 DEFAULT_STATUS = "N/A"
 MONITOR_STATUS = ("Created", "Started", "Paused", "Stopped")
@@ -55,6 +60,105 @@ def human_time_utc(ts):
         return DEFAULT_STATUS
 
 
+# Layout of the status segment, a fixed size record mirroring the
+# status file of a worker, along with the timings of its last batch.
+# Readers don't lock it: the sequence number in the header is odd
+# while a writer is at it, readers retry if it's odd or changed
+# while they were reading.
+SEGMENT_MAGIC = b"GSST"
+SEGMENT_VERSION = 1
+SEGMENT_HDR = struct.Struct("=4sHHQ")
+SEGMENT_FIELDS = (
+    ("entry", "q"),
+    ("data", "q"),
+    ("meta", "q"),
+    ("failures", "q"),
+    ("last_synced", "q"),
+    ("last_synced_entry", "q"),
+    ("checkpoint_time", "q"),
+    ("checkpoint_completion_time", "q"),
+    ("batch_duration", "d"),
+    ("batch_entry_duration", "d"),
+    ("batch_meta_duration", "d"),
+    ("batch_data_duration", "d"),
+    ("worker_status", "64s"),
+    ("crawl_status", "64s"),
+    ("checkpoint_completed", "8s"),
+    ("secondary_node", "256s"))
+SEGMENT_BODY = struct.Struct("=" + "".join(f for _, f in SEGMENT_FIELDS))
+SEGMENT_SIZE = SEGMENT_HDR.size + SEGMENT_BODY.size
+BATCH_FIELDS = ("batch_duration", "batch_entry_duration",
+                "batch_meta_duration", "batch_data_duration")
+
+
+# fields of the batch records which are summarized by percentiles
+BATCH_TIMINGS = ("duration", "entry_duration", "meta_duration",
+                 "data_duration", "queue_wait")
+
+
+def read_batch_records(path):
+    """the batch records in the timeline @path and its rotated
+    predecessor, oldest first"""
+    records = []
+    for fname in (path + ".1", path):
+        try:
+            with open(fname) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # cut short by a crash, or a rotation
+                        pass
+        except (OSError, IOError) as e:
+            if e.errno != ENOENT:
+                raise
+    return records
+
+
+def percentiles(values, pcts=(50, 90, 99)):
+    """nearest-rank percentiles of @values, and their maximum"""
+    if not values:
+        return {}
+    values = sorted(values)
+    out = {}
+    for p in pcts:
+        rank = int(math.ceil(p / 100.0 * len(values)))
+        out["p%d" % p] = values[max(rank, 1) - 1]
+    out["max"] = values[-1]
+    return out
+
+
+def summarize_batches(records):
+    """aggregate batch records into throughput and latency figures"""
+    summary = {"batches": len(records)}
+    if not records:
+        return summary
+
+    start = min(r["start_time"] for r in records)
+    end = max(r["start_time"] + r["duration"] for r in records)
+    span = end - start
+    summary["start_time"] = start
+    summary["end_time"] = end
+    for key in ("changelogs", "files", "retries"):
+        summary[key] = sum(r.get(key, 0) for r in records)
+    sized = [r["bytes"] for r in records if r.get("bytes") is not None]
+    summary["bytes"] = sum(sized) if sized else None
+
+    for key in ("changelogs", "files", "bytes"):
+        if span > 0 and summary[key] is not None:
+            summary[key + "_per_sec"] = round(summary[key] / span, 2)
+
+    for key in BATCH_TIMINGS:
+        summary[key] = percentiles([r[key] for r in records if key in r])
+
+    fops = {}
+    for r in records:
+        for fop, count in r.get("fops", {}).items():
+            fops[fop] = fops.get(fop, 0) + count
+    summary["fops"] = fops
+    return summary
+
+
 def get_default_values():
     return {
         "secondary_node": DEFAULT_STATUS,
@@ -71,6 +175,97 @@ def get_default_values():
         "checkpoint_completion_time": 0}
 
 
+class StatusSegment(object):
+
+    """the status segment (see SEGMENT_FIELDS) in file @path
+
+    Writers of different processes serialize on a lock of the file,
+    readers don't lock. The lock doesn't exclude the threads of a
+    process, writers sharing a StatusSegment serialize themselves.
+    """
+
+    def __init__(self, path, create=False):
+        if create:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR)
+            if os.fstat(fd).st_size < SEGMENT_SIZE:
+                os.ftruncate(fd, SEGMENT_SIZE)
+            access = mmap.ACCESS_WRITE
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            access = mmap.ACCESS_READ
+        try:
+            self.mm = mmap.mmap(fd, SEGMENT_SIZE, access=access)
+        except (ValueError, mmap.error):
+            os.close(fd)
+            raise
+        self.fd = fd
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def _unpack(self, body):
+        values = {}
+        for (key, fmt), value in zip(SEGMENT_FIELDS, body):
+            if fmt.endswith("s"):
+                value = value.rstrip(b"\0").decode("utf-8", "replace")
+            values[key] = value
+        return values
+
+    def read(self, retries=100):
+        """the values of the segment, None if not set (or being
+        written for too long)"""
+        for _ in range(retries):
+            magic, version, _, seq = SEGMENT_HDR.unpack_from(self.mm)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                return None
+            if seq & 1:
+                time.sleep(0.001)
+                continue
+            body = SEGMENT_BODY.unpack_from(self.mm, SEGMENT_HDR.size)
+            if SEGMENT_HDR.unpack_from(self.mm)[3] == seq:
+                return self._unpack(body)
+        return None
+
+    def update(self, values=None, deltas=None):
+        """set @values and add @deltas to the current ones"""
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            magic, version, _, seq = SEGMENT_HDR.unpack_from(self.mm)
+            if magic == SEGMENT_MAGIC and version == SEGMENT_VERSION:
+                current = self._unpack(
+                    SEGMENT_BODY.unpack_from(self.mm, SEGMENT_HDR.size))
+            else:
+                current = {}
+                seq = 0
+            for key, fmt in SEGMENT_FIELDS:
+                current.setdefault(key, "" if fmt.endswith("s") else 0)
+            for key, value in (values or {}).items():
+                if key in current:
+                    current[key] = value
+            for key, value in (deltas or {}).items():
+                current[key] = max(current[key] + value, 0)
+
+            body = []
+            for key, fmt in SEGMENT_FIELDS:
+                value = current[key]
+                if fmt.endswith("s"):
+                    value = str(value).encode("utf-8")
+                elif fmt == "q":
+                    value = int(value) if value != DEFAULT_STATUS else 0
+                else:
+                    value = float(value)
+                body.append(value)
+
+            SEGMENT_HDR.pack_into(self.mm, 0, SEGMENT_MAGIC, SEGMENT_VERSION,
+                                  0, seq + 1)
+            SEGMENT_BODY.pack_into(self.mm, SEGMENT_HDR.size, *body)
+            SEGMENT_HDR.pack_into(self.mm, 0, SEGMENT_MAGIC, SEGMENT_VERSION,
+                                  0, seq + 2)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+
 class LockedOpen(object):
 
     def __init__(self, filename, *args, **kwargs):
@@ -124,8 +319,25 @@ def set_monitor_status(status_file, status):
 
 
 class GeorepStatus(object):
+
+    """status of a worker, kept in brick_*.status
+
+    With a @flush_interval (in seconds), counters changed by
+    inc_value and dec_value are accumulated in memory and written
+    out by a thread at most once in that interval, or before any
+    other field is set.
+
+    All changes are published right away in the status segment
+    (see StatusSegment), which get_status reads in preference to
+    the status file.
+
+    The status files are created unless @create is False, as when
+    only reading the statistics of a session.
+    """
+
     def __init__(self, monitor_status_file, primary_node, brick, primary_node_id,
-                 primary, secondary, monitor_pid_file=None):
+                 primary, secondary, monitor_pid_file=None, flush_interval=0,
+                 create=True):
         self.primary = primary
         slv_data = secondary.split("::")
         self.secondary_host = slv_data[0]
@@ -135,16 +347,34 @@ class GeorepStatus(object):
         self.filename = os.path.join(self.work_dir,
                                      "brick_%s.status"
                                      % urllib.quote_plus(brick))
-
-        fd = os.open(self.filename, os.O_CREAT | os.O_RDWR)
-        os.close(fd)
-        fd = os.open(self.monitor_status_file, os.O_CREAT | os.O_RDWR)
-        os.close(fd)
+        self.repce_stats_file = os.path.join(self.work_dir,
+                                             "brick_%s.repce_stats"
+                                             % urllib.quote_plus(brick))
+        self.segment_file = os.path.join(self.work_dir,
+                                         "brick_%s.status_seg"
+                                         % urllib.quote_plus(brick))
+        self.batches_file = os.path.join(self.work_dir,
+                                         "brick_%s.batches"
+                                         % urllib.quote_plus(brick))
+        self.segment = None
+        # serializes the threads publishing in the segment
+        self.segment_lock = Lock()
+
+        if create:
+            fd = os.open(self.filename, os.O_CREAT | os.O_RDWR)
+            os.close(fd)
+            fd = os.open(self.monitor_status_file, os.O_CREAT | os.O_RDWR)
+            os.close(fd)
         self.primary_node = primary_node
         self.primary_node_id = primary_node_id
         self.brick = brick
         self.default_values = get_default_values()
         self.monitor_pid_file = monitor_pid_file
+        self.flush_interval = flush_interval
+        # counter deltas not written out yet
+        self.deltas = {}
+        self.deltas_lock = Lock()
+        self.flusher = None
 
     def send_event(self, event_type, **kwargs):
         gf_event(event_type,
@@ -164,16 +394,16 @@ class GeorepStatus(object):
             except ValueError:
                 pass
 
-            data = mergerfunc(data)
+            merged = mergerfunc(data)
             # If Data is not changed by merger func
-            if not data:
+            if not merged:
                 return False
 
             with tempfile.NamedTemporaryFile(
                     'w',
                     dir=os.path.dirname(self.filename),
                     delete=False) as tf:
-                tf.write(data)
+                tf.write(merged)
                 tempname = tf.name
 
             os.rename(tempname, self.filename)
@@ -181,9 +411,47 @@ class GeorepStatus(object):
                             os.O_DIRECTORY)
             os.fsync(dirfd)
             os.close(dirfd)
+
+            # the counters in the segment include the pending deltas
+            values = dict((k, v) for k, v in data.items()
+                          if k not in BATCH_FIELDS)
+            with self.deltas_lock:
+                self._publish(values, self.deltas)
             return True
 
+    def _publish(self, values=None, deltas=None):
+        with self.segment_lock:
+            try:
+                if self.segment is None:
+                    self.segment = StatusSegment(self.segment_file,
+                                                 create=True)
+                self.segment.update(values, deltas)
+            except (OSError, IOError, ValueError) as e:
+                logging.debug(lf("Status segment not updated", error=e))
+
+    def read_segment(self):
+        """the values in the status segment, None if unavailable"""
+        try:
+            segment = StatusSegment(self.segment_file)
+        except (OSError, IOError, ValueError):
+            return None
+        try:
+            return segment.read()
+        finally:
+            segment.close()
+
+    def set_batch_stats(self, duration, entry_duration, meta_duration,
+                        data_duration):
+        """publish the timings of the last batch in the segment"""
+        self._publish({"batch_duration": duration,
+                       "batch_entry_duration": entry_duration,
+                       "batch_meta_duration": meta_duration,
+                       "batch_data_duration": data_duration})
+
     def reset_on_worker_start(self):
+        with self.deltas_lock:
+            self.deltas = {}
+
         def merger(data):
             data["secondary_node"] = DEFAULT_STATUS
             data["crawl_status"] = DEFAULT_STATUS
@@ -195,6 +463,8 @@ class GeorepStatus(object):
         self._update(merger)
 
     def set_field(self, key, value):
+        self.flush()
+
         def merger(data):
             # Current data and prev data is same
             if data[key] == value:
@@ -212,6 +482,8 @@ class GeorepStatus(object):
                         checkpoint_completion_time=checkpoint_completion_time)
 
     def set_last_synced(self, value, checkpoint_time):
+        self.flush()
+
         def merger(data):
             data["last_synced"] = value[0]
 
@@ -253,6 +525,8 @@ class GeorepStatus(object):
                             status=status))
 
     def set_secondary_node(self, secondary_node):
+        self.flush()
+
         def merger(data):
             data["secondary_node"] = secondary_node
             return json.dumps(data)
@@ -260,6 +534,10 @@ class GeorepStatus(object):
         self._update(merger)
 
     def inc_value(self, key, value):
+        if self.flush_interval > 0:
+            self._add_delta(key, value)
+            return
+
         def merger(data):
             data[key] = data.get(key, 0) + value
             return json.dumps(data)
@@ -267,6 +545,10 @@ class GeorepStatus(object):
         self._update(merger)
 
     def dec_value(self, key, value):
+        if self.flush_interval > 0:
+            self._add_delta(key, -value)
+            return
+
         def merger(data):
             data[key] = data.get(key, 0) - value
             if data[key] < 0:
@@ -275,6 +557,35 @@ class GeorepStatus(object):
 
         self._update(merger)
 
+    def _add_delta(self, key, value):
+        with self.deltas_lock:
+            self.deltas[key] = self.deltas.get(key, 0) + value
+            self._publish(deltas={key: value})
+            if self.flusher is None:
+                self.flusher = Thread(target=self._flush_loop)
+                self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """write out the accumulated counter deltas"""
+        with self.deltas_lock:
+            deltas = self.deltas
+            self.deltas = {}
+        deltas = dict((k, v) for k, v in deltas.items() if v)
+        if not deltas:
+            return
+
+        def merger(data):
+            for key, value in deltas.items():
+                data[key] = max(data.get(key, 0) + value, 0)
+            return json.dumps(data)
+
+        self._update(merger)
+
     def set_active(self):
         if self.set_field("worker_status", "Active"):
             logging.info(lf("Worker Status Change",
@@ -310,12 +621,18 @@ class GeorepStatus(object):
         checkpoint_time            N/A        VALUE    VALUE       VALUE
         checkpoint_completed_time  N/A        VALUE    VALUE       VALUE
         """
-        data = self.default_values
-        with open(self.filename) as f:
-            try:
-                data.update(json.load(f))
-            except ValueError:
-                pass
+        data = dict(self.default_values)
+        for key in BATCH_FIELDS:
+            data[key] = 0
+        segment = self.read_segment()
+        if segment is not None:
+            data.update(segment)
+        else:
+            with open(self.filename) as f:
+                try:
+                    data.update(json.load(f))
+                except ValueError:
+                    pass
         monitor_status = self.get_monitor_status()
 
         # Verifying whether monitor process running and adjusting status
@@ -391,6 +708,12 @@ class GeorepStatus(object):
             data["checkpoint_time_utc"] = DEFAULT_STATUS
             data["checkpoint_completion_time_utc"] = DEFAULT_STATUS
 
+        for key in BATCH_FIELDS:
+            if data["worker_status"] != "Active" or not data[key]:
+                data[key] = DEFAULT_STATUS
+            else:
+                data[key] = "%.4f" % data[key]
+
         if data["worker_status"] not in ["Active", "Passive"]:
             data["secondary_node"] = DEFAULT_STATUS
 
@@ -417,3 +740,60 @@ class GeorepStatus(object):
 
         for key, value in status_out.items():
             print(("%s: %s" % (key, value)))
+
+    def set_repce_stats(self, data):
+        """store a snapshot of the RePCe call statistics"""
+        with tempfile.NamedTemporaryFile(
+                'w',
+                dir=self.work_dir,
+                delete=False) as tf:
+            json.dump(data, tf)
+            tempname = tf.name
+        os.rename(tempname, self.repce_stats_file)
+
+    def add_batch_record(self, record, max_size):
+        """append @record to the batch timeline, a file of JSON lines
+        rotated once it's @max_size bytes"""
+        try:
+            if os.path.getsize(self.batches_file) >= max_size:
+                os.rename(self.batches_file, self.batches_file + ".1")
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+        fd = os.open(self.batches_file,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record) + "\n").encode())
+        finally:
+            os.close(fd)
+
+    def get_batch_records(self):
+        return read_batch_records(self.batches_file)
+
+    def get_session_batch_records(self):
+        """the batch records of all the bricks of the session"""
+        records = []
+        for path in glob.glob(os.path.join(self.work_dir, "brick_*.batches")):
+            records += read_batch_records(path)
+        return records
+
+    def get_repce_stats(self, path=None):
+        try:
+            with open(path or self.repce_stats_file) as f:
+                return json.load(f)
+        except (OSError, IOError) as e:
+            if e.errno != ENOENT:
+                raise
+        except ValueError:
+            pass
+        return {}
+
+    def get_session_repce_stats(self):
+        """the RePCe statistics of all the bricks of the session,
+        by brick path"""
+        stats = {}
+        for path in glob.glob(os.path.join(self.work_dir,
+                                           "brick_*.repce_stats")):
+            brick = os.path.basename(path)[len("brick_"):-len(".repce_stats")]
+            stats[urllib.unquote_plus(brick)] = self.get_repce_stats(path)
+        return stats
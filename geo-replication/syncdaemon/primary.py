@@ -17,15 +17,30 @@ import fcntl
 import string
 import errno
 import tarfile
+import zlib
 from errno import ENOENT, ENODATA, EEXIST, EACCES, EAGAIN, ESTALE, EINTR
-from threading import Condition, Lock
+from threading import Condition, Lock, BoundedSemaphore
 from datetime import datetime
+from collections import deque
+try:
+    from concurrent.futures import ThreadPoolExecutor, Future
+except ImportError:
+    # py2 without the futures backport, lookups are not prefetched
+    ThreadPoolExecutor = None
+
+    class Future(object):
+        pass
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 import gsyncdconfig as gconf
 import libgfchangelog
+import changelogparser
 from rconf import rconf
 from syncdutils import (Thread, GsyncdError, escape_space_newline,
-                        unescape_space_newline, gauxpfx, escape,
+                        gauxpfx, escape,
                         lstat, errno_wrap, FreeObject, lf, matching_disk_gfid,
                         NoStimeAvailable, PartialHistoryAvailable,
                         host_brick_split)
@@ -119,6 +134,8 @@ def gprimary_builder(excrawl=None):
 
     if gconf.get("sync-method") == "tarssh":
         syncengine = TarSSHEngine
+    elif gconf.get("sync-method") == "native":
+        syncengine = NativeEngine
     else:
         syncengine = RsyncEngine
 
@@ -279,69 +296,19 @@ class TarSSHEngine(object):
        for data transfers. Good for lots of small files.
     """
 
-    def a_syncdata(self, files):
-        logging.debug(lf("Files", files=files))
-
-        for f in files:
-            pb = self.syncer.add(f)
-
-            def regjob(se, xte, pb):
-                rv = pb.wait()
-                if rv[0]:
-                    logging.debug(lf('synced', file=se))
-                    return True
-                else:
-                    # stat check for file presence
-                    st = lstat(se)
-                    if isinstance(st, int):
-                        # file got unlinked in the interim
-                        self.unlinked_gfids.add(se)
-                        return True
-
-            self.add_job(self.FLAT_DIR_HIERARCHY, 'reg', regjob, f, None, pb)
-
-    def syncdata_wait(self):
-        if self.wait(self.FLAT_DIR_HIERARCHY, None):
-            return True
-
-    def syncdata(self, files):
-        self.a_syncdata(files)
-        self.syncdata_wait()
-
 
 class RsyncEngine(object):
 
     """Sync engine that uses rsync(1) for data transfers"""
 
-    def a_syncdata(self, files):
-        logging.debug(lf("files", files=files))
-
-        for f in files:
-            logging.debug(lf('candidate for syncing', file=f))
-            pb = self.syncer.add(f)
-
-            def regjob(se, xte, pb):
-                rv = pb.wait()
-                if rv[0]:
-                    logging.debug(lf('synced', file=se))
-                    return True
-                else:
-                    # stat to check if the file exist
-                    st = lstat(se)
-                    if isinstance(st, int):
-                        # file got unlinked in the interim
-                        self.unlinked_gfids.add(se)
-                        return True
 
-            self.add_job(self.FLAT_DIR_HIERARCHY, 'reg', regjob, f, None, pb)
+class NativeEngine(RsyncEngine):
 
-    def syncdata_wait(self):
-        if self.wait(self.FLAT_DIR_HIERARCHY, None):
-            return True
+    """Sync engine that sends file data over RePCe
 
-    def syncdata(self, files):
-        self.a_syncdata(files)
-        self.syncdata_wait()
+    Files are queued and accounted for like with rsync, only the
+    transfer differs (see SSH.native_sync).
+    """
 
 
 class GPrimaryCommon(object):
@@ -404,15 +371,87 @@ class GPrimaryCommon(object):
         self.make_xtime_opts(rsc == self.primary, opts)
         return self.xtime_low(rsc, path, **opts)
 
+    def a_syncdata(self, files, jobkey=None, batch=None):
+        """queue @files for data sync, adding a job waiting for each
+        to the @jobkey jobs (by default, those of the batch)
+
+        The files which fail, or turn out to be unlinked, are noted
+        in the ChangelogBatch @batch, if any.
+        """
+        logging.debug(lf("files", files=files))
+
+        # sizes of the files of the batch, if the Syncer accounts
+        # for them, were looked up along with the other lookups
+        sized = self.syncer.sized and jobkey is None and \
+            self.resolver is not None
+        log_err = batch is not None and batch.log_err
+        for f in files:
+            logging.debug(lf('candidate for syncing', file=f))
+            size = None
+            if sized:
+                st = self.resolver.lstat(f)
+                size = 0 if isinstance(st, int) else st.st_size
+            pb = self.syncer.add(f, size, log_err)
+
+            def regjob(se, xte, pb):
+                rv = pb.wait()
+                # on partial failure, the files which failed
+                # are told if known
+                if rv[0] or (rv[2] is not None and se not in rv[2]):
+                    logging.debug(lf('synced', file=se))
+                    return True
+                else:
+                    # stat to check if the file exist
+                    st = lstat(se)
+                    if isinstance(st, int):
+                        # file got unlinked in the interim
+                        if batch is not None:
+                            batch.unlinked_gfids.add(se)
+                        return True
+                    if batch is not None:
+                        batch.datas_failed.add(se)
+
+            self.add_job(jobkey or self.FLAT_DIR_HIERARCHY, 'reg', regjob,
+                         f, None, pb)
+        self.syncer.flush()
+
+    def syncdata_wait(self):
+        if self.wait(self.FLAT_DIR_HIERARCHY, None):
+            return True
+
+    def syncdata(self, files):
+        self.a_syncdata(files)
+        self.syncdata_wait()
+
+    def make_syncer(self, method, jobs):
+        """return a Syncer with @jobs workers using sync @method"""
+        if method == "tarssh":
+            return Syncer(self.secondary, self.secondary.tarssh, [2], jobs)
+        elif method == "native" and \
+                self.secondary.native_sync_supported():
+            # some files could not be synced
+            return Syncer(self.secondary, self.secondary.native_sync, [23],
+                          jobs)
+        else:
+            if method == "native":
+                logging.warn(lf("Native sync method not supported by "
+                                "the Secondary, using rsync"))
+            # partial transfer (cf. rsync(1)), that's normal
+            return Syncer(self.secondary, self.secondary.rsync, [23, 24],
+                          jobs)
+
     def __init__(self, primary, secondary):
         self.primary = primary
         self.secondary = secondary
         self.jobtab = {}
-        if gconf.get("sync-method") == "tarssh":
-            self.syncer = Syncer(secondary, self.secondary.tarssh, [2])
-        else:
-            # partial transfer (cf. rsync(1)), that's normal
-            self.syncer = Syncer(secondary, self.secondary.rsync, [23, 24])
+        self.syncer = self.make_syncer(gconf.get("sync-method"),
+                                       gconf.get("sync-jobs"))
+        if gconf.get("sync-large-file-size"):
+            self.syncer = SplitSyncer(
+                self.syncer,
+                self.make_syncer(gconf.get("sync-large-file-method"),
+                                 gconf.get("sync-large-file-jobs")),
+                gconf.get("sync-large-file-size"))
         # crawls vs. turns:
         # - self.crawls is simply the number of crawl() invocations on root
         # - one turn is a maximal consecutive sequence of crawls so that each
@@ -433,7 +472,6 @@ class GPrimaryCommon(object):
         self.volinfo = None
         self.terminate = False
         self.sleep_interval = 1
-        self.unlinked_gfids = set()
 
     def init_keep_alive(cls):
         """start the keep-alive thread """
@@ -654,14 +692,18 @@ class GPrimaryCommon(object):
         success of all the jobs. In case of
         success, call .sendmark on @path
         """
-        jobs = self.jobtab.pop(path, [])
+        succeed = self.run_jobs(self.jobtab.pop(path, []))
+        if succeed and not args[0] is None:
+            self.sendmark(path, *args)
+        return succeed
+
+    def run_jobs(self, jobs):
+        """perform @jobs, return if all of them succeeded"""
         succeed = True
         for j in jobs:
             ret = j[-1]()
             if not ret:
                 succeed = False
-        if succeed and not args[0] is None:
-            self.sendmark(path, *args)
         return succeed
 
     def sendmark(self, path, mark, adct=None):
@@ -683,28 +725,213 @@ class XCrawlMetadata(object):
         self.st_mtime = float(st_mtime)
 
 
-class GPrimaryChangelogMixin(GPrimaryCommon):
+class StatResolver(object):
 
-    """ changelog based change detection and syncing """
+    """lstat() and GFID checks of the files of a batch of changelogs
 
-    # index for change type and entry
-    IDX_START = 0
-    IDX_END = 2
-    UNLINK_ENTRY = 2
+    The lookups the records of a batch call for are issued upfront,
+    concurrently on @nthreads threads, each being a round trip to the
+    aux-gfid mount. Results are kept till the batch is over, but are
+    dropped for a GFID on its UNLINK, RMDIR and RENAME, so lookups
+    made after those hit the mount again.
+    """
 
-    POS_GFID = 0
-    POS_TYPE = 1
-    POS_ENTRY1 = -1
+    def __init__(self, nthreads):
+        self.executor = None
+        if nthreads > 1 and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(max_workers=nthreads)
+        self.pfx = gauxpfx()
+        self.reset()
+
+    def reset(self):
+        # aux-gfid path -> lstat() result (or its Future)
+        self.stats = {}
+        # gfid -> {entry: matching_disk_gfid() result (or its Future)}
+        self.matches = {}
+
+    def _submit(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def prefetch(self, parsed, data=False):
+        """start the lookups of the Changelogs @parsed, including
+        the lstat() of the files to sync if @data"""
+        if self.executor is None:
+            return
+        for cl in parsed:
+            for ty, fop, gfid, en, args in zip(cl.types, cl.fops, cl.gfids,
+                                               cl.entries, cl.args):
+                go = self.pfx + gfid
+                if ty == changelogparser.TYPE_ENTRY:
+                    if fop in changelogparser.CREATE_FOPS:
+                        continue
+                    if fop not in changelogparser.FIRST_ENTRY_FOPS:
+                        ens = self.matches.setdefault(gfid, {})
+                        if en not in ens:
+                            ens[en] = self._submit(matching_disk_gfid,
+                                                   gfid, en)
+                elif ty == changelogparser.TYPE_DATA:
+                    if not data:
+                        continue
+                elif ty != changelogparser.TYPE_META or \
+                        fop != 'SETATTR' or len(args) == 5:
+                    continue
+                if go not in self.stats:
+                    self.stats[go] = self._submit(lstat, go)
+
+    def lstat(self, go):
+        res = self.stats.get(go)
+        if res is None:
+            res = self.stats[go] = lstat(go)
+        elif isinstance(res, Future):
+            res = self.stats[go] = res.result()
+        return res
+
+    def matching_disk_gfid(self, gfid, en):
+        ens = self.matches.setdefault(gfid, {})
+        res = ens.get(en)
+        if res is None:
+            res = ens[en] = matching_disk_gfid(gfid, en)
+        elif isinstance(res, Future):
+            res = ens[en] = res.result()
+        return res
+
+    def forget(self, gfid):
+        """drop the results of @gfid"""
+        self.stats.pop(self.pfx + gfid, None)
+        self.matches.pop(gfid, None)
+
+
+class BatchSizer(object):
+
+    """size limit of the batches changelogs are grouped into
+
+    With a latency @target (in seconds), the limit adapts to how long
+    batches take to sync their entries, metadata and data: it grows by
+    @size while batches which were cut by the limit sync within half
+    of the target, and shrinks in proportion to the overshoot (at most
+    halved) when a batch takes longer than the target, or is halved
+    when a batch had to be retried. The limit stays between a
+    sixteenth of @size and @max_size. Without a target, batches are
+    sized by @size only.
+    """
+
+    def __init__(self, size, target, max_size):
+        self.base = size
+        self.size = size
+        self.target = target
+        self.min_size = max(size // 16, 1)
+        self.max_size = max(max_size, size)
+        self.lock = Lock()
+        # last changelog of the batches cut by the limit
+        self.full = set()
+
+    def batches(self, changes):
+        """group @changes into batches, the limit being read as each
+        batch is started so that feedback of the batches processed
+        meanwhile is taken into account"""
+        batch = []
+        batch_size = 0
+        for c in changes:
+            si = os.lstat(c).st_size
+            if batch and batch_size + si > self.size:
+                with self.lock:
+                    self.full.add(batch[-1])
+                yield batch
+                batch = []
+                batch_size = 0
+            # a single changelog bigger than the limit is a batch too
+            batch.append(c)
+            batch_size += si
+        if batch:
+            yield batch
+
+    def observe(self, changes, sync_time, retries):
+        """adapt the limit to the batch of @changes, synced in
+        @sync_time seconds with @retries"""
+        with self.lock:
+            full = changes[-1] in self.full
+            self.full.discard(changes[-1])
+            if not self.target:
+                return
+            size = self.size
+            if retries:
+                size = size // 2
+            elif sync_time > self.target:
+                size = int(size * max(0.5, self.target / sync_time))
+            elif full and sync_time < self.target / 2.0:
+                size += self.base
+            size = min(max(size, self.min_size), self.max_size)
+            if size == self.size:
+                return
+            self.size = size
+
+        logging.info(lf("Changelog batch size changed",
+                        size=size,
+                        sync_time="%.4f" % sync_time,
+                        retries=retries))
 
-    TYPE_META = "M "
-    TYPE_GFID = "D "
-    TYPE_ENTRY = "E "
+
+class ChangelogBatch(object):
+
+    """a batch of changelogs, and what's left to do of it once its
+    entries and metadata are synced"""
+
+    def __init__(self, changes, done):
+        self.changes = changes
+        self.done = done
+        # files whose sync failed, to be retried
+        self.datas_failed = set()
+        # files whose sync failed as they got unlinked in the interim
+        self.unlinked_gfids = set()
+        # if the sync errors are logged, for the last retry
+        self.log_err = False
+        self.queue_wait = 0
+        self.retries = 0
+
+    def collect(self, gprimary):
+        """collect the pending data syncs and the stats of the batch
+        from @gprimary, once its entries and metadata are synced"""
+        self.jobs = gprimary.jobtab.pop(gprimary.FLAT_DIR_HIERARCHY, [])
+        self.datas = gprimary.datas_in_batch
+        self.files_in_batch = gprimary.files_in_batch
+        self.num_files = len(self.datas)
+        # bytes to sync, if accounted: sum up the sizes of the
+        # PostBoxes the data jobs wait on
+        self.bytes = None
+        if gprimary.syncer.sized:
+            boxes = dict((id(j[1][2]), j[1][2]) for j in self.jobs
+                         if j[0] == 'reg')
+            self.bytes = sum(pb.size for pb in boxes.values())
+        self.queued_time = time.time()
+        self.stats = gprimary.batch_stats
+        self.start_time = gprimary.batch_start_time
+        self.skipped_first = gprimary.skipped_entry_changelogs_first
+        self.skipped_last = gprimary.skipped_entry_changelogs_last
+        self.num_skipped = gprimary.num_skipped_entry_changelogs
+
+
+class GPrimaryChangelogMixin(GPrimaryCommon):
+
+    """ changelog based change detection and syncing """
+
+    TYPE_META = changelogparser.TYPE_META
+    TYPE_GFID = changelogparser.TYPE_DATA
+    TYPE_ENTRY = changelogparser.TYPE_ENTRY
 
     MAX_EF_RETRIES = 10
     MAX_OE_RETRIES = 10
 
     # flat directory hierarchy for gfid based access
     FLAT_DIR_HIERARCHY = '.'
+    # job table key of the data syncs retried by the batch completer
+    RETRY_JOBS = 'retry'
+
+    # batches waiting for data sync, if pipelined
+    batch_queue = None
+    # lookups of the files of the batch being processed
+    resolver = None
+    # size limit of the changelog batches
+    batch_sizer = None
 
     CHANGELOG_CONN_RETRIES = 5
 
@@ -722,6 +949,7 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
             "SETXATTR": 0,
             "XATTROP": 0,
             "DATA": 0,
+            "COALESCED": 0,
             "ENTRY_SYNC_TIME": 0,
             "META_SYNC_TIME": 0,
             "DATA_START_TIME": 0
@@ -986,7 +1214,7 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
                 for failure in failures1:
                     logging.error("Failed to fix entry ops %s", repr(failure))
 
-    def process_change(self, change, done, retry):
+    def process_change(self, change, done, cl=None, batch=None):
         pfx = gauxpfx()
         clist = []
         entries = []
@@ -1015,24 +1243,16 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
             if int(change_ts) <= entry_stime[0]:
                 ignore_entry_ops = True
 
-        try:
-            f = open(change, "r")
-            clist = f.readlines()
-            f.close()
-        except IOError:
-            raise
-
-        for e in clist:
-            e = e.strip()
-            et = e[self.IDX_START:self.IDX_END]   # entry type
-            ec = e[self.IDX_END:].split(' ')      # rest of the bits
+        if cl is None:
+            cl = changelogparser.parse(change, pfx, use_mmap=True)
 
+        for et, ty, gfid, en, en1, mode, uid, gid, args in cl.rows():
             # skip ENTRY operation if hot tier brick
             if self.name == 'live_changelog' or \
                self.name == 'history_changelog':
                 if rconf.args.is_hottier and et == self.TYPE_ENTRY:
                     logging.debug(lf('skip ENTRY op if hot tier brick',
-                                     op=ec[self.POS_TYPE]))
+                                     op=ty))
                     continue
 
             # Data and Meta operations are decided while parsing
@@ -1040,7 +1260,7 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
             # entry ops if ignore_entry_ops is True.
             # UNLINK/RMDIR/MKNOD entry_ops are ignored in the end
             if ignore_entry_ops and et == self.TYPE_ENTRY and \
-               ec[self.POS_TYPE] not in ["UNLINK", "RMDIR", "MKNOD"]:
+               ty not in ["UNLINK", "RMDIR", "MKNOD"]:
                 continue
 
             if et == self.TYPE_ENTRY:
@@ -1048,27 +1268,14 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
                 # the entry operation. create(), mkdir() and mknod()
                 # have mode, uid, gid information in the changelog
                 # itself, so no need to stat()...
-                ty = ec[self.POS_TYPE]
-
-                self.update_fop_batch_stats(ec[self.POS_TYPE])
-
-                # PARGFID/BNAME
-                en = unescape_space_newline(
-                    os.path.join(pfx, ec[self.POS_ENTRY1]))
-                # GFID of the entry
-                gfid = ec[self.POS_GFID]
+                self.update_fop_batch_stats(ty)
 
                 if ty in ['UNLINK', 'RMDIR']:
-                    # The index of PARGFID/BNAME for UNLINK, RMDIR
-                    # is no more the last index. It varies based on
-                    # changelog.capture-del-path is enabled or not.
-                    en = unescape_space_newline(
-                        os.path.join(pfx, ec[self.UNLINK_ENTRY]))
-
                     # Remove from DATA list, so that rsync will
                     # not fail
-                    pt = os.path.join(pfx, ec[0])
-                    st = lstat(pt)
+                    pt = pfx + gfid
+                    st = self.resolver.lstat(pt)
+                    self.resolver.forget(gfid)
                     if pt in datas and isinstance(st, int):
                         # file got unlinked, May be historical Changelog
                         datas.remove(pt)
@@ -1084,13 +1291,12 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
                 elif ty in ['CREATE', 'MKDIR', 'MKNOD']:
                     # Special case: record mknod as link
                     if ty in ['MKNOD']:
-                        mode = int(ec[2])
                         if mode & 0o1000:
                                 # Avoid stat'ing the file as it
                                 # may be deleted in the interim
-                                st = FreeObject(st_mode=int(ec[2]),
-                                                st_uid=int(ec[3]),
-                                                st_gid=int(ec[4]),
+                                st = FreeObject(st_mode=mode,
+                                                st_uid=uid,
+                                                st_gid=gid,
                                                 st_atime=0,
                                                 st_mtime=0)
 
@@ -1102,44 +1308,43 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
 
                                 # Here, we have the assumption that only
                                 # tier-gfid.linkto causes this mknod. Add data
-                                datas.add(os.path.join(pfx, ec[0]))
+                                datas.add(pfx + gfid)
                                 continue
 
                     # stat info. present in the changelog itself
                     entries.append(edct(ty, gfid=gfid, entry=en,
-                                   mode=int(ec[2]),
-                                   uid=int(ec[3]), gid=int(ec[4])))
+                                   mode=mode, uid=uid, gid=gid))
                 elif ty == "RENAME":
-                    go = os.path.join(pfx, gfid)
-                    st = lstat(go)
+                    go = pfx + gfid
+                    st = self.resolver.lstat(go)
+                    self.resolver.forget(gfid)
                     if isinstance(st, int):
                         st = {}
 
+                    # the entry is looked up at the target of the rename
                     rl = None
                     if st and stat.S_ISLNK(st.st_mode):
-                        rl = errno_wrap(os.readlink, [en], [ENOENT],
+                        rl = errno_wrap(os.readlink, [en1], [ENOENT],
                                         [ESTALE, EINTR])
                         if isinstance(rl, int):
                             rl = None
 
-                    e1 = unescape_space_newline(
-                        os.path.join(pfx, ec[self.POS_ENTRY1 - 1]))
-                    entries.append(edct(ty, gfid=gfid, entry=e1, entry1=en,
+                    entries.append(edct(ty, gfid=gfid, entry=en, entry1=en1,
                                         stat=st, link=rl))
                     # If src doesn't exist while doing rename, destination
                     # is created. If data is not followed by rename, this
                     # remains zero byte file on secondary. Hence add data entry
                     # for renames
-                    datas.add(os.path.join(pfx, gfid))
+                    datas.add(go)
                 else:
                     # stat() to get mode and other information
-                    if not matching_disk_gfid(gfid, en):
+                    if not self.resolver.matching_disk_gfid(gfid, en):
                         logging.debug(lf('Ignoring entry, purged in the '
                                       'interim', file=en, gfid=gfid))
                         continue
 
-                    go = os.path.join(pfx, gfid)
-                    st = lstat(go)
+                    go = pfx + gfid
+                    st = self.resolver.lstat(go)
                     if isinstance(st, int):
                         logging.debug(lf('Ignoring entry, purged in the '
                                       'interim', file=en, gfid=gfid))
@@ -1159,7 +1364,7 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
                         # followed by link, this remains zero byte file on
                         # secondary. Hence add data entry for links
                         if rl is None:
-                            datas.add(os.path.join(pfx, gfid))
+                            datas.add(go)
                     elif ty == 'SYMLINK':
                         rl = errno_wrap(os.readlink, [en], [ENOENT],
                                         [ESTALE, EINTR])
@@ -1173,39 +1378,38 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
                                         gfid=gfid,
                                         type=ty))
             elif et == self.TYPE_GFID:
-                # If self.unlinked_gfids is available, then that means it is
-                # retrying the changelog second time. Do not add the GFID's
-                # to rsync job if failed previously but unlinked in primary
-                if self.unlinked_gfids and \
-                   os.path.join(pfx, ec[0]) in self.unlinked_gfids:
+                # Do not add the GFID's to rsync job if failed
+                # previously but unlinked in primary
+                if batch is not None and \
+                   pfx + gfid in batch.unlinked_gfids:
                     logging.debug("ignoring data, since file purged interim")
                 else:
-                    datas.add(os.path.join(pfx, ec[0]))
+                    datas.add(pfx + gfid)
             elif et == self.TYPE_META:
-                self.update_fop_batch_stats(ec[self.POS_TYPE])
-                if ec[1] == 'SETATTR':  # only setattr's for now...
-                    if len(ec) == 5:
+                self.update_fop_batch_stats(ty)
+                if ty == 'SETATTR':  # only setattr's for now...
+                    if len(args) == 5:
                         # In xsync crawl, we already have stat data
-                        # avoid doing stat again
-                        meta_gfid.add((os.path.join(pfx, ec[0]),
-                                       XCrawlMetadata(st_uid=ec[2],
-                                                      st_gid=ec[3],
-                                                      st_mode=ec[4],
-                                                      st_atime=ec[5],
-                                                      st_mtime=ec[6])))
+                        # (uid, gid, mode, atime, mtime) avoid doing
+                        # stat again
+                        meta_gfid.add((pfx + gfid, XCrawlMetadata(*args)))
                     else:
-                        meta_gfid.add((os.path.join(pfx, ec[0]), ))
-                elif ec[1] in ['SETXATTR', 'XATTROP', 'FXATTROP']:
+                        meta_gfid.add((pfx + gfid, ))
+                elif ty in ['SETXATTR', 'XATTROP', 'FXATTROP']:
                     # To sync xattr/acls use rsync/tar, --xattrs and --acls
                     # switch to rsync and tar
-                    if not gconf.get("sync-method") == "tarssh" and \
+                    if gconf.get("sync-method") == "rsync" and \
                        (gconf.get("sync-xattrs") or gconf.get("sync-acls")):
-                        datas.add(os.path.join(pfx, ec[0]))
+                        datas.add(pfx + gfid)
             else:
                 logging.warn(lf('got invalid fop type',
                                 type=et))
         logging.debug('entries: %s' % repr(entries))
 
+        # files already queued for an earlier changelog of the batch
+        # are not synced again, the sync reads them as they're by now
+        datas -= self.datas_in_batch
+
         # Increment counters for Status
         self.files_in_batch += len(datas)
         self.status.inc_value("data", len(datas))
@@ -1214,13 +1418,37 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
             self.batch_stats["SETXATTR"] - \
             self.batch_stats["XATTROP"]
 
+        # stat the metadata candidates upfront, so that metadata ops
+        # can be pipelined with the entry ops in a single round trip
+        meta_entries = []
+        for go in meta_gfid:
+            if len(go) > 1:
+                st = go[1]
+            else:
+                st = self.resolver.lstat(go[0])
+            if isinstance(st, int):
+                logging.debug(lf('file got purged in the interim',
+                                 file=go[0]))
+                continue
+            meta_entries.append(edct('META', go=go[0], stat=st))
+
         entry_start_time = time.time()
+        # Meta ops results if sent together with entry ops
+        meta_failures = None
         # sync namespace
         if entries and not ignore_entry_ops:
             # Increment counters for Status
             self.status.inc_value("entry", len(entries))
 
-            failures = self.secondary.server.entry_ops(entries)
+            if meta_entries:
+                # Secondary executes the calls of a batch in order.
+                # The round trip can't be told apart between the two,
+                # it's all accounted in ENTRY_SYNC_TIME
+                failures, meta_failures = self.secondary.server.call_many(
+                    [('entry_ops', (entries, )),
+                     ('meta_ops', (meta_entries, ))])
+            else:
+                failures = self.secondary.server.entry_ops(entries)
 
             if gconf.get("gfid-conflict-resolution"):
                 count = 0
@@ -1229,6 +1457,9 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
                 if failures:
                     logging.info(lf('Entry ops failed with gfid mismatch',
                                     count=num_failures))
+                    # Metadata is to be applied again once
+                    # the fixed entries are in place
+                    meta_failures = None
                 while failures and count < self.MAX_OE_RETRIES:
                     count += 1
                     self.handle_entry_failures(failures, entries)
@@ -1274,24 +1505,14 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
             self.skipped_entry_changelogs_last = change_ts
 
         meta_start_time = time.time()
-        # sync metadata
-        if meta_gfid:
-            meta_entries = []
-            for go in meta_gfid:
-                if len(go) > 1:
-                    st = go[1]
-                else:
-                    st = lstat(go[0])
-                if isinstance(st, int):
-                    logging.debug(lf('file got purged in the interim',
-                                     file=go[0]))
-                    continue
-                meta_entries.append(edct('META', go=go[0], stat=st))
-            if meta_entries:
-                self.status.inc_value("meta", len(meta_entries))
-                failures = self.secondary.server.meta_ops(meta_entries)
-                self.log_failures(failures, 'go', '', 'META')
-                self.status.dec_value("meta", len(meta_entries))
+        # sync metadata, unless done along with the entry ops above
+        # (META_SYNC_TIME then doesn't cover the meta ops)
+        if meta_entries:
+            self.status.inc_value("meta", len(meta_entries))
+            if meta_failures is None:
+                meta_failures = self.secondary.server.meta_ops(meta_entries)
+            self.log_failures(meta_failures, 'go', '', 'META')
+            self.status.dec_value("meta", len(meta_entries))
 
         self.batch_stats["META_SYNC_TIME"] += time.time() - meta_start_time
 
@@ -1300,164 +1521,285 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
 
         # sync data
         if datas:
-            self.a_syncdata(datas)
+            self.a_syncdata(datas, batch=batch)
             self.datas_in_batch.update(datas)
 
     def process(self, changes, done=1):
-        tries = 0
-        retry = False
-        self.unlinked_gfids = set()
+        """process a batch of changelogs
+
+        Entries and metadata are synced here, while the data sync of
+        the batch is waited for by .complete_batch. With
+        changelog-batch-inflight above 1 that happens in a separate
+        thread, so that the entries of the next batches are synced
+        while the data of the previous ones is still in transfer.
+        Batches are completed in order, so stime only moves forward.
+        """
         self.files_in_batch = 0
         self.datas_in_batch = set()
-        # Error log disabled till the last round
-        self.syncer.disable_errorlog()
         self.skipped_entry_changelogs_first = None
         self.skipped_entry_changelogs_last = None
         self.num_skipped_entry_changelogs = 0
         self.batch_start_time = time.time()
         self.init_fop_batch_stats()
 
-        while True:
-            # first, fire all changelog transfers in parallel. entry and
-            # metadata are performed synchronously, therefore in serial.
-            # However at the end of each changelog, data is synchronized
-            # with syncdata_async() - which means it is serial w.r.t
-            # entries/metadata of that changelog but happens in parallel
-            # with data of other changelogs.
-
-            if retry:
-                if tries == (gconf.get("max-rsync-retries") - 1):
-                    # Enable Error logging if it is last retry
-                    self.syncer.enable_errorlog()
-
-                # Remove Unlinked GFIDs from Queue
-                for unlinked_gfid in self.unlinked_gfids:
-                    if unlinked_gfid in self.datas_in_batch:
-                        self.datas_in_batch.remove(unlinked_gfid)
-
-                # Retry only Sync. Do not retry entry ops
-                if self.datas_in_batch:
-                    self.a_syncdata(self.datas_in_batch)
-            else:
-                for change in changes:
-                    logging.debug(lf('processing change',
-                                     changelog=change))
-                    self.process_change(change, done, retry)
-                    if not retry:
-                        # number of changelogs processed in the batch
-                        self.turns += 1
-
-            # Now we wait for all the data transfers fired off in the above
-            # step to complete. Note that this is not ideal either. Ideally
-            # we want to trigger the entry/meta-data transfer of the next
-            # batch while waiting for the data transfer of the current batch
-            # to finish.
-
-            # Note that the reason to wait for the data transfer (vs doing it
-            # completely in the background and call the changelog_done()
-            # asynchronously) is because this waiting acts as a "backpressure"
-            # and prevents a spiraling increase of wait stubs from consuming
+        # first, fire all changelog transfers in parallel. entry and
+        # metadata are performed synchronously, therefore in serial.
+        # However at the end of each changelog, data is synchronized
+        # with syncdata_async() - which means it is serial w.r.t
+        # entries/metadata of that changelog but happens in parallel
+        # with data of other changelogs.
+        parsed = [changelogparser.parse(change, gauxpfx(), use_mmap=True)
+                  for change in changes]
+        if self.resolver is None:
+            self.resolver = StatResolver(
+                gconf.get("changelog-lookup-threads"))
+        self.resolver.reset()
+        self.resolver.prefetch(parsed, self.syncer.sized)
+        if gconf.get("changelog-batch-coalesce") and \
+           not gconf.get("ignore-deletes"):
+            parsed = self.coalesce(parsed)
+
+        batch = ChangelogBatch(changes, done)
+        for change, cl in zip(changes, parsed):
+            logging.debug(lf('processing change',
+                             changelog=change))
+            self.process_change(change, done, cl, batch)
+            # number of changelogs processed in the batch
+            self.turns += 1
+
+        batch.collect(self)
+        inflight = gconf.get("changelog-batch-inflight")
+        if inflight > 1 and self.batch_queue is None and \
+           self.name in ["live_changelog", "history_changelog"]:
+            # one of the batches in flight is the one being processed
+            self.batch_slots = BoundedSemaphore(inflight - 1)
+            self.batch_queue = Queue()
+            Thread(target=self.batch_completer).start()
+
+        if self.batch_queue is None:
+            self.complete_batch(batch)
+        else:
+            # the waiting acts as a "backpressure" and prevents a
+            # spiraling increase of wait stubs from consuming
             # unbounded memory and resources.
+            self.batch_slots.acquire()
+            self.batch_queue.put(batch)
+
+    def coalesce(self, parsed):
+        """drop the records of the files created and unlinked within
+        the changelogs @parsed, which are gone by now
+
+        Such files are neither created on the secondary nor synced,
+        but their unlinks are kept: a crash between the entry ops of
+        a changelog and the update of the entry stime gets the ops
+        replayed, so the files might have been created on the
+        secondary already. Files which had anything else happen to
+        their entries (link, rename) are left alone.
+        """
+        created = set()
+        unlinked = set()
+        others = set()
+        for cl in parsed:
+            for ty, fop, gfid in zip(cl.types, cl.fops, cl.gfids):
+                if ty != self.TYPE_ENTRY:
+                    continue
+                if fop in ['CREATE', 'MKNOD', 'SYMLINK']:
+                    created.add(gfid)
+                elif fop == 'UNLINK':
+                    unlinked.add(gfid)
+                else:
+                    others.add(gfid)
 
+        pfx = gauxpfx()
+        gone = set(gfid for gfid in (created & unlinked) - others
+                   if isinstance(self.resolver.lstat(pfx + gfid), int))
+        if not gone:
+            return parsed
+
+        logging.debug(lf('coalescing short lived files', count=len(gone)))
+        self.batch_stats["COALESCED"] += len(gone)
+        return [cl.select([gfid not in gone or fop == 'UNLINK'
+                           for fop, gfid in zip(cl.fops, cl.gfids)])
+                for cl in parsed]
+
+    def batch_completer(self):
+        """complete the queued batches in order"""
+        while True:
+            batch = self.batch_queue.get()
+            try:
+                self.complete_batch(batch)
+            finally:
+                self.batch_slots.release()
+                self.batch_queue.task_done()
+
+    def drain_batches(self):
+        """wait for the queued batches to be completed"""
+        if self.batch_queue is not None:
+            self.batch_queue.join()
+
+    def complete_batch(self, batch):
+        """wait for the data sync of @batch, retrying the files which
+        failed, then update the secondary's time"""
+        changes = batch.changes
+        tries = 0
+        batch.queue_wait = time.time() - batch.queued_time
+        jobs = batch.jobs
+
+        while True:
             # update the secondary's time with the timestamp of the _last_
             # changelog file time suffix. Since, the changelog prefix time
             # is the time when the changelog was rolled over, introduce a
             # tolerance of 1 second to counter the small delta b/w the
             # marker update and gettimeofday().
             # NOTE: this is only for changelog mode, not xsync.
-
-            # @change is the last changelog (therefore max time for this batch)
-            if self.syncdata_wait():
-                self.unlinked_gfids = set()
-                if done:
-                    xtl = (int(change.split('.')[-1]) - 1, 0)
-                    self.upd_stime(xtl)
-                    list(map(self.changelog_done_func, changes))
-                    self.archive_and_purge_changelogs(changes)
+            if self.run_jobs(jobs):
+                if batch.done:
+                    self.changelogs_done(changes)
 
                 # Reset Data counter after sync
-                self.status.dec_value("data", self.files_in_batch)
-                self.files_in_batch = 0
-                self.datas_in_batch = set()
+                self.status.dec_value("data", batch.files_in_batch)
                 break
 
-            # We do not know which changelog transfer failed, retry everything.
-            retry = True
             tries += 1
+            batch.retries = tries
             if tries == gconf.get("max-rsync-retries"):
                 logging.error(lf('changelogs could not be processed '
                                  'completely - moving on...',
                                  files=list(map(os.path.basename, changes))))
 
                 # Reset data counter on failure
-                self.status.dec_value("data", self.files_in_batch)
-                self.files_in_batch = 0
-                self.datas_in_batch = set()
-
-                if done:
-                    xtl = (int(change.split('.')[-1]) - 1, 0)
-                    self.upd_stime(xtl)
-                    list(map(self.changelog_done_func, changes))
-                    self.archive_and_purge_changelogs(changes)
+                self.status.dec_value("data", batch.files_in_batch)
+
+                if batch.done:
+                    self.changelogs_done(changes)
                 break
-            # it's either entry_ops() or Rsync that failed to do it's
-            # job. Mostly it's entry_ops() [which currently has a problem
-            # of failing to create an entry but failing to return an errno]
-            # Therefore we do not know if it's either Rsync or the freaking
-            # entry_ops() that failed... so we retry the _whole_ changelog
-            # again.
-            # TODO: remove entry retries when it's gets fixed.
             logging.warn(lf('incomplete sync, retrying changelogs',
                             files=list(map(os.path.basename, changes))))
 
             # Reset the Data counter before Retry
-            self.status.dec_value("data", self.files_in_batch)
-            self.files_in_batch = 0
-            self.init_fop_batch_stats()
-            time.sleep(0.5)
+            self.status.dec_value("data", batch.files_in_batch)
+            batch.files_in_batch = 0
+            # back off exponentially, the files which keep failing
+            # are likely to need some time to recover
+            time.sleep(min(0.5 * 2 ** (tries - 1), 10))
+
+            if tries == (gconf.get("max-rsync-retries") - 1):
+                # Enable Error logging if it is last retry
+                batch.log_err = True
+
+            # Remove Unlinked GFIDs from Queue
+            batch.datas -= batch.unlinked_gfids
+
+            # Retry only Sync. Do not retry entry ops, and
+            # only the files which failed
+            datas = batch.datas_failed & batch.datas or batch.datas
+            batch.datas_failed = set()
+            if datas:
+                self.a_syncdata(datas, self.RETRY_JOBS, batch)
+            jobs = self.jobtab.pop(self.RETRY_JOBS, [])
+
+        self.log_batch(batch)
+
+    def changelogs_done(self, changes):
+        """update stime to the last of @changes and dispose of them"""
+        xtl = (int(changes[-1].split('.')[-1]) - 1, 0)
+        self.upd_stime(xtl)
+        list(map(self.changelog_done_func, changes))
+        self.archive_and_purge_changelogs(changes)
+
+    def log_batch(self, batch):
+        changes = batch.changes
+        stats = batch.stats
 
         # Log the Skipped Entry ops range if any
-        if self.skipped_entry_changelogs_first is not None and \
-           self.skipped_entry_changelogs_last is not None:
+        if batch.skipped_first is not None and \
+           batch.skipped_last is not None:
             logging.info(lf("Skipping already processed entry ops",
-                            from_changelog=self.skipped_entry_changelogs_first,
-                            to_changelog=self.skipped_entry_changelogs_last,
-                            num_changelogs=self.num_skipped_entry_changelogs))
+                            from_changelog=batch.skipped_first,
+                            to_changelog=batch.skipped_last,
+                            num_changelogs=batch.num_skipped))
 
         # Log Current batch details
         if changes:
             logging.info(
                 lf("Entry Time Taken",
-                   UNL=self.batch_stats["UNLINK"],
-                   RMD=self.batch_stats["RMDIR"],
-                   CRE=self.batch_stats["CREATE"],
-                   MKN=self.batch_stats["MKNOD"],
-                   MKD=self.batch_stats["MKDIR"],
-                   REN=self.batch_stats["RENAME"],
-                   LIN=self.batch_stats["LINK"],
-                   SYM=self.batch_stats["SYMLINK"],
-                   duration="%.4f" % self.batch_stats["ENTRY_SYNC_TIME"]))
+                   UNL=stats["UNLINK"],
+                   RMD=stats["RMDIR"],
+                   CRE=stats["CREATE"],
+                   MKN=stats["MKNOD"],
+                   MKD=stats["MKDIR"],
+                   REN=stats["RENAME"],
+                   LIN=stats["LINK"],
+                   SYM=stats["SYMLINK"],
+                   duration="%.4f" % stats["ENTRY_SYNC_TIME"]))
 
             logging.info(
                 lf("Data/Metadata Time Taken",
-                   SETA=self.batch_stats["SETATTR"],
-                   meta_duration="%.4f" % self.batch_stats["META_SYNC_TIME"],
-                   SETX=self.batch_stats["SETXATTR"],
-                   XATT=self.batch_stats["XATTROP"],
-                   DATA=self.batch_stats["DATA"],
+                   SETA=stats["SETATTR"],
+                   meta_duration="%.4f" % stats["META_SYNC_TIME"],
+                   SETX=stats["SETXATTR"],
+                   XATT=stats["XATTROP"],
+                   DATA=stats["DATA"],
+                   COA=stats["COALESCED"],
                    data_duration="%.4f" % (
-                       time.time() - self.batch_stats["DATA_START_TIME"])))
+                       time.time() - stats["DATA_START_TIME"])))
+
+            self.status.set_batch_stats(
+                time.time() - batch.start_time,
+                stats["ENTRY_SYNC_TIME"],
+                stats["META_SYNC_TIME"],
+                time.time() - stats["DATA_START_TIME"])
+
+            if self.batch_sizer is not None:
+                self.batch_sizer.observe(
+                    changes,
+                    stats["ENTRY_SYNC_TIME"] + stats["META_SYNC_TIME"] +
+                    time.time() - stats["DATA_START_TIME"],
+                    batch.retries)
+
+            if gconf.get("batch-stats-file-size"):
+                self.add_batch_record(batch)
 
             logging.info(
                 lf("Batch Completed",
                    mode=self.name,
-                   duration="%.4f" % (time.time() - self.batch_start_time),
+                   duration="%.4f" % (time.time() - batch.start_time),
                    changelog_start=changes[0].split(".")[-1],
                    changelog_end=changes[-1].split(".")[-1],
                    num_changelogs=len(changes),
                    stime=self.get_data_stime(),
                    entry_stime=self.get_entry_stime()))
 
+    def add_batch_record(self, batch):
+        """add the timeline record of @batch to the batch stats file"""
+        stats = batch.stats
+        now = time.time()
+        record = {
+            "time": now,
+            "mode": self.name,
+            "changelog_start": int(batch.changes[0].split(".")[-1]),
+            "changelog_end": int(batch.changes[-1].split(".")[-1]),
+            "changelogs": len(batch.changes),
+            "start_time": batch.start_time,
+            "duration": now - batch.start_time,
+            "entry_duration": stats["ENTRY_SYNC_TIME"],
+            "meta_duration": stats["META_SYNC_TIME"],
+            "data_duration": now - stats["DATA_START_TIME"],
+            "queue_wait": batch.queue_wait,
+            "retries": batch.retries,
+            "files": batch.num_files,
+            "bytes": batch.bytes,
+            "fops": dict((k, v) for k, v in stats.items()
+                         if k.isupper() and not k.endswith("_TIME") and v)
+        }
+        try:
+            self.status.add_batch_record(
+                record, gconf.get("batch-stats-file-size"))
+        except (OSError, IOError) as e:
+            # the timeline is informational, never fail the batch for it
+            logging.warn(lf("Failed to add the batch record",
+                            error=e))
+
     def upd_entry_stime(self, stime):
         self.secondary.server.set_entry_stime(self.FLAT_DIR_HIERARCHY,
                                           self.uuid,
@@ -1487,27 +1829,17 @@ class GPrimaryChangelogMixin(GPrimaryCommon):
         self.status.set_secondary_node(remote_node_ip)
 
     def changelogs_batch_process(self, changes):
-        changelogs_batches = []
-        current_size = 0
-        for c in changes:
-            si = os.lstat(c).st_size
-            if (si + current_size) > gconf.get("changelog-batch-size"):
-                # Create new batch if single Changelog file greater than
-                # Max Size! or current batch size exceeds Max size
-                changelogs_batches.append([c])
-                current_size = si
-            else:
-                # Append to last batch, if No batches available Create one
-                current_size += si
-                if not changelogs_batches:
-                    changelogs_batches.append([c])
-                else:
-                    changelogs_batches[-1].append(c)
+        if self.batch_sizer is None:
+            self.batch_sizer = BatchSizer(
+                gconf.get("changelog-batch-size"),
+                gconf.get("changelog-batch-latency-target"),
+                gconf.get("changelog-batch-size-max"))
 
-        for batch in changelogs_batches:
+        for batch in self.batch_sizer.batches(changes):
             logging.debug(lf('processing changes',
                              batch=batch))
             self.process(batch)
+        self.drain_batches()
 
     def crawl(self):
         self.status.set_worker_crawl_status("Changelog Crawl")
@@ -1916,6 +2248,10 @@ class PostBox(list):
         self.lever = Condition()
         self.open = True
         self.done = False
+        # total size of the files posted, if accounted
+        self.size = 0
+        # if the errors of syncing the box are to be logged
+        self.log_err = False
 
     def wait(self):
         """wait on requests to be processed"""
@@ -1974,63 +2310,231 @@ class Syncer(object):
     the producer can re-try posting against the actual PostBox of
     the queue.
 
+    Boxes are also cut when they reach sync-batch-max-files files or
+    sync-batch-max-bytes bytes, and queued as ready for the next
+    worker, so that the sync jobs get batches of bounded size and a
+    burst of changes is spread over all of them. Producers .flush
+    the box at the end of a batch, which hands it over right away.
+
     To aid accumlation of items in the PostBoxen before grabbed
-    by an rsync worker, the worker goes to sleep a bit after
-    each completed syncjob.
+    by an rsync worker, an idle worker takes an unflushed box only
+    after it was left alone for a bit.
+
+    A file added while it's still in a box no worker took yet is not
+    posted again, the requestor gets that box: its transfer picks up
+    the file as it is when it starts. With batches of changelogs in
+    flight (changelog-batch-inflight), this spares syncing the files
+    changed by consecutive batches once per batch.
+
+    A worker taking a box of at least twice sync-shard-min-files
+    files while others are idle splits it by GFID hash into shards
+    for them, syncs one shard itself, and wakes up the requestors of
+    the box once all shards are done. Shards not yet taken by the
+    time it's done with its own are synced by it too.
     """
 
-    def __init__(self, secondary, sync_engine, resilient_errnos=[]):
-        """spawn worker threads"""
-        self.log_err = False
+    def __init__(self, secondary, sync_engine, resilient_errnos=[],
+                 jobs=None):
+        """spawn @jobs (default: sync-jobs) worker threads"""
         self.secondary = secondary
         self.lock = Lock()
+        self.lever = Condition(self.lock)
         self.pb = PostBox()
+        self.ready = deque()
+        # file -> the box it waits in, till a worker takes the box
+        self.waiting = {}
+        self.max_files = gconf.get("sync-batch-max-files")
+        self.max_bytes = gconf.get("sync-batch-max-bytes")
+        self.shard_min = gconf.get("sync-shard-min-files")
+        # if sizes of the files are accounted in the PostBoxes
+        self.sized = bool(self.max_bytes)
+        self.idle = 0
         self.sync_engine = sync_engine
         self.errnos_ok = resilient_errnos
-        for i in range(gconf.get("sync-jobs")):
+        for i in range(jobs or gconf.get("sync-jobs")):
             t = Thread(target=self.syncjob, args=(i + 1, ))
             t.start()
 
+    def _swap(self):
+        # to be called with self.lock held
+        pb, self.pb = self.pb, PostBox()
+        pb.close()
+        return pb
+
+    def _seal(self):
+        # to be called with self.lock held
+        self.ready.append(self._swap())
+        self.lever.notify()
+
+    def _take(self, pb):
+        # to be called with self.lock held
+        for e in pb:
+            if self.waiting.get(e) is pb:
+                del self.waiting[e]
+        return pb
+
+    def next_box(self):
+        """wait for a PostBox to sync and take it"""
+        with self.lock:
+            self.idle += 1
+            try:
+                while not self.ready:
+                    self.lever.wait(0.5)
+                    if not self.ready and self.pb:
+                        return self._take(self._swap())
+                return self._take(self.ready.popleft())
+            finally:
+                self.idle -= 1
+
+    def shard(self, pb):
+        """split @pb among the idle workers
+
+        Return the list of shards, the first one for the caller,
+        the others queued for the idle workers. Return None if @pb
+        is not worth splitting.
+        """
+        if not self.shard_min:
+            return None
+        with self.lock:
+            count = min(self.idle + 1, len(pb) // self.shard_min)
+            if count < 2:
+                return None
+            shards = [PostBox() for _ in range(count)]
+            for e in pb:
+                shards[zlib.crc32(e.encode()) % count].append(e)
+            # the hash might have left some empty
+            shards = [shard for shard in shards if shard]
+            if len(shards) < 2:
+                return None
+            count = len(shards)
+            for shard in shards:
+                shard.log_err = pb.log_err
+                shard.close()
+            # ahead of other boxes, the caller is waiting for them
+            self.ready.extendleft(shards[1:])
+            self.lever.notify(count - 1)
+        return shards
+
+    def reclaim(self, pb):
+        """take back @pb from the ready boxes if not yet taken"""
+        with self.lock:
+            for i, ready in enumerate(self.ready):
+                if ready is pb:
+                    del self.ready[i]
+                    self._take(pb)
+                    return True
+        return False
+
+    def sync(self, job_id, pb):
+        """sync the files of @pb, return the outcome for requestors"""
+        start = time.time()
+        po = self.sync_engine(pb, pb.log_err)
+        logging.info(lf("Sync Time Taken",
+                        job=job_id,
+                        num_files=len(pb),
+                        return_code=po.returncode,
+                        duration="%.4f" % (time.time() - start)))
+
+        if po.returncode == 0:
+            return (True, 0, None)
+        elif po.returncode in self.errnos_ok:
+            # the files which failed, if the sync engine could tell
+            # them all (None otherwise)
+            failed = set(getattr(po, 'failed_files', None) or ()) & set(pb)
+            return (False, po.returncode, failed or None)
+        else:
+            po.errfail()
+
     def syncjob(self, job_id):
         """the life of a worker"""
         while True:
-            pb = None
-            while True:
-                self.lock.acquire()
-                if self.pb:
-                    pb, self.pb = self.pb, PostBox()
-                self.lock.release()
-                if pb:
-                    break
-                time.sleep(0.5)
-            pb.close()
-            start = time.time()
-            po = self.sync_engine(pb, self.log_err)
-            logging.info(lf("Sync Time Taken",
-                            job=job_id,
-                            num_files=len(pb),
-                            return_code=po.returncode,
-                            duration="%.4f" % (time.time() - start)))
-
-            if po.returncode == 0:
-                ret = (True, 0)
-            elif po.returncode in self.errnos_ok:
-                ret = (False, po.returncode)
-            else:
-                po.errfail()
-            pb.wakeup(ret)
+            pb = self.next_box()
+            shards = self.shard(pb)
+            if not shards:
+                pb.wakeup(self.sync(job_id, pb))
+                continue
+            rets = [self.sync(job_id, shards[0])]
+            for shard in shards[1:]:
+                if self.reclaim(shard):
+                    rets.append(self.sync(job_id, shard))
+                else:
+                    rets.append(shard.wait())
+            pb.wakeup(merge_outcomes(rets))
 
-    def add(self, e):
-        while True:
-            pb = self.pb
-            try:
-                pb.append(e)
-                return pb
-            except BoxClosedErr:
-                pass
+    def add(self, e, size=None, log_err=False):
+        """add file @e of @size bytes to the current PostBox,
+        return the box
 
-    def enable_errorlog(self):
-        self.log_err = True
+        With @log_err, the errors of syncing the box are logged.
+        """
+        pb = self.waiting.get(e)
+        if pb is not None and not log_err:
+            return pb
+        if size is None:
+            size = 0
+            if self.max_bytes:
+                st = lstat(e)
+                if not isinstance(st, int):
+                    size = st.st_size
+        with self.lock:
+            pb = self.waiting.get(e)
+            if pb is not None:
+                pb.log_err = pb.log_err or log_err
+                return pb
+            pb = self.pb
+            pb.append(e)
+            pb.size += size
+            pb.log_err = pb.log_err or log_err
+            self.waiting[e] = pb
+            if (self.max_files and len(pb) >= self.max_files) or \
+               (self.max_bytes and pb.size >= self.max_bytes):
+                self._seal()
+            return pb
+
+    def flush(self):
+        """hand the current PostBox over to a worker right away"""
+        with self.lock:
+            if self.pb:
+                self._seal()
+
+
+def merge_outcomes(rets):
+    """merge the outcomes of syncing parts of a PostBox"""
+    failed = [ret for ret in rets if not ret[0]]
+    if not failed:
+        return (True, 0, None)
+    files = set()
+    for ret in failed:
+        if ret[2] is None:
+            files = None
+            break
+        files |= ret[2]
+    return (False, failed[0][1], files)
+
+
+class SplitSyncer(object):
+
+    """front of two Syncers, one for small files and one for large ones
+
+    Files of at least @threshold bytes go to the @large Syncer, so that
+    big transfers don't hold back the boxes of small files, and each
+    kind gets its own sync method and number of jobs.
+    """
 
-    def disable_errorlog(self):
-        self.log_err = False
+    def __init__(self, small, large, threshold):
+        self.small = small
+        self.large = large
+        self.threshold = threshold
+        self.sized = True
+
+    def add(self, e, size=None, log_err=False):
+        if size is None:
+            st = lstat(e)
+            size = 0 if isinstance(st, int) else st.st_size
+        if size >= self.threshold:
+            return self.large.add(e, size, log_err)
+        return self.small.add(e, size, log_err)
+
+    def flush(self):
+        self.small.flush()
+        self.large.flush()
@@ -27,5 +27,9 @@ class RConf(object):
     mountbroker = False
     mount_point = None
     mbr_umount_cmd = []
+    # ssh processes of the RePCe data channels
+    channel_transports = []
+    # commands stopping the ssh control masters started apart
+    ssh_ctl_exit_args = []
 
 rconf = RConf()
@@ -11,12 +11,16 @@
 import os
 import sys
 import time
+import itertools
+import zlib
+import struct
 import logging
-from threading import Condition
+from threading import Lock
 try:
-    import _thread as thread
+    from concurrent.futures import TimeoutError
 except ImportError:
-    import thread
+    class TimeoutError(Exception):
+        pass
 try:
     from queue import Queue
 except ImportError:
@@ -25,11 +29,58 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-from syncdutils import Thread, select, lf
+from syncdutils import Thread, GsyncdError, lf
 
 pickle_proto = 2
-repce_version = 1.0
+# minor version 1 announces support for length-prefixed frames,
+# minor version 2 for negotiating their compression,
+# the major part is what peers compare during the handshake
+repce_version = 1.2
+
+# Frame header: magic, flags, payload length.
+# Legacy (unframed) messages are bare pickles which always start
+# with the PROTO opcode (0x80), so the magic byte is what tells
+# the two formats apart on the receiving side.
+FRAME_MAGIC = 0x52
+FRAME_HDR = struct.Struct('!BBI')
+# payload is a list of messages to be processed in order
+FLAG_BATCH = 0x01
+# payload is compressed
+FLAG_ZLIB = 0x02
+FLAG_ZSTD = 0x04
+
+
+class Codec(object):
+
+    """compression method for frame payloads"""
+
+    def __init__(self, name, flag, compress, decompress):
+        self.name = name
+        self.flag = flag
+        self.compress = compress
+        self.decompress = decompress
+
+
+# compressors are not shared among threads, hence
+# the (cheap) instantiation for each frame
+CODECS = [Codec('zlib', FLAG_ZLIB, zlib.compress, zlib.decompress)]
+if zstandard:
+    CODECS.insert(0, Codec(
+        'zstd', FLAG_ZSTD,
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data)))
+
+
+def get_codec(name):
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    return None
 
 
 def ioparse(i, o):
@@ -43,6 +94,55 @@ def ioparse(i, o):
     return (i, o)
 
 
+def _write(out, buf):
+    """write out @buf wholly, resuming on short writes"""
+    while buf:
+        n = os.write(out, buf)
+        buf = buf[n:]
+
+
+def _read(inf, size):
+    """read exactly @size bytes from @inf"""
+    buf = b''
+    while len(buf) < size:
+        chunk = inf.read(size - len(buf))
+        if not chunk:
+            raise EOFError
+        buf += chunk
+    return buf
+
+
+class _Pushback(object):
+
+    """file-like wrapper which replays an already consumed
+    prefix before reading on from the underlying stream"""
+
+    def __init__(self, head, inf):
+        self.head = head
+        self.inf = inf
+
+    def read(self, size=-1):
+        head, self.head = self.head, b''
+        if size < 0:
+            return head + self.inf.read()
+        if len(head) > size:
+            head, self.head = head[:size], head[size:]
+        if len(head) < size:
+            head += self.inf.read(size - len(head))
+        return head
+
+    def readline(self):
+        head, self.head = self.head, b''
+        if head.endswith(b'\n'):
+            return head
+        return head + self.inf.readline()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
 def send(out, *args):
     """pickle args and write out wholly in one syscall
 
@@ -50,19 +150,160 @@ def send(out, *args):
     a stream, as that would potentially mess up messages
     by interleaving them
     """
-    os.write(out, pickle.dumps(args, pickle_proto))
+    _write(out, pickle.dumps(args, pickle_proto))
 
 
-def recv(inf):
-    """load an object from input stream
-    python2 and python3 compatibility, inf is sys.stdin
+def pack_frame(msg, flags=0, codec=None, threshold=0):
+    """pickle @msg into a length-prefixed frame
+
+    The payload is compressed with @codec if its size reaches
+    @threshold and compression actually makes it smaller.
+    """
+    payload = pickle.dumps(msg, pickle_proto)
+    if codec and len(payload) >= threshold:
+        cpayload = codec.compress(payload)
+        if len(cpayload) < len(payload):
+            flags |= codec.flag
+            payload = cpayload
+    return FRAME_HDR.pack(FRAME_MAGIC, flags, len(payload)) + payload
+
+
+def unpack_payload(flags, payload):
+    """load the message from the payload of a frame"""
+    for codec in CODECS:
+        if flags & codec.flag:
+            payload = codec.decompress(payload)
+            break
+    else:
+        if flags & (FLAG_ZLIB | FLAG_ZSTD):
+            raise GsyncdError("unsupported compression, flags %#x" % flags)
+    return pickle.loads(payload)
+
+
+def send_frame(out, msg, flags=0, codec=None, threshold=0):
+    """pickle @msg and write it out as a length-prefixed frame
+
+    Header and payload go out in one write, so a frame is
+    never interleaved with another one sent under the same lock.
+    """
+    _write(out, pack_frame(msg, flags, codec, threshold))
+
+
+def _binstream(inf):
+    """python2 and python3 compatibility, inf is sys.stdin
     and is opened as text stream by default. Hence using the
     buffer attribute in python3
     """
     if hasattr(inf, "buffer"):
-        return pickle.load(inf.buffer)
-    else:
-        return pickle.load(inf)
+        return inf.buffer
+    return inf
+
+
+def recv(inf):
+    """load an object from input stream"""
+    return pickle.load(_binstream(inf))
+
+
+def recv_frame(inf):
+    """load a message from input stream, either framed or legacy
+
+    Return a (flags, message) pair, flags being None for a legacy
+    (bare pickle) message.
+    """
+    inf = _binstream(inf)
+    head = inf.read(1)
+    if not head:
+        raise EOFError
+    if ord(head) != FRAME_MAGIC:
+        return None, pickle.load(_Pushback(head, inf))
+    _, flags, size = FRAME_HDR.unpack(head + _read(inf, FRAME_HDR.size - 1))
+    return flags, unpack_payload(flags, _read(inf, size))
+
+
+class RepceStats(object):
+
+    """call statistics of a RePCe endpoint
+
+    For each method the number of calls, failures and calls in
+    progress is counted and latencies are collected in histograms
+    with power of two microsecond buckets: round trip time on the
+    client, time spent queued and executing on the server.
+    """
+
+    NBUCKETS = 32
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.methods = {}
+
+    def _method(self, meth):
+        m = self.methods.get(meth)
+        if m is None:
+            m = self.methods[meth] = {'calls': 0, 'errors': 0,
+                                      'in_flight': 0, 'hists': {}}
+        return m
+
+    def begin(self, meth):
+        with self.lock:
+            self._method(meth)['in_flight'] += 1
+
+    def end(self, meth, error=False, **times):
+        """account a finished call, @times being durations in seconds"""
+        with self.lock:
+            m = self._method(meth)
+            m['in_flight'] -= 1
+            m['calls'] += 1
+            if error:
+                m['errors'] += 1
+            for name, secs in times.items():
+                hist = m['hists'].get(name)
+                if hist is None:
+                    hist = m['hists'][name] = [0.0] + [0] * self.NBUCKETS
+                hist[0] += secs
+                b = int(secs * 1000000).bit_length()
+                hist[1 + min(b, self.NBUCKETS - 1)] += 1
+
+    def sent(self, nbytes):
+        with self.lock:
+            self.frames_sent += 1
+            self.bytes_sent += nbytes
+
+    @staticmethod
+    def _summary(hist):
+        """describe histogram @hist with bucket upper bounds in us"""
+        count = sum(hist[1:])
+        d = {'count': count, 'sum': hist[0], 'buckets': {}}
+        seen = 0
+        for i, n in enumerate(hist[1:]):
+            if not n:
+                continue
+            bound = 1 << i
+            d['buckets'][str(bound)] = n
+            for pct in (50, 90, 99):
+                key = 'p%d_us' % pct
+                if key not in d and seen + n >= count * pct / 100.0:
+                    d[key] = bound
+            seen += n
+        return d
+
+    def snapshot(self):
+        """return the statistics as a JSON serializable dict"""
+        with self.lock:
+            methods = {}
+            for meth, m in self.methods.items():
+                methods[meth] = {
+                    'calls': m['calls'],
+                    'errors': m['errors'],
+                    'in_flight': m['in_flight']}
+                for name, hist in m['hists'].items():
+                    methods[meth][name] = self._summary(hist)
+            return {'uptime': time.time() - self.started,
+                    'frames_sent': self.frames_sent,
+                    'bytes_sent': self.bytes_sent,
+                    'methods': methods}
 
 
 class RepceServer(object):
@@ -83,6 +324,11 @@ class RepceServer(object):
         self.inf, self.out = ioparse(i, o)
         self.wnum = wnum
         self.q = Queue()
+        self.wlock = Lock()
+        # compression of replies, set up by the client
+        self.codec = None
+        self.threshold = 0
+        self.stats = RepceStats()
 
     def service_loop(self):
         """fire up worker threads, get messages and dispatch among them"""
@@ -91,10 +337,50 @@ class RepceServer(object):
             t.start()
         try:
             while True:
-                self.q.put(recv(self.inf))
+                flags, in_data = recv_frame(self.inf)
+                self.q.put((flags, in_data, time.time()))
         except EOFError:
             logging.info("terminating on reaching EOF.")
 
+    def dispatch(self, in_data, received=None):
+        """call method on .obj as told by @in_data
+
+        @received is the time the message was read at.
+        Return message id + exception flag + return value.
+        """
+        rid = in_data[0]
+        rmeth = in_data[1]
+        exc = False
+        if rmeth == '__repce_stats__':
+            res = self.stats.snapshot()
+            # statistics of the object served
+            if hasattr(self.obj, 'repce_stats'):
+                res.update(self.obj.repce_stats())
+        elif rmeth == '__repce_version__':
+            res = repce_version
+        elif rmeth == '__repce_features__':
+            res = {'compression': [codec.name for codec in CODECS],
+                   'stats': True}
+            # features of the object served
+            res.update(getattr(self.obj, 'repce_features', {}))
+        elif rmeth == '__repce_compress__':
+            self.codec = get_codec(in_data[2])
+            self.threshold = in_data[3]
+            res = self.codec is not None
+        else:
+            t0 = time.time()
+            self.stats.begin(rmeth)
+            try:
+                res = getattr(self.obj, rmeth)(*in_data[2:])
+            except:
+                res = sys.exc_info()[1]
+                exc = True
+                logging.exception("call failed: ")
+            t1 = time.time()
+            self.stats.end(rmeth, exc, wait=t0 - (received or t0),
+                           execute=t1 - t0)
+        return (rid, exc, res)
+
     def worker(self):
         """life of a worker
 
@@ -104,56 +390,128 @@ class RepceServer(object):
         If method call throws an exception, rescue it, and send
         back the exception as result (with flag marking it as
         exception).
+
+        Messages of a batch frame are dispatched in order by a
+        single worker and answered with a single batch frame.
+        The reply is sent in the format of the request.
         """
         while True:
-            in_data = self.q.get(True)
-            rid = in_data[0]
-            rmeth = in_data[1]
-            exc = False
-            if rmeth == '__repce_version__':
-                res = repce_version
+            flags, in_data, received = self.q.get(True)
+            if flags is None:
+                out_data = self.dispatch(in_data, received)
+                with self.wlock:
+                    send(self.out, *out_data)
+                continue
+            if flags & FLAG_BATCH:
+                out_data = [self.dispatch(m, received) for m in in_data]
             else:
-                try:
-                    res = getattr(self.obj, rmeth)(*in_data[2:])
-                except:
-                    res = sys.exc_info()[1]
-                    exc = True
-                    logging.exception("call failed: ")
-            send(self.out, rid, exc, res)
+                out_data = self.dispatch(in_data, received)
+            buf = pack_frame(out_data, flags & FLAG_BATCH,
+                             self.codec, self.threshold)
+            with self.wlock:
+                _write(self.out, buf)
+            self.stats.sent(len(buf))
 
 
 class RepceJob(object):
 
     """class representing message status we can use
-    for waiting on reply"""
+    for waiting on reply
 
-    def __init__(self, cbk):
+    It's a lightweight future: completion is signalled by releasing
+    a lock which is held from creation on, so no Condition is
+    allocated per call. The interface follows concurrent.futures.
+    """
+
+    __slots__ = ('rid', 'cbk', 'lever', 'reply', 'meth', 'start')
+
+    def __init__(self, rid, cbk, meth=None):
         """
-        - .rid: (process-wise) unique id
+        - .rid: (client-wise) unique id
         - .cbk: what we do upon receiving reply
+        - .meth, .start: the method called and when
         """
-        self.rid = (os.getpid(), thread.get_ident(), time.time())
+        self.rid = rid
         self.cbk = cbk
-        self.lever = Condition()
-        self.done = False
+        self.meth = meth
+        self.start = time.time()
+        self.lever = Lock()
+        self.lever.acquire()
+        self.reply = None
 
     def __repr__(self):
-        return ':'.join([str(x) for x in self.rid])
+        return str(self.rid)
 
-    def wait(self):
-        self.lever.acquire()
-        if not self.done:
-            self.lever.wait()
-        self.lever.release()
-        return self.result
+    def done(self):
+        return self.reply is not None
+
+    def wait(self, timeout=None):
+        """wait for the reply, return it as [exception flag, value]"""
+        if self.reply is None:
+            if not _acquire(self.lever, timeout):
+                raise TimeoutError
+            # pass on the token to other waiters
+            self.lever.release()
+        return self.reply
 
     def wakeup(self, data):
-        self.result = data
-        self.lever.acquire()
-        self.done = True
-        self.lever.notify()
+        self.reply = data
         self.lever.release()
 
+    def exception(self, timeout=None):
+        exc, res = self.wait(timeout)
+        if exc:
+            return res
+        return None
+
+    def result(self, timeout=None):
+        exc, res = self.wait(timeout)
+        if exc:
+            raise res
+        return res
+
+
+def _acquire(lock, timeout):
+    """acquire @lock, giving up after @timeout seconds"""
+    if timeout is None:
+        return lock.acquire()
+    try:
+        return lock.acquire(True, timeout)
+    except TypeError:
+        # python2 locks can't time out, poll them
+        deadline = time.time() + timeout
+        while not lock.acquire(False):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+
+def wait_all(rjobs, timeout=None):
+    """wait for a number of RepceJobs at once
+
+    Return a (done, not_done) pair of lists, like
+    concurrent.futures.wait with ALL_COMPLETED does.
+    """
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    done, not_done = [], []
+    for rjob in rjobs:
+        try:
+            if deadline is None:
+                rjob.wait()
+            else:
+                rjob.wait(max(deadline - time.time(), 0))
+            done.append(rjob)
+        except TimeoutError:
+            not_done.append(rjob)
+    return done, not_done
+
+
+def _ignore(rjob, res):
+    pass
+
 
 class RepceClient(object):
 
@@ -168,43 +526,107 @@ class RepceClient(object):
     def __init__(self, i, o):
         self.inf, self.out = ioparse(i, o)
         self.jtab = {}
+        self.rids = itertools.count(1)
+        self.wlock = Lock()
+        # switched on by .negotiate() if the server understands frames
+        self.framed = False
+        self.codec = None
+        self.threshold = 0
+        self.features = {}
+        self.stats = RepceStats()
         t = Thread(target=self.listen)
         t.start()
 
     def listen(self):
+        # no select() on the fd before reading: the buffered stream
+        # may already hold the next reply, read ahead with the
+        # previous one, leaving nothing on the fd to wake us up
         while True:
-            select((self.inf,), (), ())
-            rid, exc, res = recv(self.inf)
+            self.reply(*recv_frame(self.inf))
+
+    def reply(self, flags, msg):
+        """complete the RepceJobs answered by @msg"""
+        if flags is None or not flags & FLAG_BATCH:
+            msg = [msg]
+        now = time.time()
+        for rid, exc, res in msg:
             rjob = self.jtab.pop(rid)
+            self.stats.end(rjob.meth, exc, latency=now - rjob.start)
+            rjob.wakeup([exc, res])
             if rjob.cbk:
                 rjob.cbk(rjob, [exc, res])
 
-    def push(self, meth, *args, **kw):
-        """wrap arguments in a RepceJob, send them to server
-           and return the RepceJob
-
-           @cbk to pass on RepceJob can be given as kwarg.
-        """
-        cbk = kw.get('cbk')
+    def _mkjob(self, meth, args, cbk=None):
         if not cbk:
             def cbk(rj, res):
                 if res[0]:
                     raise res[1]
-        rjob = RepceJob(cbk)
+        rjob = RepceJob(next(self.rids), cbk, meth)
+        self.stats.begin(meth)
         self.jtab[rjob.rid] = rjob
         logging.debug("call %s %s%s ..." % (repr(rjob), meth, repr(args)))
-        send(self.out, rjob.rid, meth, *args)
         return rjob
 
-    def __call__(self, meth, *args):
-        """RePCe client is callabe, calling it implements a synchronous
-        remote call.
+    def push(self, meth, *args, **kw):
+        """wrap arguments in a RepceJob, send them to server
+           and return the RepceJob
 
-        We do a .push with a cbk which does a wakeup upon receiving answer,
-        then wait on the RepceJob.
+           @cbk to pass on RepceJob can be given as kwarg,
+           it's called upon receiving the reply. By default
+           a failed call raises in the listener thread; use
+           .submit if the caller takes care of the result.
         """
-        rjob = self.push(
-            meth, *args, **{'cbk': lambda rj, res: rj.wakeup(res)})
+        rjob = self._mkjob(meth, args, kw.get('cbk'))
+        if not self.framed:
+            with self.wlock:
+                send(self.out, rjob.rid, meth, *args)
+            return rjob
+        buf = pack_frame((rjob.rid, meth) + args, 0,
+                         self.codec, self.threshold)
+        with self.wlock:
+            _write(self.out, buf)
+        self.stats.sent(len(buf))
+        return rjob
+
+    def submit(self, meth, *args):
+        """send a call to the server without waiting for the reply
+
+        Return the RepceJob, on which .result() can be waited for.
+        Outstanding calls can be collected with wait_all().
+        """
+        return self.push(meth, *args, **{'cbk': _ignore})
+
+    def push_many(self, calls, **kw):
+        """pipeline a sequence of (meth, args) pairs to the server
+
+        The calls are sent in a single frame, executed by the
+        server in order and answered with a single frame.
+        Return the list of RepceJobs, in the order of @calls.
+
+        Without framing support on the server side the calls
+        are performed one after the other, to keep the ordering.
+
+        @cbk to pass on RepceJobs can be given as kwarg.
+        """
+        cbk = kw.get('cbk')
+        if not self.framed:
+            rjobs = []
+            for meth, args in calls:
+                rjob = self.push(meth, *args, **{'cbk': cbk})
+                rjob.wait()
+                rjobs.append(rjob)
+            return rjobs
+
+        rjobs = [self._mkjob(meth, args, cbk) for meth, args in calls]
+        msg = [(rjob.rid, meth) + tuple(args)
+               for rjob, (meth, args) in zip(rjobs, calls)]
+        buf = pack_frame(msg, FLAG_BATCH, self.codec, self.threshold)
+        with self.wlock:
+            _write(self.out, buf)
+        self.stats.sent(len(buf))
+        return rjobs
+
+    def _result(self, rjob, meth):
         exc, res = rjob.wait()
         if exc:
             logging.error(lf('call failed',
@@ -215,6 +637,29 @@ class RepceClient(object):
         logging.debug("call %s %s -> %s" % (repr(rjob), meth, repr(res)))
         return res
 
+    def __call__(self, meth, *args):
+        """RePCe client is callabe, calling it implements a synchronous
+        remote call.
+
+        We .submit the call and wait on the RepceJob.
+        """
+        return self._result(self.submit(meth, *args), meth)
+
+    def call_many(self, calls):
+        """synchronous counterpart of .push_many
+
+        Return the list of results; if any of the calls failed,
+        its exception is raised once all the replies are in.
+        """
+        rjobs = self.push_many(calls, **{'cbk': _ignore})
+        wait_all(rjobs)
+        return [self._result(rjob, meth)
+                for rjob, (meth, _) in zip(rjobs, calls)]
+
+    def batch(self):
+        """return a RepceBatch collecting calls for .push_many"""
+        return RepceBatch(self)
+
     class mprx(object):
 
         """method proxy, standard trick to implement rubyesque
@@ -251,3 +696,232 @@ class RepceClient(object):
         except AttributeError:
             pass
         return d
+
+    def negotiate(self, proto, compression=None, threshold=0):
+        """switch to the features offered by a server of version @proto
+
+        @compression is the name of the codec to compress frames
+        with, 'auto' picking the best one both sides support. Frames
+        smaller than @threshold bytes are sent uncompressed.
+        """
+        self.framed = proto >= 1.1
+        if compression == 'none':
+            compression = None
+        if proto < 1.2:
+            if compression:
+                logging.info(lf("RePCe features not supported by peer",
+                                proto=proto))
+            return
+        features = self.features = self('__repce_features__')
+        if compression:
+            self.negotiate_compression(features['compression'],
+                                       compression, threshold)
+
+    def negotiate_compression(self, offered, compression, threshold):
+        names = [codec.name for codec in CODECS if codec.name in offered]
+        if compression != 'auto':
+            names = [name for name in names if name == compression]
+        if not names:
+            logging.warn(lf("RePCe compression not available",
+                            compression=compression,
+                            offered=",".join(offered)))
+            return
+        self('__repce_compress__', names[0], threshold)
+        self.codec = get_codec(names[0])
+        self.threshold = threshold
+        logging.info(lf("RePCe compression enabled",
+                        compression=names[0],
+                        threshold=threshold))
+
+    def stats_snapshot(self):
+        """return the call statistics of this client and of the server
+
+        The latter are None if the server doesn't provide them.
+        """
+        server = None
+        if self.features.get('stats'):
+            server = self('__repce_stats__')
+        return {'client': self.stats.snapshot(), 'server': server}
+
+
+class RepceBatch(object):
+
+    """collector of calls to be pipelined in one frame
+
+    Used as a context manager, calls made on it through
+    the usual method syntax are recorded and sent by .push_many
+    at exit:
+
+      with rclient.batch() as b:
+          b.entry_ops(entries)
+          b.meta_ops(meta_entries)
+      entry_failures, meta_failures = b.results()
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.rjobs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None and self.calls:
+            self.rjobs = self.client.push_many(
+                self.calls, **{'cbk': _ignore})
+
+    def __getattr__(self, meth):
+        def record(*args):
+            self.calls.append((meth, args))
+        return record
+
+    def results(self):
+        """wait for the replies, return results in order of calls"""
+        if not self.rjobs:
+            return []
+        wait_all(self.rjobs)
+        return [self.client._result(rjob, meth)
+                for rjob, (meth, _) in zip(self.rjobs, self.calls)]
+
+
+def shard_of(gfid, nshards):
+    # stable across processes, unlike hash()
+    return zlib.crc32(gfid.encode()) % nshards
+
+
+def _pgfid(path):
+    # entry paths are of the form .gfid/<pgfid>/<name>
+    return path.split('/', 2)[1]
+
+
+def shard_entries(entries, nshards):
+    """split entry records for concurrent processing on @nshards channels
+
+    Return a list of waves, each a list of @nshards lists of entries.
+    Waves are to be processed one after the other, the shards of a
+    wave concurrently. Records go to the shard of their parent GFID;
+    those related to records already placed in a wave (sharing a GFID
+    or a parent, or creating the parent of the record) go to the same
+    shard. Records which would tie together different shards of a
+    wave (like a rename across directories) start a new wave, so
+    the order of dependent records is kept.
+    """
+    waves = []
+    wave = None
+    owner = {}
+    for e in entries:
+        keys = [_pgfid(e['entry']), e.get('gfid')]
+        if 'entry1' in e:
+            keys.append(_pgfid(e['entry1']))
+        shards = set(owner[k] for k in keys if k in owner)
+        if wave is None or len(shards) > 1:
+            wave = [[] for _ in range(nshards)]
+            waves.append(wave)
+            owner = {}
+            shards = set()
+        shard = shards.pop() if shards else shard_of(keys[0], nshards)
+        wave[shard].append(e)
+        for k in keys:
+            owner[k] = shard
+    return waves
+
+
+class RepceChannels(object):
+
+    """RePCe client multiplexing calls over a pool of channels
+
+    Each channel is a RepceClient connected to a separate server.
+    The control channel serves all calls but entry_ops and meta_ops,
+    which are sharded among the data channels by GFID (see
+    shard_entries) and performed concurrently. keep_alive is sent
+    on all the channels, to keep all servers alive.
+    """
+
+    SHARDED = ('entry_ops', 'meta_ops', 'keep_alive')
+
+    def __init__(self, control, channels):
+        self.control = control
+        self.channels = channels
+
+    def __getattr__(self, meth):
+        return getattr(self.control, meth)
+
+    def _fan_out(self, meth, shards, index):
+        """call @meth with the shards on the respective channels
+
+        Return the failures reported (entry_ops and meta_ops return
+        lists of (entry, ...) tuples), ordered by the @index of their
+        entry, as if the entries had been done in a single call.
+        """
+        calls = [(ch, shard, ch.submit(meth, shard))
+                 for ch, shard in zip(self.channels, shards) if shard]
+        wait_all([rjob for _, _, rjob in calls])
+        res = []
+        for ch, shard, rjob in calls:
+            # failures come back with a copy of their entry, in the
+            # order of the shard, so it's searched from the last one
+            # found; failures of an unknown entry go last
+            j = 0
+            for failure in ch._result(rjob, meth):
+                try:
+                    j = shard.index(failure[0], j)
+                except ValueError:
+                    try:
+                        j = shard.index(failure[0])
+                    except ValueError:
+                        res.append((len(index), failure))
+                        continue
+                res.append((index[id(shard[j])], failure))
+        res.sort(key=lambda r: r[0])
+        return [failure for _, failure in res]
+
+    def entry_ops(self, entries):
+        index = dict((id(e), i) for i, e in enumerate(entries))
+        failures = []
+        # waves hold consecutive entries
+        for wave in shard_entries(entries, len(self.channels)):
+            failures += self._fan_out('entry_ops', wave, index)
+        return failures
+
+    def meta_ops(self, meta_entries):
+        index = dict((id(e), i) for i, e in enumerate(meta_entries))
+        shards = [[] for _ in self.channels]
+        for e in meta_entries:
+            shards[shard_of(e['go'], len(shards))].append(e)
+        return self._fan_out('meta_ops', shards, index)
+
+    def keep_alive(self, dct):
+        rjobs = [ch.submit('keep_alive', None) for ch in self.channels]
+        res = self.control.keep_alive(dct)
+        for ch, rjob in zip(self.channels, rjobs):
+            ch._result(rjob, 'keep_alive')
+        return res
+
+    def call_many(self, calls):
+        """perform @calls one after the other, routed as usual
+
+        Like RepceClient.call_many, the exception of a failed
+        call is raised once all the calls are done. Calls which
+        all go to the control channel are pipelined there.
+        """
+        if not any(meth in self.SHARDED for meth, _ in calls):
+            return self.control.call_many(calls)
+        res = []
+        exc = None
+        for meth, args in calls:
+            try:
+                res.append(getattr(self, meth)(*args))
+            except Exception as e:
+                exc = exc or e
+                res.append(None)
+        if exc:
+            raise exc
+        return res
+
+    def stats_snapshot(self):
+        """statistics of the control channel, with those of the
+        data channels in a 'channels' list"""
+        snap = self.control.stats_snapshot()
+        snap['channels'] = [ch.stats_snapshot() for ch in self.channels]
+        return snap
@@ -0,0 +1,211 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+"""asyncio based RePCe engine
+
+It speaks the same wire protocol as the threaded engine in repce.py,
+but instead of a pool of worker threads waiting on a shared queue,
+messages are read and answered on an event loop. Only the calls to
+the backend object, which block on the filesystem, are handed over to
+a bounded executor.
+"""
+
+import io
+import os
+import time
+import asyncio
+import logging
+import pickletools
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from repce import (RepceServer, RepceClient, FRAME_MAGIC, FRAME_HDR,
+                   FLAG_BATCH, pickle_proto, pack_frame, unpack_payload)
+
+READ_CHUNK = 1 << 16
+
+
+class FrameReader(object):
+
+    """read RePCe messages from a StreamReader
+
+    Framed messages carry their length, legacy (bare pickle)
+    ones are scanned opcode by opcode as data comes in, till the
+    end of the pickle is seen. As peers switch to frames after the
+    handshake, legacy messages are expected to be small.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.buf = b''
+
+    async def read(self):
+        data = await self.reader.read(READ_CHUNK)
+        if not data:
+            raise EOFError
+        return data
+
+    async def fill(self):
+        self.buf += await self.read()
+
+    async def readexactly(self, size):
+        while len(self.buf) < size:
+            await self.fill()
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    async def recv_legacy(self):
+        bio = io.BytesIO(self.buf)
+        # end of the opcodes scanned so far, scanning resumes from
+        # there when more data is in, so that a message is scanned
+        # only once however many reads it takes
+        pos = 0
+        while True:
+            bio.seek(pos)
+            try:
+                # stops after the STOP opcode
+                for _ in pickletools.genops(bio):
+                    pos = bio.tell()
+                break
+            except ValueError:
+                data = await self.read()
+                bio.seek(0, io.SEEK_END)
+                bio.write(data)
+        buf = bio.getvalue()
+        self.buf = buf[pos:]
+        return pickle.loads(buf[:pos])
+
+    async def recv_frame(self):
+        """async counterpart of repce.recv_frame"""
+        if not self.buf:
+            await self.fill()
+        if ord(self.buf[:1]) != FRAME_MAGIC:
+            return None, await self.recv_legacy()
+        hdr = await self.readexactly(FRAME_HDR.size)
+        _, flags, size = FRAME_HDR.unpack(hdr)
+        return flags, unpack_payload(flags, await self.readexactly(size))
+
+
+async def open_streams(loop, inf, out=None):
+    """wrap file objects @inf and @out into asyncio streams"""
+    reader = asyncio.StreamReader(limit=READ_CHUNK)
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), inf)
+    if out is None:
+        return reader, None
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, out)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+class AsyncRepceServer(RepceServer):
+
+    """RePCe server serving requests on an event loop
+
+    Requests are dispatched concurrently, blocking calls of the
+    backend object running on at most .wnum executor threads.
+    Messages of a batch frame are still dispatched in order, in
+    one go. Replies are sent in the format of the request.
+    """
+
+    def service_loop(self):
+        """run the event loop till EOF on input"""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.executor = ThreadPoolExecutor(max_workers=self.wnum)
+        try:
+            loop.run_until_complete(self.serve(loop))
+        except EOFError:
+            logging.info("terminating on reaching EOF.")
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def serve(self, loop):
+        out = self.out
+        if isinstance(out, int):
+            out = os.fdopen(out, 'wb')
+        reader, self.writer = await open_streams(loop, self.inf, out)
+        # only one task may wait for the writer to drain at a time
+        self.write_lock = asyncio.Lock()
+        reader = FrameReader(reader)
+        # the loop only keeps weak references to tasks
+        tasks = set()
+        while True:
+            flags, in_data = await reader.recv_frame()
+            task = loop.create_task(
+                self.handle(loop, flags, in_data, time.time()))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    def serve_one(self, flags, in_data, received):
+        """dispatch a message, return the serialized reply"""
+        if flags is None:
+            return pickle.dumps(self.dispatch(in_data, received),
+                                pickle_proto)
+        if flags & FLAG_BATCH:
+            out_data = [self.dispatch(m, received) for m in in_data]
+        else:
+            out_data = self.dispatch(in_data, received)
+        return pack_frame(out_data, flags & FLAG_BATCH,
+                          self.codec, self.threshold)
+
+    async def handle(self, loop, flags, in_data, received):
+        if (flags is None or not flags & FLAG_BATCH) and \
+           in_data[1].startswith('__repce_'):
+            # internal calls don't block, answer them right away
+            buf = self.serve_one(flags, in_data, received)
+        else:
+            # pickling and compression happen in the executor too,
+            # to keep the loop responsive with large replies
+            buf = await loop.run_in_executor(
+                self.executor, self.serve_one, flags, in_data, received)
+        async with self.write_lock:
+            self.writer.write(buf)
+            self.stats.sent(len(buf))
+            await self.writer.drain()
+
+
+class AsyncRepceClient(RepceClient):
+
+    """RePCe client receiving replies on an event loop
+
+    Calls can be made synchronously from any thread, like with
+    RepceClient, or be awaited from coroutines by .acall.
+    """
+
+    def listen(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.alisten(loop))
+
+    async def alisten(self, loop):
+        reader, _ = await open_streams(loop, self.inf)
+        reader = FrameReader(reader)
+        while True:
+            self.reply(*(await reader.recv_frame()))
+
+    async def acall(self, meth, *args):
+        """awaitable version of a synchronous remote call"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def settle(res):
+            if not fut.cancelled():
+                fut.set_result(res)
+
+        rjob = self.push(
+            meth, *args,
+            **{'cbk': lambda rj, res: loop.call_soon_threadsafe(settle, res)})
+        await fut
+        return self._result(rjob, meth)
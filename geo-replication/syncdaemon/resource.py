@@ -18,7 +18,13 @@ import types
 import struct
 import logging
 import tempfile
+import threading
 import subprocess
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait
+except ImportError:
+    # py2 without the futures backport, ops are applied one by one
+    ThreadPoolExecutor = None
 from errno import (EEXIST, ENOENT, ENODATA, ENOTDIR, ELOOP, EACCES,
                    EISDIR, ENOTEMPTY, ESTALE, EINVAL, EBUSY, EPERM)
 import errno
@@ -40,7 +46,9 @@ from syncdutils import (GsyncdError, select, privileged, funcode,
                         gf_mount_ready, lf, Popen, sup,
                         Xattr, matching_disk_gfid, get_gfid_from_mnt,
                         unshare_propagation_supported, get_slv_dir_path,
-                        ssh_cipher_present)
+                        ssh_cipher_present, block_digest, open_regular,
+                        failed_gfid_paths, error_file, read_error_file,
+                        GfidMemo)
 from gsyncdstatus import GeorepStatus
 from py2py3 import (pipe, str_to_bytearray, entry_pack_reg,
                     entry_pack_reg_stat, entry_pack_mkdir,
@@ -74,6 +82,22 @@ class Server(object):
 
     local_path = ''
 
+    # optional calls served, announced in the RePCe handshake
+    repce_features = {'native_sync': True}
+
+    # threads performing entry_ops and meta_ops, if parallel
+    ops_pools = {}
+    ops_lock = threading.Lock()
+
+    # GFID lookups made and saved by entry_ops, overall
+    gfid_lookups = {"lookups": 0, "saved": 0}
+
+    @classmethod
+    def repce_stats(cls):
+        """statistics added to those of the RePCe server"""
+        with cls.ops_lock:
+            return {"gfid_lookups": dict(cls.gfid_lookups)}
+
     @classmethod
     def _fmt_mknod(cls, l):
         return "!II%dsI%dsIII" % (GX_GFID_CANONICAL_LEN, l + 1)
@@ -380,6 +404,9 @@ class Server(object):
         pfx = gauxpfx()
         logging.debug('entries: %s' % repr(entries))
         dist_count = rconf.args.primary_dist_count
+        # GFIDs of the entries, kept up to date with the changes
+        # made here, so that they're looked up on the mount once
+        gfids = GfidMemo()
 
         def entry_purge(op, entry, gfid, e, uid, gid):
             # This is an extremely racy code and needs to be fixed ASAP.
@@ -394,10 +421,11 @@ class Server(object):
                isinstance(lstat(os.path.join(pfx, gfid)), int):
                 return
 
-            if not matching_disk_gfid(gfid, entry):
+            if not gfids.matching(gfid, entry):
                 collect_failure(e, EEXIST, uid, gid)
                 return
 
+            gfids.forget(entry)
             if op == 'UNLINK':
                 er = errno_wrap(os.unlink, [entry], [ENOENT, ESTALE], [EBUSY])
                 # EISDIR is safe error, ignore. This can only happen when
@@ -434,7 +462,7 @@ class Server(object):
                     en = e['entry1']
                 else:
                     en = e['entry']
-                disk_gfid = get_gfid_from_mnt(en)
+                disk_gfid = gfids.get(en)
                 if isinstance(disk_gfid, str) and \
                    e['gfid'] != disk_gfid:
                     slv_entry_info['gfid_mismatch'] = True
@@ -458,17 +486,24 @@ class Server(object):
 
         failures = []
 
-        def recursive_rmdir(gfid, entry, path):
+        def recursive_rmdir(gfid, entry, path, dir_gfid=None):
             """disk_gfid check added for original path for which
             recursive_delete is called. This disk gfid check executed
             before every Unlink/Rmdir. If disk gfid is not matching
             with GFID from Changelog, that means other worker
             deleted the directory. Even if the subdir/file present,
             it belongs to different parent. Exit without performing
-            further deletes.
+            further deletes. (Hence those checks are not memoized,
+            but for the first one.)
+
+            @dir_gfid is the GFID of @path (by default, that of
+            @entry), the names removed under it are forgotten
+            by the GFID memo.
             """
-            if not matching_disk_gfid(gfid, entry):
+            if not gfids.matching(gfid, entry):
                 return
+            if dir_gfid is None:
+                dir_gfid = gfid
 
             names = []
             names = errno_wrap(os.listdir, [path], [ENOENT], [ESTALE, ENOTSUP])
@@ -483,30 +518,41 @@ class Server(object):
                                                         EISDIR], [EBUSY])
 
                 if er == EISDIR:
-                    recursive_rmdir(gfid, entry, fullname)
+                    sub_gfid = get_gfid_from_mnt(fullname)
+                    if isinstance(sub_gfid, int):
+                        # no telling the names looked up under it
+                        gfids.clear()
+                    recursive_rmdir(gfid, entry, fullname, sub_gfid)
+
+                # the name might have been looked up through the
+                # GFID of the directory
+                if not isinstance(dir_gfid, int):
+                    gfids.forget(os.path.join(pfx, dir_gfid, name))
 
             if not matching_disk_gfid(gfid, entry):
                 return
 
+            gfids.forget(path)
             errno_wrap(os.rmdir, [path], [ENOENT, ESTALE], [EBUSY])
 
-        def rename_with_disk_gfid_confirmation(gfid, entry, en, uid, gid):
-            if not matching_disk_gfid(gfid, entry):
+        def rename_with_disk_gfid_confirmation(e, gfid, entry, en, uid, gid):
+            if not gfids.matching(gfid, entry):
                 logging.error(lf("RENAME ignored: source entry does not match "
                                  "with on-disk gfid",
                                  source=entry,
                                  gfid=gfid,
-                                 disk_gfid=get_gfid_from_mnt(entry),
+                                 disk_gfid=gfids.get(entry),
                                  target=en))
                 collect_failure(e, EEXIST, uid, gid)
                 return
 
+            gfids.forget(entry, en)
             cmd_ret = errno_wrap(os.rename,
                                  [entry, en],
                                  [ENOENT, EEXIST], [ESTALE, EBUSY])
             collect_failure(e, cmd_ret, uid, gid)
 
-        for e in entries:
+        def apply_entry(e):
             blob = None
             op = e['op']
             gfid = e['gfid']
@@ -517,7 +563,7 @@ class Server(object):
             # Skip entry processing if it's marked true during gfid
             # conflict resolution
             if e['skip_entry']:
-                continue
+                return
 
             if e.get("stat", {}):
                 # Copy UID/GID value and then reset to zero. Copied UID/GID
@@ -565,6 +611,7 @@ class Server(object):
                 # So if the gfid already exists, it should be
                 # processed as hard link not mknod.
                 elif op in ['MKNOD']:
+                    gfids.forget(entry)
                     cmd_ret = errno_wrap(os.link,
                                          [slink, entry],
                                          [ENOENT, EEXIST], [ESTALE])
@@ -578,7 +625,7 @@ class Server(object):
                     blob = entry_pack_mkdir(cls, gfid, bname,
                                             e['mode'], e['uid'], e['gid'])
                 elif (isinstance(lstat(en), int) or
-                      not matching_disk_gfid(gfid, en)):
+                      not gfids.matching(gfid, en)):
                     # If gfid of a directory exists on secondary but path based
                     # create is getting EEXIST. This means the directory is
                     # renamed in primary but recorded as MKDIR during hybrid
@@ -611,6 +658,7 @@ class Server(object):
                         blob = entry_pack_symlink(cls, gfid, bname, e['link'],
                                                   e['stat'])
                 else:
+                    gfids.forget(entry)
                     cmd_ret = errno_wrap(os.link,
                                          [slink, entry],
                                          [ENOENT, EEXIST], [ESTALE])
@@ -621,7 +669,7 @@ class Server(object):
                 if isinstance(st, int):
                     blob = entry_pack_symlink(cls, gfid, bname, e['link'],
                                               e['stat'])
-                elif not matching_disk_gfid(gfid, en):
+                elif not gfids.matching(gfid, en):
                     collect_failure(e, EEXIST, uid, gid)
             elif op == 'RENAME':
                 en = e['entry1']
@@ -632,7 +680,7 @@ class Server(object):
                 # exist. We can't rely on only gfid stat as hardlink could
                 # be present and we can't rely only on name as name could
                 # exist with different gfid.
-                if not matching_disk_gfid(gfid, entry):
+                if not gfids.matching(gfid, entry):
                     if e['stat'] and not stat.S_ISDIR(e['stat']['mode']):
                         if stat.S_ISLNK(e['stat']['mode']):
                             # src is not present, so don't sync symlink as
@@ -646,7 +694,7 @@ class Server(object):
                                     blob = entry_pack_symlink(cls, gfid, bname,
                                                               e['link'],
                                                               e['stat'])
-                                elif not matching_disk_gfid(gfid, en):
+                                elif not gfids.matching(gfid, en):
                                     collect_failure(e, EEXIST, uid, gid, True)
                         else:
                             slink = os.path.join(pfx, gfid)
@@ -657,6 +705,7 @@ class Server(object):
                                 blob = entry_pack_reg_stat(cls, gfid, bname,
                                                            e['stat'])
                             else:
+                                gfids.forget(en)
                                 cmd_ret = errno_wrap(os.link, [slink, en],
                                                     [ENOENT, EEXIST], [ESTALE])
                                 collect_failure(e, cmd_ret, uid, gid)
@@ -664,11 +713,12 @@ class Server(object):
                     st = lstat(entry)
                     st1 = lstat(en)
                     if isinstance(st1, int):
-                        rename_with_disk_gfid_confirmation(gfid, entry, en,
+                        rename_with_disk_gfid_confirmation(e, gfid, entry, en,
                                                            uid, gid)
                     else:
                         if st.st_ino == st1.st_ino:
                             # we have a hard link, we can now unlink source
+                            gfids.forget(entry)
                             try:
                                 errno_wrap(os.unlink, [entry],
                                            [ENOENT, ESTALE], [EBUSY])
@@ -689,7 +739,7 @@ class Server(object):
                                             raise
                                 else:
                                     raise
-                        elif not matching_disk_gfid(gfid, en) and dist_count > 1:
+                        elif not gfids.matching(gfid, en) and dist_count > 1:
                             collect_failure(e, EEXIST, uid, gid, True)
                         else:
                             # We are here which means matching_disk_gfid for
@@ -698,9 +748,10 @@ class Server(object):
                             # then one. Which basically says both the source and
                             # destination exist and not hardlinks.
                             # So we are safe to go ahead with rename here.
-                            rename_with_disk_gfid_confirmation(gfid, entry, en,
-                                                               uid, gid)
+                            rename_with_disk_gfid_confirmation(e, gfid, entry,
+                                                               en, uid, gid)
             if blob:
+                gfids.forget(os.path.join(pg, bname))
                 cmd_ret = errno_wrap(Xattr.lsetxattr,
                                      [pg, 'glusterfs.gfid.newfile', blob],
                                      [EEXIST, ENOENT, ESTALE],
@@ -716,13 +767,53 @@ class Server(object):
                                          [ESTALE, EINVAL])
                     collect_failure(e, cmd_ret, uid, gid)
 
+        def apply_entries(shard):
+            for e in shard:
+                apply_entry(e)
+
+        nthreads = gconf.get("secondary-entry-ops-threads")
+        if nthreads > 1 and len(entries) > 1 and \
+           ThreadPoolExecutor is not None:
+            # Entries with no parent directory or GFID in common are
+            # applied concurrently; see repce.shard_entries. Failures
+            # are reported in the order of the entries, as if applied
+            # one by one.
+            pool = cls.ops_executor('entry', nthreads)
+            for wave in repce.shard_entries(entries, nthreads):
+                fs = [pool.submit(apply_entries, shard)
+                      for shard in wave if shard]
+                wait(fs)
+                for f in fs:
+                    f.result()
+            order = dict((id(e), i) for i, e in enumerate(entries))
+            failures.sort(key=lambda f: order[id(f[0])])
+        else:
+            apply_entries(entries)
+
+        with cls.ops_lock:
+            cls.gfid_lookups["lookups"] += gfids.lookups
+            cls.gfid_lookups["saved"] += gfids.saved
+        logging.debug(lf("Entry ops GFID lookups",
+                         lookups=gfids.lookups,
+                         saved=gfids.saved,
+                         total_lookups=cls.gfid_lookups["lookups"],
+                         total_saved=cls.gfid_lookups["saved"]))
         return failures
 
+    @classmethod
+    def ops_executor(cls, kind, nthreads):
+        """the pool of @nthreads threads performing @kind ops"""
+        with cls.ops_lock:
+            if kind not in cls.ops_pools:
+                cls.ops_pools[kind] = ThreadPoolExecutor(max_workers=nthreads)
+            return cls.ops_pools[kind]
+
     @classmethod
     def meta_ops(cls, meta_entries):
         logging.debug('Meta-entries: %s' % repr(meta_entries))
         failures = []
-        for e in meta_entries:
+
+        def apply_meta(e):
             mode = e['stat']['mode']
             uid = e['stat']['uid']
             gid = e['stat']['gid']
@@ -744,24 +835,55 @@ class Server(object):
             # and 'utime with de-reference'. Hence avoiding 'chmod'
             # and 'utime' if it's symlink file.
 
-            is_symlink = False
-            cmd_ret = errno_wrap(os.lchown, [go, uid, gid], [ENOENT],
-                                 [ESTALE, EINVAL])
-            if isinstance(cmd_ret, int):
-                continue
+            # Only what differs from the current attributes is set.
+            st = lstat(go)
+            if isinstance(st, int):
+                return
 
-            is_symlink = os.path.islink(go)
+            chowned = False
+            if st.st_uid != uid or st.st_gid != gid:
+                cmd_ret = errno_wrap(os.lchown, [go, uid, gid], [ENOENT],
+                                     [ESTALE, EINVAL])
+                if isinstance(cmd_ret, int):
+                    return
+                chowned = True
 
-            if not is_symlink:
+            if stat.S_ISLNK(st.st_mode):
+                return
+
+            # chown may have cleared the setuid and setgid bits
+            if chowned or stat.S_IMODE(st.st_mode) != stat.S_IMODE(mode):
                 cmd_ret = errno_wrap(os.chmod, [go, mode],
                                      [ENOENT, EACCES, EPERM], [ESTALE, EINVAL])
                 if isinstance(cmd_ret, int):
                     failures.append((e, cmd_ret, "chmod"))
 
+            if st.st_atime != atime or st.st_mtime != mtime:
                 cmd_ret = errno_wrap(os.utime, [go, (atime, mtime)],
                                      [ENOENT, EACCES, EPERM], [ESTALE, EINVAL])
                 if isinstance(cmd_ret, int):
                     failures.append((e, cmd_ret, "utime"))
+
+        def apply_metas(shard):
+            for e in shard:
+                apply_meta(e)
+
+        nthreads = gconf.get("secondary-meta-ops-threads")
+        if nthreads > 1 and len(meta_entries) > 1 and \
+           ThreadPoolExecutor is not None:
+            # entries of a GFID stay in order, on the same thread
+            shards = [[] for _ in range(nthreads)]
+            for e in meta_entries:
+                shards[repce.shard_of(e['go'], nthreads)].append(e)
+            pool = cls.ops_executor('meta', nthreads)
+            fs = [pool.submit(apply_metas, shard) for shard in shards if shard]
+            wait(fs)
+            for f in fs:
+                f.result()
+            order = dict((id(e), i) for i, e in enumerate(meta_entries))
+            failures.sort(key=lambda f: order[id(f[0])])
+        else:
+            apply_metas(meta_entries)
         return failures
 
     @classmethod
@@ -783,6 +905,67 @@ class Server(object):
         if times:
             os.utime(path, times)
 
+    @classmethod
+    @_pathguard
+    def data_sums(cls, path, block_size):
+        """size of file @path and digests of its @block_size sized blocks
+
+        Used by the native sync method to skip unchanged blocks.
+        Return ENOENT if @path does not exist. Raise EINVAL if it's
+        not a regular file.
+        """
+        try:
+            fd = open_regular(path, os.O_RDONLY)
+        except OSError as ex:
+            if ex.errno == ENOENT:
+                return ex.errno
+            raise
+        try:
+            size = os.fstat(fd).st_size
+            sums = []
+            for offset in range(0, size, block_size):
+                data = os.pread(fd, block_size, offset)
+                if not data:
+                    break
+                sums.append(block_digest(data))
+        finally:
+            os.close(fd)
+        return size, sums
+
+    @classmethod
+    @_pathguard
+    def data_write(cls, path, blocks, size=None, adct=None):
+        """write @blocks, a list of (offset, data), to the file @path
+
+        The file is not created, as with rsync --existing. With @size
+        given, the file is truncated to it and the attributes in @adct
+        are set like .setattr does, completing its sync.
+        Return ENOENT if @path does not exist, 0 otherwise. Files
+        other than regular ones, symlinks above all, are refused
+        with EINVAL.
+        """
+        try:
+            fd = open_regular(path, os.O_WRONLY)
+        except OSError as ex:
+            if ex.errno == ENOENT:
+                return ex.errno
+            raise
+        try:
+            for offset, data in blocks:
+                data = memoryview(data)
+                while data:
+                    n = os.pwrite(fd, data, offset)
+                    data = data[n:]
+                    offset += n
+            if size is not None:
+                os.ftruncate(fd, size)
+                os.fchown(fd, *adct['own'])
+                os.fchmod(fd, stat.S_IMODE(adct['mode']))
+                os.utime(fd, adct['times'])
+        finally:
+            os.close(fd)
+        return 0
+
     @staticmethod
     def pid():
         return os.getpid()
@@ -1159,7 +1342,11 @@ class GLUSTER(object):
                 raise GsyncdError(
                     "using rsync for extended attributes is not supported")
 
-            repce = RepceServer(
+            server_class = RepceServer
+            if gconf.get("secondary-repce-engine") == "asyncio":
+                from repceasync import AsyncRepceServer
+                server_class = AsyncRepceServer
+            repce = server_class(
                 self.server, sys.stdin, sys.stdout, gconf.get("sync-jobs"))
             t = syncdutils.Thread(target=lambda: (repce.service_loop(),
                                                   syncdutils.finalize()))
@@ -1262,9 +1449,22 @@ class GLUSTER(object):
                               rconf.args.local_path,
                               rconf.args.local_node_id,
                               rconf.args.primary,
-                              rconf.args.secondary)
+                              rconf.args.secondary,
+                              flush_interval=gconf.get(
+                                  "status-flush-interval") / 1000.0)
         status.reset_on_worker_start()
 
+        stats_interval = gconf.get("repce-stats-interval")
+        if stats_interval > 0:
+            def export_repce_stats():
+                while True:
+                    time.sleep(stats_interval)
+                    data = secondary.server.stats_snapshot()
+                    data['time'] = time.time()
+                    status.set_repce_stats(data)
+            t = syncdutils.Thread(target=export_repce_stats)
+            t.start()
+
         try:
             workdir = g2.setup_working_dir()
             # Register only when change_detector is not set to
@@ -1328,6 +1528,9 @@ class SSH(object):
     implementing an ssh based proxy
     """
 
+    # held while starting the ssh control master of tar
+    tar_ssh_lock = threading.Lock()
+
     def __init__(self, host, volume):
         self.remote_addr = host
         self.volume = volume
@@ -1348,8 +1551,19 @@ class SSH(object):
         It's cut out as a separate method to let
         subclasses hook into client startup
         """
-        self.server = RepceClient(i, o)
-        rv = self.server.__version__()
+        self.server = self.make_fd_client(i, o)
+        secondarypath = "/proc/%d/cwd" % self.server.pid()
+        self.secondaryurl = ':'.join([self.remote_addr, secondarypath])
+
+    def make_fd_client(self, i, o):
+        """return a RePCe client on @i and @o, after handshake
+        and negotiation of protocol features with the server"""
+        client_class = RepceClient
+        if gconf.get("repce-engine") == "asyncio":
+            from repceasync import AsyncRepceClient
+            client_class = AsyncRepceClient
+        client = client_class(i, o)
+        rv = client.__version__()
         exrv = {'proto': repce.repce_version, 'object': Server.version()}
         da0 = (rv, exrv)
         da1 = ({}, {})
@@ -1360,8 +1574,29 @@ class SSH(object):
             raise GsyncdError(
                 "RePCe major version mismatch: local %s, remote %s" %
                 (exrv, rv))
-        secondarypath = "/proc/%d/cwd" % self.server.pid()
-        self.secondaryurl = ':'.join([self.remote_addr, secondarypath])
+        client.negotiate(rv['proto'],
+                         gconf.get("repce-compression"),
+                         gconf.get("repce-compression-threshold"))
+        return client
+
+    def start_channels(self, ssh_argv, secondary_argv, count):
+        """open @count data channels besides the control one
+
+        They bypass the ssh control master, so that each of them
+        has its own connection to the Secondary, encrypted by its
+        own ssh process. Like with the control channel, error output
+        of the ssh processes is harvested by the error handler, and
+        they are terminated on exit.
+        """
+        channels = []
+        for _ in range(count):
+            po = Popen(ssh_argv + ["-oControlPath=none"] + secondary_argv,
+                       stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE)
+            rconf.channel_transports.append(po)
+            channels.append(self.make_fd_client(po.stdout, po.stdin))
+        self.server = repce.RepceChannels(self.server, channels)
+        logging.info(lf("RePCe data channels established", count=count))
 
     def connect_remote(self):
         """connect to inner secondary url through outer ssh url
@@ -1396,10 +1631,10 @@ class SSH(object):
         if gconf.get("use-rsync-xattrs"):
             extra_opts.append('--use-rsync-xattrs')
 
-        args_to_secondary = [gconf.get("ssh-command")] + \
+        ssh_argv = [gconf.get("ssh-command")] + \
             gconf.get("ssh-options").split() + \
-            ["-p", str(gconf.get("ssh-port"))] + \
-            rconf.ssh_ctl_args + [self.remote_addr] + \
+            ["-p", str(gconf.get("ssh-port"))]
+        args_to_secondary = [self.remote_addr] + \
             [remote_gsyncd, "secondary"] + \
             extra_opts + \
             [rconf.args.primary, rconf.args.secondary] + \
@@ -1425,14 +1660,27 @@ class SSH(object):
         if gconf.get("secondary-access-mount"):
             args_to_secondary.append('--secondary-access-mount')
 
+        # only sent if not the default, so that older
+        # Secondary gsyncd, not knowing the option, still works
+        if gconf.get("secondary-repce-engine") != "threaded":
+            args_to_secondary += ['--secondary-repce-engine',
+                                  gconf.get("secondary-repce-engine")]
+        for opt in ("secondary-entry-ops-threads",
+                    "secondary-meta-ops-threads"):
+            if gconf.get(opt) > 1:
+                args_to_secondary += ['--' + opt, str(gconf.get(opt))]
+
         if rconf.args.debug:
             args_to_secondary.append('--debug')
 
-        po = Popen(args_to_secondary,
+        po = Popen(ssh_argv + rconf.ssh_ctl_args + args_to_secondary,
                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                    stderr=subprocess.PIPE)
         rconf.transport = po
         self.start_fd_client(po.stdout, po.stdin)
+        if gconf.get("repce-channels") > 1:
+            self.start_channels(ssh_argv, args_to_secondary,
+                                gconf.get("repce-channels") - 1)
         logging.info(lf("SSH connection between primary and secondary established.",
                         duration="%.4f" % (time.time() - t0)))
 
@@ -1492,21 +1740,24 @@ class SSH(object):
                 rsync_verbose = True
                 break
 
+        errf = error_file()
         if log_rsync_performance or rsync_verbose:
             # use stdout=PIPE only when log_rsync_performance enabled
             # Else rsync will write to stdout and nobody is there
             # to consume. If PIPE is full rsync hangs.
             po = Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                       stderr=subprocess.PIPE, universal_newlines=True)
+                       stderr=errf, universal_newlines=True)
         else:
-            po = Popen(argv, stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+            po = Popen(argv, stdin=subprocess.PIPE, stderr=errf,
                        universal_newlines=True)
 
         for f in files:
             po.stdin.write(f)
             po.stdin.write('\0')
 
-        stdout, stderr = po.communicate()
+        stdout, _ = po.communicate()
+        stderr = read_error_file(errf)
+        po.failed_files = failed_gfid_paths(stderr)
 
         if kw.get("log_err", False):
             for errline in stderr.strip().split("\n")[:-1]:
@@ -1535,6 +1786,47 @@ class SSH(object):
 
         return po
 
+    def tar_ssh_ctl_args(self, ssh_cmd, host):
+        """ssh options to share a connection among tar transfers
+
+        Unlike rsync, which is tunneled through the control master
+        of the RePCe connection, tar authenticates with its own key,
+        so it gets a control master of its own. It's started apart
+        from the transfers, with its output going to /dev/null, when
+        none is running, and exits tar-ssh-control-persist seconds
+        after the last transfer (or is stopped on exit by finalize),
+        so a steady flow of small batches doesn't pay for ssh
+        connection setup each time. Transfers never become the
+        master themselves, they connect directly if there's none.
+        The exit status of the remote tar is still reported per
+        transfer.
+        """
+        persist = gconf.get("tar-ssh-control-persist")
+        if not persist or not rconf.ssh_ctl_dir:
+            return []
+        sock = os.path.join(rconf.ssh_ctl_dir, "tar.sock")
+        with self.tar_ssh_lock:
+            if not os.path.exists(sock):
+                self.start_tar_ssh_master(ssh_cmd, host, sock, persist)
+        return ["-oControlMaster=no", "-S", sock]
+
+    def start_tar_ssh_master(self, ssh_cmd, host, sock, persist):
+        with open(os.devnull, 'r+') as devnull:
+            # -f: goes to the background once connected
+            po = Popen(ssh_cmd + ["-oControlMaster=yes",
+                                  "-oControlPersist=%d" % persist,
+                                  "-S", sock, "-N", "-f", host],
+                       stdin=devnull, stdout=devnull, stderr=devnull)
+            po.wait()
+        if po.returncode != 0:
+            logging.warn(lf("Failed to start the ssh control master "
+                            "for tar, connecting for each transfer",
+                            error=po.returncode))
+            return
+        exit_args = ssh_cmd + ["-S", sock, "-O", "exit", host]
+        if exit_args not in rconf.ssh_ctl_exit_args:
+            rconf.ssh_ctl_exit_args.append(exit_args)
+
     def tarssh(self, files, log_err=False):
         """invoke tar+ssh
         -z (compress) can be use if needed, but omitting it now
@@ -1547,15 +1839,19 @@ class SSH(object):
 
         tar_cmd = ["tar"] + \
             ["--sparse", "-cf", "-", "--files-from", "-"]
-        ssh_cmd = gconf.get("ssh-command").split() + \
+        ssh_base = gconf.get("ssh-command").split() + \
             gconf.get("ssh-options-tar").split() + \
-            ["-p", str(gconf.get("ssh-port"))] + \
+            ["-p", str(gconf.get("ssh-port"))]
+        ssh_cmd = ssh_base + \
+            self.tar_ssh_ctl_args(ssh_base, host) + \
             [host, "tar"] + \
             ["--overwrite", "-xf", "-", "-C", rdir]
+        errf0 = error_file()
+        errf1 = error_file()
         p0 = Popen(tar_cmd, stdout=subprocess.PIPE,
-                   stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                   stdin=subprocess.PIPE, stderr=errf0,
                    universal_newlines=True)
-        p1 = Popen(ssh_cmd, stdin=p0.stdout, stderr=subprocess.PIPE,
+        p1 = Popen(ssh_cmd, stdin=p0.stdout, stderr=errf1,
                    universal_newlines=True)
         for f in files:
             p0.stdin.write(f)
@@ -1570,7 +1866,9 @@ class SSH(object):
         p0.stdout = None
 
         def wait_for_tar(p0):
-            _, stderr = p0.communicate()
+            p0.communicate()
+            stderr = read_error_file(errf0)
+            p0.failed_files = failed_gfid_paths(stderr)
             if log_err:
                 for errline in stderr.strip().split("\n")[:-1]:
                     if "No such file or directory" not in errline:
@@ -1584,8 +1882,14 @@ class SSH(object):
         t.start()
 
         # wait for ssh process
-        _, stderr1 = p1.communicate()
+        p1.communicate()
         t.join()
+        stderr1 = read_error_file(errf1)
+        failed1 = failed_gfid_paths(stderr1)
+        if p0.failed_files is None or failed1 is None:
+            p1.failed_files = None
+        else:
+            p1.failed_files = p0.failed_files | failed1
 
         if log_err:
             for errline in stderr1.strip().split("\n")[:-1]:
@@ -1594,3 +1898,178 @@ class SSH(object):
                                  error=errline))
 
         return p1
+
+    def native_sync(self, files, log_err=False):
+        """sync the data of @files over RePCe
+
+        Files are read through the aux-gfid mount and their content
+        sent to Server.data_write. Files of at least sync-native-delta-min
+        bytes are first checksummed on the Secondary by blocks of
+        sync-native-block-size bytes, and only the differing blocks
+        are sent. Like with rsync --existing --ignore-missing-args,
+        files missing on either side are skipped, and so are files
+        which are not regular ones on the Primary. Files which can't
+        be read, or whose checksums or writes fail on the Secondary,
+        are reported as failed, like rsync does with a partial
+        transfer.
+        """
+        if not files:
+            raise GsyncdError("no files to sync")
+        logging.debug("files: " + ", ".join(files))
+
+        block_size = gconf.get("sync-native-block-size")
+        delta_min = gconf.get("sync-native-delta-min")
+        sender = NativeSender(self.server)
+        srcs = []
+        for f in files:
+            try:
+                st = os.lstat(f)
+            except OSError as ex:
+                if ex.errno not in (ENOENT, ESTALE):
+                    sender.errors.append((f, str(ex)))
+                continue
+            if stat.S_ISREG(st.st_mode):
+                srcs.append((f, st))
+
+        large = [f for f, st in srcs if st.st_size >= delta_min]
+        sums = {}
+        if large:
+            rjobs = self.server.push_many(
+                [('data_sums', (f, block_size)) for f in large],
+                **{'cbk': repce._ignore})
+            for f, rjob in zip(large, rjobs):
+                try:
+                    sums[f] = self.server._result(rjob, 'data_sums')
+                except (IOError, OSError) as ex:
+                    sender.errors.append((f, str(ex)))
+                    sums[f] = None
+
+        for f, st in srcs:
+            remote = sums.get(f, 0)
+            if remote == ENOENT or remote is None:
+                continue
+            # files are opened one at a time, as they're sent
+            try:
+                fd = open_regular(f, os.O_RDONLY)
+            except OSError as ex:
+                # gone, or not a regular file any more
+                if ex.errno not in (ENOENT, ESTALE, ELOOP, EINVAL):
+                    sender.errors.append((f, str(ex)))
+                continue
+            try:
+                self.native_send(sender, f, fd, st,
+                                 remote and remote[1] or [], block_size)
+            except OSError as ex:
+                if ex.errno not in (ENOENT, ESTALE):
+                    sender.errors.append((f, str(ex)))
+            finally:
+                os.close(fd)
+        sender.drain()
+
+        if log_err:
+            for f, err in sender.errors:
+                logging.error(lf("SYNC Error",
+                                 sync_engine="Native",
+                                 file=f,
+                                 error=err))
+        return NativeSyncResult(sender.errors and 23 or 0, sender.errors)
+
+    def native_send(self, sender, f, fd, st, remote_sums, block_size):
+        """send the blocks of @f (open as @fd) differing from
+        @remote_sums, then its size and attributes"""
+        blocks = []
+        nbytes = 0
+        partial = False
+        for i, offset in enumerate(range(0, st.st_size, block_size)):
+            data = os.pread(fd, block_size, offset)
+            if not data:
+                break
+            if i < len(remote_sums) and \
+               remote_sums[i] == block_digest(data):
+                continue
+            blocks.append((offset, data))
+            nbytes += len(data)
+            if nbytes >= NativeSender.FRAME_SIZE:
+                sender.write(f, blocks)
+                blocks = []
+                nbytes = 0
+                partial = True
+        if partial:
+            # the partial writes are to land before truncation
+            sender.drain()
+        sender.write(f, blocks, st.st_size,
+                     {'own': (st.st_uid, st.st_gid),
+                      'mode': st.st_mode,
+                      'times': (st.st_atime, st.st_mtime)})
+
+    def native_sync_supported(self):
+        """if the Secondary serves data_sums and data_write"""
+        return bool(self.server.features.get('native_sync'))
+
+
+class NativeSender(object):
+
+    """pipeline of Server.data_write calls
+
+    Calls are sent in frames of about FRAME_SIZE bytes of data, each
+    of them executed in order by the Secondary. Up to MAX_INFLIGHT
+    frames are outstanding, in which case the oldest is waited for.
+    """
+
+    FRAME_SIZE = 4 << 20
+    MAX_INFLIGHT = 4
+
+    def __init__(self, server):
+        self.server = server
+        self.calls = []
+        self.nbytes = 0
+        self.inflight = []
+        self.errors = []
+
+    def write(self, path, blocks, size=None, adct=None):
+        self.calls.append(('data_write', (path, blocks, size, adct)))
+        self.nbytes += sum(len(data) for _, data in blocks)
+        if self.nbytes >= self.FRAME_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.calls:
+            return
+        self.inflight.append((self.calls, self.server.push_many(
+            self.calls, **{'cbk': repce._ignore})))
+        self.calls = []
+        self.nbytes = 0
+        if len(self.inflight) > self.MAX_INFLIGHT:
+            self.collect(*self.inflight.pop(0))
+
+    def collect(self, calls, rjobs):
+        for (meth, args), rjob in zip(calls, rjobs):
+            try:
+                self.server._result(rjob, meth)
+            except (IOError, OSError) as ex:
+                self.errors.append((args[0], str(ex)))
+
+    def drain(self):
+        """send what's pending and wait for all the replies"""
+        self.flush()
+        while self.inflight:
+            self.collect(*self.inflight.pop(0))
+
+
+class NativeSyncResult(object):
+
+    """outcome of a native sync, standing in for the Popen object
+    returned by the other sync methods"""
+
+    def __init__(self, returncode, errors):
+        self.returncode = returncode
+        self.errors = errors
+        self.failed_files = set(f for f, _ in errors)
+
+    def errfail(self):
+        for f, err in self.errors:
+            logging.error(lf("SYNC Error",
+                             sync_engine="Native",
+                             file=f,
+                             error=err))
+        syncdutils.finalize(exval=1)
@@ -47,6 +47,52 @@ def subcmd_status(args):
                               json_output=args.json)
 
 
+def stats_status(args):
+    """GeorepStatus to read the statistics of args.local_path, or of
+    the whole session without it, creating no status file"""
+    from gsyncdstatus import GeorepStatus
+
+    primary_name = args.primary.replace(":", "")
+    secondary_data = args.secondary.replace("ssh://", "")
+
+    return GeorepStatus(gconf.get("state-file"),
+                        "",
+                        args.local_path or "",
+                        "",
+                        primary_name,
+                        secondary_data,
+                        gconf.get("pid-file"),
+                        create=False)
+
+
+def subcmd_repce_stats(args):
+    import json
+
+    brick_status = stats_status(args)
+    if args.local_path:
+        print(json.dumps(brick_status.get_repce_stats()))
+    else:
+        print(json.dumps(brick_status.get_session_repce_stats()))
+
+
+def subcmd_batch_stats(args):
+    import json
+    from gsyncdstatus import summarize_batches
+
+    brick_status = stats_status(args)
+    if args.local_path:
+        records = brick_status.get_batch_records()
+    else:
+        records = brick_status.get_session_batch_records()
+    if args.since:
+        records = [r for r in records if r["start_time"] >= args.since]
+    if args.raw:
+        for r in records:
+            print(json.dumps(r))
+        return
+    print(json.dumps(summarize_batches(records)))
+
+
 def subcmd_monitor(args):
     import monitor
     from resource import GLUSTER, SSH, Popen
@@ -9,11 +9,14 @@
 #
 
 import os
+import re
 import sys
 import pwd
 import time
 import fcntl
 import shutil
+import stat
+import tempfile
 import logging
 import errno
 import threading
@@ -22,7 +25,8 @@ import socket
 from subprocess import PIPE
 from threading import Lock, Thread as baseThread
 from errno import (EACCES, EAGAIN, EPIPE, ENOTCONN, ENOMEM, ECONNABORTED,
-                   EINTR, ENOENT, ESTALE, EBUSY, ENODATA, errorcode, EIO)
+                   EINTR, ENOENT, ESTALE, EBUSY, ENODATA, errorcode, EIO,
+                   EINVAL)
 from signal import signal, SIGTERM
 import select as oselect
 from os import waitpid as owaitpid
@@ -263,6 +267,9 @@ def finalize(*args, **kwargs):
                     pass
                 else:
                     raise
+    if not rconf.cpid:
+        terminate_channels()
+        stop_ssh_ctl_masters()
     if rconf.ssh_ctl_dir and not rconf.cpid:
         def handle_rm_error(func, path, exc_info):
             if exc_info[1].errno == ENOENT:
@@ -295,6 +302,28 @@ def finalize(*args, **kwargs):
     os._exit(kwargs.get('exval', 0))
 
 
+def terminate_channels(log_errors=False):
+    """terminate the ssh processes of the RePCe data channels,
+    logging the error output of those which failed if @log_errors"""
+    while rconf.channel_transports:
+        po = rconf.channel_transports.pop()
+        po.terminate_geterr(fail_on_err=False)
+        if log_errors and po.returncode > 0:
+            po.errlog()
+
+
+def stop_ssh_ctl_masters():
+    """stop the ssh control masters which outlive their clients"""
+    while rconf.ssh_ctl_exit_args:
+        argv = rconf.ssh_ctl_exit_args.pop()
+        try:
+            with open(os.devnull, 'r+') as devnull:
+                subprocess.call(argv, stdin=devnull, stdout=devnull,
+                                stderr=devnull)
+        except OSError:
+            pass
+
+
 def log_raise_exception(excont):
     """top-level exception handler
 
@@ -339,6 +368,7 @@ def log_raise_exception(excont):
                                   "<SECONDARYVOL> config remote-gsyncd "
                                   "<GSYNCD_PATH> (Example GSYNCD_PATH: "
                                   "`/usr/libexec/glusterfs/gsyncd`)")
+                terminate_channels(log_errors=True)
                 rconf.transport.terminate_geterr()
         elif isinstance(exc, OSError) and exc.errno in (ENOTCONN,
                                                         ECONNABORTED):
@@ -558,6 +588,78 @@ def sha256hex(s):
     return sha256(s).hexdigest()
 
 
+_GFID_PATH_RE = re.compile(
+    r'\.gfid/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+
+
+# lines of sync error output which only sum up the errors before them
+_SYNC_SUMMARY_RE = re.compile(
+    r'rsync error: some files/attrs were not transferred|'
+    r'rsync warning: some files vanished before they could be transferred|'
+    r'tar: Exiting with failure status due to previous errors')
+
+
+def failed_gfid_paths(errors):
+    """aux-gfid paths of the files named by sync error output @errors
+
+    Return None if some of the errors are not about a file (eg. the
+    connection was lost), as then any file could have failed.
+    """
+    paths = set()
+    for line in errors.splitlines():
+        if not line.strip() or _SYNC_SUMMARY_RE.search(line):
+            continue
+        gfids = _GFID_PATH_RE.findall(line)
+        if not gfids:
+            return None
+        paths.update(os.path.join(gauxpfx(), gfid) for gfid in gfids)
+    return paths
+
+
+def error_file():
+    """temp file to take the error output of a sync child
+
+    Unlike stderr=PIPE, this keeps the child away from the Popen error
+    handler thread, which would otherwise read part of the output behind
+    the back of communicate(): once the child is waited for, the file
+    holds all of it, as failed_gfid_paths needs.
+    """
+    return tempfile.TemporaryFile()
+
+
+def read_error_file(f):
+    """the error output in the error_file @f of a terminated child,
+    closing @f"""
+    try:
+        f.seek(0)
+        return f.read().decode("utf-8", "replace")
+    finally:
+        f.close()
+
+
+def block_digest(data):
+    """digest of a file block, as compared by the native sync method"""
+    # blake2b is only available in py3, and only needed with it
+    from hashlib import blake2b
+    return blake2b(data, digest_size=16).digest()
+
+
+def open_regular(path, flags):
+    """open the regular file @path with @flags, not following symlinks
+
+    Raise EINVAL if @path is not a regular file, symlinks included,
+    without opening it (ELOOP if it was replaced by a symlink in the
+    interim).
+    """
+    if not stat.S_ISREG(os.lstat(path).st_mode):
+        raise OSError(EINVAL, "not a regular file: %s" % path)
+    fd = os.open(path, flags | os.O_NOFOLLOW | os.O_NONBLOCK)
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        raise OSError(EINVAL, "not a regular file: %s" % path)
+    return fd
+
+
 def selfkill(sig=SIGTERM):
     os.kill(os.getpid(), sig)
 
@@ -605,6 +707,47 @@ def matching_disk_gfid(gfid, entry):
     return True
 
 
+class GfidMemo(object):
+
+    """GFIDs of paths on the mount, as by get_gfid_from_mnt(), looked
+    up once till the path is changed. Callers are to .forget paths
+    they create, remove or rename. .lookups and .saved count the
+    lookups made and those answered from the memo.
+    """
+
+    def __init__(self):
+        self.gfids = {}
+        self.lookups = 0
+        self.saved = 0
+        self.lock = Lock()
+
+    def get(self, path):
+        with self.lock:
+            gfid = self.gfids.get(path)
+            if gfid is not None:
+                self.saved += 1
+                return gfid
+            self.lookups += 1
+        gfid = get_gfid_from_mnt(path)
+        with self.lock:
+            self.gfids[path] = gfid
+        return gfid
+
+    def matching(self, gfid, path):
+        """memoized matching_disk_gfid()"""
+        disk_gfid = self.get(path)
+        return not isinstance(disk_gfid, int) and gfid == disk_gfid
+
+    def forget(self, *paths):
+        with self.lock:
+            for path in paths:
+                self.gfids.pop(path, None)
+
+    def clear(self):
+        with self.lock:
+            self.gfids.clear()
+
+
 class NoStimeAvailable(Exception):
     pass
 
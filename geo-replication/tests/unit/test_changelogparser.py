@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from syncdaemon import changelogparser
+
+G1 = "00000000-0000-0000-0000-000000000001"
+G2 = "9f3c9a02-5c83-4dc6-8e0c-1ab1b1d4f1a7"
+G3 = "4c1d5e3b-8f7a-4f0e-9b2d-6a5c7e8f9a0b"
+
+RECORDS = (
+    "E %(g2)s CREATE 33188 0 0 %(g1)s/a%%20b%%25c\n"
+    "D %(g2)s\n"
+    "\n"
+    "M %(g2)s SETATTR 1000 1000 33188\n"
+    "E %(g3)s MKDIR 16877 10 20 %(g1)s/dir\n"
+    "E %(g2)s RENAME %(g1)s/a%%20b%%25c %(g3)s/new%%0Aname\n"
+    "E %(g2)s LINK %(g3)s/link\n"
+    "E %(g2)s UNLINK %(g3)s/new%%0Aname %(g3)s/deleted/path\n"
+    "M %(g3)s SETXATTR\n"
+    "X %(g1)s whatever\n"
+) % {"g1": G1, "g2": G2, "g3": G3}
+
+
+class ChangelogParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def changelog(self, data):
+        path = os.path.join(self.work_dir, "CHANGELOG.1600000000")
+        with open(path, "w") as f:
+            f.write(data)
+        return path
+
+    def test_parse(self):
+        cl = changelogparser.parse(self.changelog(RECORDS), ".gfid/")
+        self.assertEqual(len(cl), 9)
+        self.assertEqual(cl.types, list("EDMEEEEMX"))
+        self.assertEqual(cl.gfids, [G2, G2, G2, G3, G2, G2, G2, G3, G1])
+        self.assertEqual(cl.fops,
+                         ["CREATE", None, "SETATTR", "MKDIR", "RENAME",
+                          "LINK", "UNLINK", "SETXATTR", None])
+        self.assertEqual(cl.entries,
+                         [".gfid/%s/a b%%c" % G1, None, None,
+                          ".gfid/%s/dir" % G1, ".gfid/%s/a b%%c" % G1,
+                          ".gfid/%s/link" % G3,
+                          ".gfid/%s/new\nname" % G3, None, None])
+        self.assertEqual(cl.entries1,
+                         [None] * 4 + [".gfid/%s/new\nname" % G3] +
+                         [None] * 4)
+        self.assertEqual(cl.modes, [33188, None, None, 16877] + [None] * 5)
+        self.assertEqual(cl.uids, [0, None, None, 10] + [None] * 5)
+        self.assertEqual(cl.gids, [0, None, None, 20] + [None] * 5)
+        self.assertEqual(cl.args,
+                         [None, None, ("1000", "1000", "33188")] +
+                         [None] * 4 + [()] + [None])
+
+    def test_rows(self):
+        cl = changelogparser.parse(self.changelog(RECORDS))
+        rows = list(cl.rows())
+        self.assertEqual(len(rows), len(cl))
+        self.assertEqual(rows[0],
+                         ("E", "CREATE", G2, "%s/a b%%c" % G1, None,
+                          33188, 0, 0, None))
+
+    def test_mmap(self):
+        path = self.changelog(RECORDS)
+        plain = changelogparser.parse(path, ".gfid/")
+        mapped = changelogparser.parse(path, ".gfid/", use_mmap=True)
+        for col in changelogparser.Changelog.COLUMNS:
+            self.assertEqual(getattr(mapped, col), getattr(plain, col))
+
+    def test_empty(self):
+        for use_mmap in (False, True):
+            cl = changelogparser.parse(self.changelog(""), use_mmap=use_mmap)
+            self.assertEqual(len(cl), 0)
+
+    def test_select(self):
+        cl = changelogparser.parse(self.changelog(RECORDS))
+        keep = [ty == changelogparser.TYPE_ENTRY for ty in cl.types]
+        sel = cl.select(keep)
+        self.assertEqual(len(sel), 5)
+        self.assertEqual(sel.fops,
+                         ["CREATE", "MKDIR", "RENAME", "LINK", "UNLINK"])
+        self.assertEqual(sel.entries1[2], "%s/new\nname" % G3)
+        # the Changelog selected from is left alone
+        self.assertEqual(len(cl), 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
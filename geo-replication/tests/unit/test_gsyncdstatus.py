@@ -11,13 +11,22 @@
 
 import unittest
 import os
-import urllib
-
-from syncdaemon.gstatus import (GeorepStatus, set_monitor_status,
-                                get_default_values,
-                                MONITOR_STATUS, DEFAULT_STATUS,
-                                STATUS_VALUES, CRAWL_STATUS_VALUES,
-                                human_time, human_time_utc)
+import sys
+import json
+import shutil
+import tempfile
+import threading
+try:
+    import urllib.parse as urllib
+except ImportError:
+    import urllib
+
+from syncdaemon.gsyncdstatus import (GeorepStatus, set_monitor_status,
+                                     StatusSegment, get_default_values,
+                                     MONITOR_STATUS, DEFAULT_STATUS,
+                                     STATUS_VALUES, CRAWL_STATUS_VALUES,
+                                     human_time, human_time_utc,
+                                     percentiles, summarize_batches)
 
 
 class GeorepStatusTestCase(unittest.TestCase):
@@ -26,7 +35,9 @@ class GeorepStatusTestCase(unittest.TestCase):
         cls.work_dir = os.path.dirname(os.path.abspath(__file__))
         cls.monitor_status_file = os.path.join(cls.work_dir, "monitor.status")
         cls.brick = "/exports/bricks/b1"
-        cls.status = GeorepStatus(cls.monitor_status_file, cls.brick)
+        cls.status = GeorepStatus(cls.monitor_status_file, "node1", cls.brick,
+                                  "node1-id", "primary", "fvm2::secondary",
+                                  os.path.join(cls.work_dir, "monitor.pid"))
         cls.statusfile = os.path.join(cls.work_dir,
                                       "brick_%s.status"
                                       % urllib.quote_plus(cls.brick))
@@ -34,6 +45,7 @@ class GeorepStatusTestCase(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         os.remove(cls.statusfile)
+        os.remove(cls.statusfile + "_seg")
         os.remove(cls.monitor_status_file)
 
     def _filter_dict(self, inp, keys):
@@ -189,5 +201,177 @@ class GeorepStatusTestCase(unittest.TestCase):
         self.status.set_active()
 
 
+class StatusSegmentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, "brick.status_seg")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_unset(self):
+        segment = StatusSegment(self.path, create=True)
+        self.assertIsNone(segment.read())
+        segment.close()
+
+    def test_update(self):
+        writer = StatusSegment(self.path, create=True)
+        writer.update({"worker_status": "Active", "entry": 4,
+                       "batch_duration": 1.5, "unknown": 1})
+        writer.update(deltas={"entry": 2, "data": -3})
+        reader = StatusSegment(self.path)
+        values = reader.read()
+        self.assertEqual(values["worker_status"], "Active")
+        self.assertEqual(values["entry"], 6)
+        # counters don't go below zero
+        self.assertEqual(values["data"], 0)
+        self.assertEqual(values["batch_duration"], 1.5)
+        self.assertEqual(values["secondary_node"], "")
+        self.assertNotIn("unknown", values)
+        reader.close()
+        writer.close()
+
+
+class GeorepStatusFlushTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        monitor_status_file = os.path.join(self.work_dir, "monitor.status")
+        self.status = GeorepStatus(monitor_status_file, "node1",
+                                   "/exports/bricks/b1", "node1-id",
+                                   "primary", "fvm2::secondary",
+                                   os.path.join(self.work_dir, "monitor.pid"),
+                                   flush_interval=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def status_file_values(self):
+        with open(self.status.filename) as f:
+            data = f.read()
+        return json.loads(data) if data else {}
+
+    def test_debounce(self):
+        self.status.inc_value("entry", 2)
+        self.status.inc_value("entry", 3)
+        self.status.dec_value("data", 1)
+        # published in the segment right away, not in the status file
+        self.assertEqual(self.status.read_segment()["entry"], 5)
+        self.assertNotIn("entry", self.status_file_values())
+
+        self.status.flush()
+        values = self.status_file_values()
+        self.assertEqual(values["entry"], 5)
+        self.assertEqual(values["data"], 0)
+        self.assertEqual(self.status.read_segment()["entry"], 5)
+
+    def test_pending_deltas_kept(self):
+        # setting a field publishes the pending deltas along
+        self.status.set_field("entry", 1)
+        self.status.inc_value("entry", 2)
+        self.status.set_field("failures", 1)
+        self.assertEqual(self.status.read_segment()["entry"], 3)
+        self.status.flush()
+        self.assertEqual(self.status_file_values()["entry"], 3)
+
+    def test_concurrent_publish(self):
+        def publish():
+            for _ in range(200):
+                self.status.inc_value("entry", 1)
+                self.status.set_batch_stats(1, 0, 0, 1)
+
+        # switch threads often, for them to meet in the segment
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=publish) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(self.status.read_segment()["entry"], 800)
+
+
+class BatchStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.status = GeorepStatus(
+            os.path.join(self.work_dir, "monitor.status"), "node1",
+            "/exports/bricks/b1", "node1-id", "primary", "fvm2::secondary")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def record(self, start_time, duration, **kw):
+        record = {"start_time": start_time, "duration": duration,
+                  "entry_duration": 0.1, "meta_duration": 0.1,
+                  "data_duration": duration - 0.2, "queue_wait": 0,
+                  "changelogs": 2, "files": 10, "bytes": None,
+                  "retries": 0, "fops": {"CREATE": 1}}
+        record.update(kw)
+        return record
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles([]), {})
+        self.assertEqual(percentiles([3]),
+                         {"p50": 3, "p90": 3, "p99": 3, "max": 3})
+        self.assertEqual(percentiles(list(range(100, 0, -1))),
+                         {"p50": 50, "p90": 90, "p99": 99, "max": 100})
+        self.assertEqual(percentiles([1, 2, 3, 4], (25, 75)),
+                         {"p25": 1, "p75": 3, "max": 4})
+
+    def test_summarize_batches(self):
+        self.assertEqual(summarize_batches([]), {"batches": 0})
+        summary = summarize_batches([
+            self.record(100, 2, bytes=1000, retries=1),
+            self.record(101, 5, fops={"CREATE": 2, "UNLINK": 3}),
+            self.record(106, 4, bytes=3000)])
+        self.assertEqual(summary["batches"], 3)
+        self.assertEqual((summary["start_time"], summary["end_time"]),
+                         (100, 110))
+        self.assertEqual(summary["changelogs"], 6)
+        self.assertEqual(summary["files_per_sec"], 3.0)
+        # bytes are summed over the batches they're known for
+        self.assertEqual(summary["bytes"], 4000)
+        self.assertEqual(summary["bytes_per_sec"], 400.0)
+        self.assertEqual(summary["retries"], 1)
+        self.assertEqual(summary["duration"]["p50"], 4)
+        self.assertEqual(summary["duration"]["max"], 5)
+        self.assertEqual(summary["fops"], {"CREATE": 4, "UNLINK": 3})
+
+    def test_summarize_unsized(self):
+        summary = summarize_batches([self.record(100, 2)])
+        self.assertIsNone(summary["bytes"])
+        self.assertNotIn("bytes_per_sec", summary)
+
+    def test_batch_records(self):
+        records = [self.record(100 + i, 1) for i in range(10)]
+        for record in records:
+            self.status.add_batch_record(record, 500)
+        # the timeline was rotated, the last rotation is kept
+        self.assertTrue(os.path.exists(self.status.batches_file + ".1"))
+        kept = self.status.get_batch_records()
+        self.assertLess(len(kept), len(records))
+        self.assertEqual(kept, records[-len(kept):])
+        self.assertEqual(self.status.get_session_batch_records(), kept)
+
+    def test_reading_creates_nothing(self):
+        self.status.set_repce_stats({"entry_ops": {"calls": 1}})
+        self.status.add_batch_record(self.record(100, 1), 500)
+        files = sorted(os.listdir(self.work_dir))
+        # as the stats subcommands do, without a brick
+        reader = GeorepStatus(
+            os.path.join(self.work_dir, "monitor.status"), "", "", "",
+            "primary", "fvm2::secondary", create=False)
+        self.assertEqual(reader.get_session_repce_stats(),
+                         {"/exports/bricks/b1": {"entry_ops": {"calls": 1}}})
+        self.assertEqual(reader.get_repce_stats(), {})
+        self.assertEqual(reader.get_session_batch_records(),
+                         [self.record(100, 1)])
+        self.assertEqual(reader.get_batch_records(), [])
+        self.assertEqual(sorted(os.listdir(self.work_dir)), files)
+
+
 if __name__ == "__main__":
     unittest.main()
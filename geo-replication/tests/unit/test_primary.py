@@ -0,0 +1,443 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from syncdaemon import changelogparser, primary, syncdutils
+
+CONF = {"sync-jobs": 1,
+        "sync-batch-max-files": 0,
+        "sync-batch-max-bytes": 0,
+        "sync-shard-min-files": 0}
+
+
+def config(**kw):
+    """patch the config with the CONF values, overridden by @kw
+    (with underscores for dashes)"""
+    values = dict(CONF)
+    for k, v in kw.items():
+        values[k.replace("_", "-")] = v
+    return mock.patch.object(primary.gconf, "get",
+                             lambda name, default=None:
+                             values.get(name, default))
+
+
+class Result(object):
+    def __init__(self, returncode, failed_files=None):
+        self.returncode = returncode
+        self.failed_files = failed_files
+
+
+class SyncerTestCase(unittest.TestCase):
+    def make_syncer(self, outcome, **kw):
+        """a Syncer whose transfers end with @outcome, a function of
+        the box synced returning a Result"""
+        self.boxes = []
+        self.log_errs = []
+
+        def engine(pb, log_err):
+            self.boxes.append(list(pb))
+            self.log_errs.append(log_err)
+            return outcome(pb)
+
+        with config(**kw):
+            return primary.Syncer(None, engine, [23])
+
+    def test_partial_failure(self):
+        s = self.make_syncer(lambda pb: Result(23, set(["a"])))
+        pb = s.add("a")
+        s.add("b")
+        s.flush()
+        self.assertEqual(pb.wait(), (False, 23, set(["a"])))
+
+    def test_unattributed_failure(self):
+        # an error the sync engine could not tie to files
+        gfid = "9f3c9a02-5c83-4dc6-8e0c-1ab1b1d4f1a7"
+        failed = syncdutils.failed_gfid_paths(
+            'rsync: [sender] read errors mapping ".gfid/%s": Input/output '
+            'error (5)\nrsync: connection unexpectedly closed\n' % gfid)
+        s = self.make_syncer(lambda pb: Result(23, failed))
+        pb = s.add(".gfid/" + gfid)
+        s.add(".gfid/00000000-0000-0000-0000-00000000000b")
+        s.flush()
+        # so all the files of the box are to be retried
+        self.assertEqual(pb.wait(), (False, 23, None))
+
+    def test_log_err(self):
+        s = self.make_syncer(lambda pb: Result(0))
+        s.add("a")
+        s.flush()
+        s.add("b", log_err=True).wait()
+        self.assertEqual(self.log_errs, [False, True])
+
+    def test_log_err_waiting(self):
+        # a file retried with errors logged, still waiting in a box
+        # of another batch, gets the errors of that box logged
+        with config(sync_jobs=0):
+            s = primary.Syncer(None, None, [23])
+        pb = s.add("a")
+        self.assertIs(s.add("a", log_err=True), pb)
+        self.assertTrue(pb.log_err)
+
+
+class SyncerSealTestCase(unittest.TestCase):
+    def make_syncer(self, **kw):
+        """a Syncer without workers, its boxes are left for
+        the test to look at"""
+        with config(sync_jobs=0, **kw):
+            return primary.Syncer(None, None, [23])
+
+    def test_seal_by_count(self):
+        s = self.make_syncer(sync_batch_max_files=2)
+        pb = s.add("a")
+        self.assertIs(s.add("b"), pb)
+        self.assertIsNot(s.add("c"), pb)
+        self.assertEqual(list(s.ready), [pb])
+        self.assertEqual(list(pb), ["a", "b"])
+        self.assertFalse(pb.open)
+        self.assertEqual(list(s.pb), ["c"])
+
+    def test_seal_by_size(self):
+        s = self.make_syncer(sync_batch_max_bytes=10)
+        self.assertTrue(s.sized)
+        pb = s.add("a", 6)
+        self.assertEqual(list(s.ready), [])
+        s.add("b", 6)
+        self.assertEqual(list(s.ready), [pb])
+        self.assertEqual(pb.size, 12)
+        s.add("c", 1)
+        self.assertEqual(s.pb.size, 1)
+
+    def test_waiting(self):
+        # a file still waiting in a box is not posted again
+        s = self.make_syncer(sync_batch_max_files=2)
+        pb = s.add("a")
+        self.assertIs(s.add("a"), pb)
+        self.assertEqual(list(pb), ["a"])
+        s.add("b")
+        # sealed, but no worker took it yet
+        self.assertIs(s.add("a"), pb)
+        self.assertIs(s.next_box(), pb)
+        # once taken, the file is to be synced again
+        self.assertIsNot(s.add("a"), pb)
+        self.assertEqual(s.waiting, {"a": s.pb})
+
+    def test_flush(self):
+        s = self.make_syncer()
+        s.flush()
+        self.assertEqual(list(s.ready), [])
+        pb = s.add("a")
+        s.flush()
+        self.assertEqual(list(s.ready), [pb])
+        self.assertEqual(len(s.pb), 0)
+
+
+class SyncerShardTestCase(unittest.TestCase):
+    def make_box(self, n):
+        pb = primary.PostBox(".gfid/%d" % i for i in range(n))
+        pb.close()
+        return pb
+
+    def make_syncer(self, idle, **kw):
+        with config(sync_jobs=0, **kw):
+            s = primary.Syncer(None, None, [23])
+        s.idle = idle
+        return s
+
+    def test_shard(self):
+        s = self.make_syncer(2, sync_shard_min_files=2)
+        pb = self.make_box(6)
+        shards = s.shard(pb)
+        self.assertGreaterEqual(len(shards), 2)
+        self.assertLessEqual(len(shards), 3)
+        self.assertEqual(sorted(sum(shards, [])), sorted(pb))
+        # the other shards are first in line for the idle workers
+        self.assertEqual(sorted(s.ready), sorted(shards[1:]))
+        for shard in shards:
+            self.assertTrue(shard)
+            self.assertFalse(shard.open)
+        # a file always goes to the same shard
+        s.ready.clear()
+        self.assertEqual(s.shard(pb), shards)
+
+    def test_no_shard(self):
+        pb = self.make_box(6)
+        # off
+        self.assertIsNone(self.make_syncer(2).shard(pb))
+        # no idle worker
+        s = self.make_syncer(0, sync_shard_min_files=2)
+        self.assertIsNone(s.shard(pb))
+        # not enough files for two shards
+        s = self.make_syncer(2, sync_shard_min_files=4)
+        self.assertIsNone(s.shard(pb))
+        self.assertEqual(list(s.ready), [])
+
+    def test_reclaim(self):
+        s = self.make_syncer(1, sync_shard_min_files=2)
+        shards = s.shard(self.make_box(20))
+        self.assertTrue(s.reclaim(shards[1]))
+        self.assertEqual(list(s.ready), [])
+        self.assertFalse(s.reclaim(shards[1]))
+
+    def test_merge_outcomes(self):
+        ok = (True, 0, None)
+        self.assertEqual(primary.merge_outcomes([ok, ok]), ok)
+        self.assertEqual(
+            primary.merge_outcomes([ok, (False, 23, set(["a"])),
+                                    (False, 24, set(["b"]))]),
+            (False, 23, set(["a", "b"])))
+        # the files which failed are known only if known for all
+        self.assertEqual(
+            primary.merge_outcomes([(False, 23, set(["a"])),
+                                    (False, 23, None)]),
+            (False, 23, None))
+
+
+def old_batches(changes, limit):
+    """the grouping into batches before the BatchSizer"""
+    changelogs_batches = []
+    current_size = 0
+    for c in changes:
+        si = os.lstat(c).st_size
+        if (si + current_size) > limit:
+            changelogs_batches.append([c])
+            current_size = si
+        else:
+            current_size += si
+            if not changelogs_batches:
+                changelogs_batches.append([c])
+            else:
+                changelogs_batches[-1].append(c)
+    return changelogs_batches
+
+
+class BatchSizerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def changelogs(self, sizes):
+        changes = []
+        for i, size in enumerate(sizes):
+            path = os.path.join(self.work_dir, "CHANGELOG.%d" % (1000 + i))
+            with open(path, "wb") as f:
+                f.write(b"x" * size)
+            changes.append(path)
+        return changes
+
+    def test_batches(self):
+        changes = self.changelogs([40, 40, 30, 100, 10, 90, 150, 5])
+        sizer = primary.BatchSizer(100, 0, 1000)
+        self.assertEqual([[os.path.basename(c) for c in batch]
+                          for batch in sizer.batches(changes)],
+                         [["CHANGELOG.1000", "CHANGELOG.1001"],
+                          ["CHANGELOG.1002"],
+                          ["CHANGELOG.1003"],
+                          ["CHANGELOG.1004", "CHANGELOG.1005"],
+                          ["CHANGELOG.1006"],
+                          ["CHANGELOG.1007"]])
+
+    def test_batches_as_before(self):
+        rnd = random.Random(42)
+        changes = self.changelogs([rnd.randint(0, 120) for _ in range(200)])
+        for limit in (1, 50, 100, 1000, 100000):
+            sizer = primary.BatchSizer(limit, 0, limit)
+            self.assertEqual(list(sizer.batches(changes)),
+                             old_batches(changes, limit))
+
+    def test_static(self):
+        changes = self.changelogs([60, 60])
+        sizer = primary.BatchSizer(100, 0, 1000)
+        batch = next(sizer.batches(changes))
+        sizer.observe(batch, 0.1, 0)
+        sizer.observe(batch, 100, 3)
+        self.assertEqual(sizer.size, 100)
+        self.assertEqual(sizer.full, set())
+
+    def test_grow(self):
+        changes = self.changelogs([60, 60, 60, 60])
+        sizer = primary.BatchSizer(100, 10, 250)
+        batches = sizer.batches(changes)
+        sizer.observe(next(batches), 1, 0)
+        self.assertEqual(sizer.size, 200)
+        # not cut by the limit, nothing to tell
+        sizer.observe(next(batches), 1, 0)
+        self.assertEqual(sizer.size, 200)
+        # within the target but not below half of it
+        sizer.size = 100
+        sizer.observe(next(sizer.batches(changes)), 6, 0)
+        self.assertEqual(sizer.size, 100)
+        # up to the max
+        sizer.size = 200
+        sizer.observe(next(sizer.batches(changes)), 1, 0)
+        self.assertEqual(sizer.size, 250)
+
+    def test_shrink(self):
+        sizer = primary.BatchSizer(160, 10, 1000)
+        sizer.observe(["c"], 16, 0)
+        self.assertEqual(sizer.size, 100)
+        # at most halved
+        sizer.observe(["c"], 100, 0)
+        self.assertEqual(sizer.size, 50)
+        sizer.observe(["c"], 1, 1)
+        self.assertEqual(sizer.size, 25)
+        # down to a sixteenth of the size
+        for _ in range(10):
+            sizer.observe(["c"], 1, 1)
+        self.assertEqual(sizer.size, 10)
+
+
+class CoalesceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.gprimary = primary.GPrimaryChangelogMixin.__new__(
+            primary.GPrimaryChangelogMixin)
+        self.gprimary.init_fop_batch_stats()
+        # GFIDs still there on the primary
+        self.present = set()
+        self.gprimary.resolver = mock.Mock()
+        self.gprimary.resolver.lstat.side_effect = self.lstat
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def lstat(self, go):
+        if go[len(".gfid/"):] in self.present:
+            return os.lstat(self.work_dir)
+        return 2
+
+    def parse(self, *changelogs):
+        parsed = []
+        for i, records in enumerate(changelogs):
+            path = os.path.join(self.work_dir, "CHANGELOG.%d" % i)
+            with open(path, "w") as f:
+                f.write("\n".join(records) + "\n")
+            parsed.append(changelogparser.parse(path, ".gfid/"))
+        return parsed
+
+    def test_coalesce(self):
+        parsed = self.parse(
+            ["E g1 CREATE 33188 0 0 p/a",
+             "D g1",
+             "E g2 CREATE 33188 0 0 p/b",
+             "E g3 MKNOD 8630 0 0 p/c",
+             "E g4 CREATE 33188 0 0 p/d",
+             "D g4"],
+            ["M g1 SETATTR 0 0 420",
+             "E g1 UNLINK p/a",
+             "E g2 UNLINK p/b",
+             "E g3 RENAME p/c p/e",
+             "E g3 UNLINK p/e"])
+        # g2 was recreated in a later changelog, say
+        self.present.add("g2")
+        cl1, cl2 = self.gprimary.coalesce(parsed)
+        # g1 is gone, only its unlink is left
+        self.assertEqual(list(zip(cl1.gfids, cl1.fops)),
+                         [("g2", "CREATE"), ("g3", "MKNOD"),
+                          ("g4", "CREATE"), ("g4", None)])
+        self.assertEqual(list(zip(cl2.gfids, cl2.fops)),
+                         [("g1", "UNLINK"), ("g2", "UNLINK"),
+                          ("g3", "RENAME"), ("g3", "UNLINK")])
+        self.assertEqual(self.gprimary.batch_stats["COALESCED"], 1)
+
+    def test_nothing_to_coalesce(self):
+        parsed = self.parse(["E g1 CREATE 33188 0 0 p/a", "D g1"],
+                            ["E g2 UNLINK p/b"])
+        self.assertIs(self.gprimary.coalesce(parsed), parsed)
+        self.assertEqual(self.gprimary.batch_stats["COALESCED"], 0)
+
+
+class StatResolverTestCase(unittest.TestCase):
+    RECORDS = ["E g1 CREATE 33188 0 0 p/a",
+               "E g2 LINK p/l",
+               "E g3 UNLINK p/u",
+               "D g4",
+               "M g5 SETATTR 0 0 420",
+               "M g6 SETXATTR",
+               "E g2 LINK p/l"]
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.lookups = []
+        for name in ("lstat", "matching_disk_gfid"):
+            patch = mock.patch.object(primary, name, getattr(self, name))
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def lstat(self, go):
+        self.lookups.append(("lstat", go))
+        return "stat of " + go
+
+    def matching_disk_gfid(self, gfid, en):
+        self.lookups.append(("match", gfid, en))
+        return True
+
+    def prefetch(self, nthreads, data):
+        path = os.path.join(self.work_dir, "CHANGELOG.1")
+        with open(path, "w") as f:
+            f.write("\n".join(self.RECORDS) + "\n")
+        resolver = primary.StatResolver(nthreads)
+        resolver.prefetch([changelogparser.parse(path, ".gfid/")], data)
+        if resolver.executor:
+            # all the lookups are done
+            resolver.executor.shutdown(wait=True)
+        return resolver
+
+    def test_prefetch(self):
+        resolver = self.prefetch(4, True)
+        # once each, none for the files created or their entries
+        self.assertEqual(sorted(self.lookups),
+                         [("lstat", ".gfid/g2"), ("lstat", ".gfid/g3"),
+                          ("lstat", ".gfid/g4"), ("lstat", ".gfid/g5"),
+                          ("match", "g2", ".gfid/p/l")])
+        del self.lookups[:]
+        self.assertEqual(resolver.lstat(".gfid/g2"), "stat of .gfid/g2")
+        self.assertTrue(resolver.matching_disk_gfid("g2", ".gfid/p/l"))
+        self.assertEqual(self.lookups, [])
+        self.assertEqual(resolver.lstat(".gfid/g1"), "stat of .gfid/g1")
+        self.assertEqual(self.lookups, [("lstat", ".gfid/g1")])
+
+    def test_prefetch_no_data(self):
+        self.prefetch(4, False)
+        self.assertNotIn(("lstat", ".gfid/g4"), self.lookups)
+        self.assertEqual(len(self.lookups), 4)
+
+    def test_forget(self):
+        resolver = self.prefetch(4, True)
+        del self.lookups[:]
+        resolver.forget("g2")
+        resolver.lstat(".gfid/g2")
+        resolver.matching_disk_gfid("g2", ".gfid/p/l")
+        resolver.lstat(".gfid/g3")
+        self.assertEqual(self.lookups, [("lstat", ".gfid/g2"),
+                                        ("match", "g2", ".gfid/p/l")])
+
+    def test_single_thread(self):
+        resolver = self.prefetch(1, True)
+        self.assertIsNone(resolver.executor)
+        self.assertEqual(self.lookups, [])
+        # looked up when asked for, then kept
+        resolver.lstat(".gfid/g2")
+        resolver.lstat(".gfid/g2")
+        self.assertEqual(self.lookups, [("lstat", ".gfid/g2")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,264 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import io
+import time
+import asyncio
+import unittest
+
+from syncdaemon import repce, repceasync
+from syncdaemon.syncdutils import Thread
+
+
+class Backend(object):
+    def __init__(self):
+        self.done = []
+
+    def echo(self, *args):
+        return args
+
+    def sleep(self, secs):
+        time.sleep(secs)
+        self.done.append(secs)
+        return secs
+
+    def fail(self):
+        raise ValueError("fail")
+
+    def repce_stats(self):
+        return {"backend": {"done": len(self.done)}}
+
+
+class RepceFrameTestCase(unittest.TestCase):
+    def _roundtrip(self, func, *args):
+        r, w = os.pipe()
+        func(w, *args)
+        os.close(w)
+        with os.fdopen(r, 'rb') as f:
+            return repce.recv_frame(f)
+
+    def test_legacy_message(self):
+        flags, msg = self._roundtrip(repce.send, 1, "meth", "arg")
+        self.assertIsNone(flags)
+        self.assertEqual(msg, (1, "meth", "arg"))
+
+    def test_frame(self):
+        flags, msg = self._roundtrip(repce.send_frame, (1, "meth", "arg"))
+        self.assertEqual(flags, 0)
+        self.assertEqual(msg, (1, "meth", "arg"))
+
+    def test_batch_frame(self):
+        batch = [(1, "a"), (2, "b")]
+        flags, msg = self._roundtrip(repce.send_frame, batch,
+                                     repce.FLAG_BATCH)
+        self.assertEqual(flags, repce.FLAG_BATCH)
+        self.assertEqual(msg, batch)
+
+    def test_compressed_frame(self):
+        codec = repce.get_codec("zlib")
+        msg = [(1, "entry_ops", [{"gfid": "x" * 36}] * 1000)]
+        buf = repce.pack_frame(msg, repce.FLAG_BATCH, codec, 1024)
+        raw = repce.pack_frame(msg, repce.FLAG_BATCH)
+        self.assertLess(len(buf) * 10, len(raw))
+        _, flags, size = repce.FRAME_HDR.unpack(buf[:repce.FRAME_HDR.size])
+        self.assertEqual(flags, repce.FLAG_BATCH | repce.FLAG_ZLIB)
+        self.assertEqual(
+            repce.unpack_payload(flags, buf[repce.FRAME_HDR.size:]), msg)
+
+    def test_below_threshold(self):
+        codec = repce.get_codec("zlib")
+        buf = repce.pack_frame((1, "xtime"), 0, codec, 1024)
+        self.assertEqual(buf, repce.pack_frame((1, "xtime")))
+
+    def test_eof(self):
+        self.assertRaises(EOFError, repce.recv_frame, io.BytesIO(b''))
+
+
+class RepceBatchTestCase(unittest.TestCase):
+    server_class = repce.RepceServer
+    client_class = repce.RepceClient
+
+    def setUp(self):
+        r1, w1 = os.pipe()
+        r2, w2 = os.pipe()
+        self.backend = Backend()
+        server = self.server_class(self.backend, r1, w2, 4)
+        t = Thread(target=server.service_loop)
+        t.start()
+        self.client = self.client_class(r2, w1)
+        self.client.negotiate(self.client.__version__()['proto'])
+
+    def test_negotiated(self):
+        self.assertTrue(self.client.framed)
+
+    def test_compression(self):
+        self.client.negotiate(1.2, "zlib", 0)
+        self.assertEqual(self.client.codec.name, "zlib")
+        self.assertEqual(self.client.echo("x" * 100000), ("x" * 100000, ))
+
+    def test_stats(self):
+        self.client.sleep(0.01)
+        self.assertRaises(ValueError, self.client.fail)
+        snap = self.client.stats_snapshot()
+        for side, hist in (("client", "latency"), ("server", "execute")):
+            meth = snap[side]["methods"]["sleep"]
+            self.assertEqual(meth["calls"], 1)
+            self.assertEqual(meth["in_flight"], 0)
+            self.assertGreaterEqual(meth[hist]["sum"], 0.01)
+            self.assertGreaterEqual(meth[hist]["p50_us"], 16384)
+            self.assertEqual(snap[side]["methods"]["fail"]["errors"], 1)
+        self.assertIn("wait", snap["server"]["methods"]["sleep"])
+        self.assertEqual(snap["server"]["backend"], {"done": 1})
+
+    def test_call_many_in_order(self):
+        res = self.client.call_many([("sleep", (0.2, )),
+                                     ("sleep", (0, )),
+                                     ("echo", (1, 2))])
+        self.assertEqual(res, [0.2, 0, (1, 2)])
+        self.assertEqual(self.backend.done, [0.2, 0])
+
+    def test_batch(self):
+        with self.client.batch() as b:
+            b.echo(1)
+            b.echo("x")
+        self.assertEqual(b.results(), [(1, ), ("x", )])
+
+    def test_call_many_failure(self):
+        self.assertRaises(ValueError, self.client.call_many,
+                          [("echo", (1, )), ("fail", ())])
+
+    def test_submit(self):
+        rjobs = [self.client.submit("sleep", 0.1),
+                 self.client.submit("echo", 1)]
+        done, not_done = repce.wait_all(rjobs)
+        self.assertEqual(len(done), 2)
+        self.assertEqual(not_done, [])
+        self.assertEqual([j.result() for j in rjobs], [0.1, (1, )])
+
+    def test_result_timeout(self):
+        rjob = self.client.submit("sleep", 0.5)
+        self.assertRaises(repce.TimeoutError, rjob.result, 0.01)
+        self.assertFalse(rjob.done())
+        self.assertEqual(rjob.result(), 0.5)
+        self.assertTrue(rjob.done())
+
+    def test_exception(self):
+        rjob = self.client.submit("fail")
+        self.assertIsInstance(rjob.exception(), ValueError)
+        self.assertRaises(ValueError, rjob.result)
+
+    def test_legacy_call_many(self):
+        self.client.framed = False
+        res = self.client.call_many([("sleep", (0.2, )),
+                                     ("sleep", (0, ))])
+        self.assertEqual(res, [0.2, 0])
+        self.assertEqual(self.backend.done, [0.2, 0])
+
+
+class AsyncRepceTestCase(RepceBatchTestCase):
+    server_class = repceasync.AsyncRepceServer
+    client_class = repceasync.AsyncRepceClient
+
+    def test_acall(self):
+        async def calls():
+            return await asyncio.gather(self.client.acall("sleep", 0.1),
+                                        self.client.acall("echo", 1))
+        self.assertEqual(asyncio.run(calls()), [0.1, (1, )])
+
+
+class FrameReaderTestCase(unittest.TestCase):
+    def test_legacy_in_pieces(self):
+        msgs = [(1, "meth", "x" * 100000), (2, "echo", (1, 2))]
+        data = b"".join(repce.pickle.dumps(m, repce.pickle_proto)
+                        for m in msgs)
+
+        async def feed(stream):
+            for i in range(0, len(data), 1000):
+                stream.feed_data(data[i:i + 1000])
+                await asyncio.sleep(0)
+            stream.feed_eof()
+
+        async def recv():
+            stream = asyncio.StreamReader()
+            feeder = asyncio.ensure_future(feed(stream))
+            reader = repceasync.FrameReader(stream)
+            res = [await reader.recv_frame() for _ in msgs]
+            await feeder
+            return res
+
+        self.assertEqual(asyncio.run(recv()), [(None, m) for m in msgs])
+
+
+def _entry(op, pgfid, name, gfid, **kw):
+    e = {"op": op, "skip_entry": False, "gfid": gfid,
+         "entry": ".gfid/%s/%s" % (pgfid, name)}
+    e.update(kw)
+    return e
+
+
+class RepceChannelsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backends = []
+        channels = []
+        for i in range(3):
+            r1, w1 = os.pipe()
+            r2, w2 = os.pipe()
+            backend = Backend()
+            backend.entry_ops = lambda entries, i=i: \
+                [(e, 0, i) for e in entries if e["op"] == "UNLINK"]
+            backend.keep_alive = lambda dct, b=backend: b.done.append(dct)
+            Thread(target=repce.RepceServer(backend, r1, w2, 2)
+                   .service_loop).start()
+            client = repce.RepceClient(r2, w1)
+            client.negotiate(client.__version__()["proto"])
+            self.backends.append(backend)
+            channels.append(client)
+        self.client = repce.RepceChannels(channels[0], channels[1:])
+
+    def test_shard_order(self):
+        entries = [_entry("MKDIR", "p1", "d", "d1"),
+                   _entry("CREATE", "d1", "f", "f1"),
+                   _entry("CREATE", "p4", "g", "f2"),
+                   _entry("RENAME", "d1", "f", "f1",
+                          entry1=".gfid/p4/f")]
+        waves = repce.shard_entries(entries, 2)
+        self.assertEqual(len(waves), 2)
+        self.assertEqual(waves[1], [entries[3:], []] if waves[1][0] else
+                         [[], entries[3:]])
+        # the directory and the file created in it are on one shard
+        shard = [s for s in waves[0] if entries[0] in s][0]
+        self.assertEqual(shard[:2], entries[:2])
+
+    def test_routing(self):
+        entries = [_entry("UNLINK", "p%d" % i, "f", "g%d" % i)
+                   for i in range(20)]
+        failures = self.client.entry_ops(entries)
+        self.assertEqual(sorted(f[0]["gfid"] for f in failures),
+                         sorted(e["gfid"] for e in entries))
+        # data calls went to the data channels only
+        self.assertNotIn(0, set(f[2] for f in failures))
+        self.client.keep_alive({"mark": 1})
+        self.assertEqual([b.done for b in self.backends],
+                         [[{"mark": 1}], [None], [None]])
+        self.assertEqual(self.client.echo(1), (1, ))
+
+    def test_failure_order(self):
+        entries = [_entry("UNLINK" if i % 3 else "CREATE", "p%d" % i, "f",
+                          "g%d" % i) for i in range(30)]
+        failures = self.client.entry_ops(entries)
+        # as reported by a single channel, whichever served them
+        self.assertEqual([f[0] for f in failures],
+                         [e for e in entries if e["op"] == "UNLINK"])
+        self.assertEqual(len(set(f[2] for f in failures)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
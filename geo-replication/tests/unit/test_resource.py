@@ -0,0 +1,308 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+from errno import EACCES, EINVAL, ENOENT
+from unittest import mock
+
+from syncdaemon import repce, resource
+from syncdaemon.syncdutils import Thread, gauxpfx
+
+OUTSIDE = b"outside of the tree"
+
+
+class Secondary(object):
+    """the data calls of the Server, on the files under secondary/"""
+
+    def data_sums(self, path, block_size):
+        return resource.Server.data_sums(os.path.join("secondary", path),
+                                         block_size)
+
+    def data_write(self, path, *args):
+        return resource.Server.data_write(os.path.join("secondary", path),
+                                          *args)
+
+
+class NativeSyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        os.mkdir("secondary")
+        self.outside = os.path.join(self.work_dir, "outside")
+        self.write(self.outside, OUTSIDE)
+        os.chmod(self.outside, 0o644)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def write(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def sync(self, files, delta_min=0):
+        r1, w1 = os.pipe()
+        r2, w2 = os.pipe()
+        server = repce.RepceServer(Secondary(), r1, w2, 2)
+        Thread(target=server.service_loop).start()
+        ssh = resource.SSH.__new__(resource.SSH)
+        ssh.server = repce.RepceClient(r2, w1)
+        ssh.server.negotiate(ssh.server.__version__()["proto"])
+        values = {"sync-native-block-size": 4096,
+                  "sync-native-delta-min": delta_min}
+        with mock.patch.object(resource.gconf, "get",
+                               lambda name, default=None:
+                               values.get(name, default)):
+            return ssh.native_sync(files)
+
+    def assertOutsideIntact(self):
+        self.assertEqual(self.read(self.outside), OUTSIDE)
+        st = os.stat(self.outside)
+        self.assertEqual(st.st_mode & 0o777, 0o644)
+        self.assertNotEqual(st.st_mtime, 0)
+
+    def test_regular(self):
+        data = os.urandom(10000)
+        self.write("g1", data)
+        self.write("secondary/g1", data[:5000] + b"x" * 8000)
+        os.utime("g1", (1000, 2000))
+        for delta_min in (0, 1 << 20):
+            res = self.sync(["g1"], delta_min)
+            self.assertEqual(res.returncode, 0)
+            self.assertEqual(self.read("secondary/g1"), data)
+            self.assertEqual(os.stat("secondary/g1").st_mtime, 2000)
+
+    def test_missing(self):
+        self.write("g1", b"data")
+        res = self.sync(["g1", "g2"])
+        self.assertEqual(res.returncode, 0)
+        self.assertFalse(os.path.exists("secondary/g1"))
+
+    def test_symlink_on_primary(self):
+        # not followed, the symlink itself is synced by entry ops
+        os.symlink(self.outside, "g1")
+        self.write("secondary/g1", b"data")
+        res = self.sync(["g1"])
+        self.assertEqual(res.returncode, 0)
+        self.assertEqual(self.read("secondary/g1"), b"data")
+
+    def test_symlink_on_secondary(self):
+        self.write("g1", b"data")
+        os.symlink(self.outside, "secondary/g1")
+        for delta_min in (0, 1 << 20):
+            res = self.sync(["g1"], delta_min)
+            self.assertEqual(res.returncode, 23)
+            self.assertEqual(res.failed_files, set(["g1"]))
+            self.assertOutsideIntact()
+
+    def test_data_write_refused(self):
+        os.symlink(self.outside, "secondary/g1")
+        adct = {"own": (os.getuid(), os.getgid()), "mode": 0o100600,
+                "times": (0, 0)}
+        with self.assertRaises(OSError) as cm:
+            resource.Server.data_write("secondary/g1", [(0, b"x")], 1, adct)
+        self.assertEqual(cm.exception.errno, EINVAL)
+        with self.assertRaises(OSError) as cm:
+            resource.Server.data_sums("secondary/g1", 4096)
+        self.assertEqual(cm.exception.errno, EINVAL)
+        self.assertOutsideIntact()
+        self.assertEqual(resource.Server.data_write("secondary/g2", []),
+                         ENOENT)
+
+
+class SyncErrorsTestCase(unittest.TestCase):
+    GFIDS = ["%08x-0000-0000-0000-000000000000" % i for i in range(2000)]
+
+    def setUp(self):
+        if not getattr(resource.Popen, "errhandler", None):
+            resource.Popen.init_errhandler()
+        self.work_dir = tempfile.mkdtemp()
+        # fails each of the files it's given, like rsync and tar do
+        self.engine = os.path.join(self.work_dir, "engine")
+        self.write_script(self.engine,
+                          "while read -r -d '' f; do\n"
+                          "  echo \"failed to open $f\" >&2\n"
+                          "done\n"
+                          "exit 23\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_script(self, path, body):
+        with open(path, "w") as f:
+            f.write("#!/bin/bash\n" + body)
+        os.chmod(path, stat.S_IRWXU)
+
+    def test_rsync(self):
+        values = {"rsync-command": self.engine, "ssh-command": "ssh",
+                  "ssh-options": "", "ssh-port": 22, "rsync-options": "",
+                  "rsync-ssh-options": ""}
+        ssh = resource.SSH.__new__(resource.SSH)
+        ssh.secondaryurl = "host:/secondary"
+        files = [os.path.join(gauxpfx(), g) for g in self.GFIDS]
+        with mock.patch.object(resource.gconf, "get",
+                               lambda name, default=None:
+                               values.get(name, default)), \
+                mock.patch.object(resource.gconf, "getr",
+                                  lambda name, default=None: default), \
+                mock.patch.object(resource.rconf, "ssh_ctl_args", []):
+            po = ssh.rsync(files)
+        self.assertEqual(po.returncode, 23)
+        # all of it was read, none left to the error handler thread
+        self.assertEqual(po.failed_files, set(files))
+        self.assertNotIn(po, resource.Popen.errstore)
+
+
+class MetaOpsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(20):
+            path = os.path.join(self.work_dir, "f%d" % i)
+            with open(path, "w"):
+                pass
+            os.chmod(path, 0o666)
+            self.paths.append(path)
+        self.utime = os.utime
+        self.chmod = os.chmod
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def meta_entry(self, path, mode, mtime):
+        return {"go": path,
+                "stat": {"mode": stat.S_IFREG | mode, "uid": os.getuid(),
+                         "gid": os.getgid(), "atime": mtime,
+                         "mtime": mtime}}
+
+    def failing_utime(self, path, times):
+        # utime fails on every third file
+        if self.paths.index(path) % 3 == 0:
+            raise OSError(EACCES, os.strerror(EACCES))
+        self.utime(path, times)
+
+    def slow_chmod(self, path, mode):
+        # holds up the first entries of the files, for later ones
+        # to overtake them if applied concurrently
+        if stat.S_IMODE(mode) == 0o600:
+            time.sleep(0.01)
+        self.chmod(path, mode)
+
+    def meta_ops(self, meta_entries, nthreads):
+        values = {"secondary-meta-ops-threads": nthreads}
+        with mock.patch.object(resource.gconf, "get",
+                               lambda name, default=None:
+                               values.get(name, default)), \
+                mock.patch.object(resource.os, "utime",
+                                  self.failing_utime), \
+                mock.patch.object(resource.os, "chmod", self.slow_chmod):
+            return resource.Server.meta_ops(meta_entries)
+
+    def test_concurrent(self):
+        for nthreads in (1, 4):
+            # the later entries of a file win
+            meta_entries = [self.meta_entry(path, 0o600, 1000)
+                            for path in self.paths]
+            meta_entries += [self.meta_entry(path, 0o640 + nthreads, 2000)
+                             for path in self.paths[::2]]
+            meta_entries.append(self.meta_entry(
+                os.path.join(self.work_dir, "missing"), 0o600, 1000))
+            failures = self.meta_ops(meta_entries, nthreads)
+            for i, path in enumerate(self.paths):
+                st = os.stat(path)
+                mode = 0o640 + nthreads if i % 2 == 0 else 0o600
+                self.assertEqual(stat.S_IMODE(st.st_mode), mode)
+                if i % 3:
+                    self.assertEqual(st.st_mtime, 2000 if i % 2 == 0
+                                     else 1000)
+            # in the order of the entries, as applied one by one
+            self.assertEqual(failures,
+                             [(e, EACCES, "utime") for e in meta_entries
+                              if e["go"] in self.paths and
+                              self.paths.index(e["go"]) % 3 == 0])
+
+
+class EntryOpsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.work_dir, "f")
+        with open(self.file, "w"):
+            pass
+        # the entry paths looked up, in order
+        self.lookups = []
+        self.slow = None
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def lstat(self, path):
+        if path == self.slow:
+            time.sleep(0.05)
+        if path.count("/") == 2:
+            self.lookups.append(path)
+        return os.lstat(self.file)
+
+    def entry_ops(self, entries, nthreads):
+        values = {"secondary-entry-ops-threads": nthreads}
+        del self.lookups[:]
+        with mock.patch.object(resource.gconf, "get",
+                               lambda name, default=None:
+                               values.get(name, default)), \
+                mock.patch.object(resource.rconf, "args",
+                                  mock.Mock(primary_dist_count=1)), \
+                mock.patch.object(resource, "lstat", self.lstat), \
+                mock.patch.object(resource.GfidMemo, "get",
+                                  lambda memo, path: "another-gfid"):
+            # none of the entries match their file, which is kept
+            return resource.Server.entry_ops(entries)
+
+    def test_waves(self):
+        pgfids = ["p%d" % i for i in range(10)]
+        pa = pgfids[0]
+        pb = [p for p in pgfids if repce.shard_of(p, 4) !=
+              repce.shard_of(pa, 4)][0]
+        entries = [{"op": "UNLINK", "skip_entry": False, "gfid": gfid,
+                    "entry": ".gfid/%s/%s" % (pgfid, name)}
+                   for pgfid, name, gfid in ((pa, "a", "g1"),
+                                             (pb, "b", "g2"),
+                                             (pa, "c", "g3"),
+                                             # links g1 to the other shard
+                                             (pb, "d", "g1"),
+                                             (pgfids[-1], "e", "g4"))]
+        waves = repce.shard_entries(entries, 4)
+        self.assertEqual(len(waves), 2)
+        self.slow = entries[0]["entry"]
+        failures = self.entry_ops(entries, 1)
+        order = list(self.lookups)
+        self.assertEqual([f[0] for f in failures], entries)
+        self.assertEqual(failures, self.entry_ops(entries, 4))
+        first = dict((path, self.lookups.index(path))
+                     for path in set(self.lookups))
+        # the first wave is done before the second one starts
+        self.assertLess(max(first[e["entry"]] for e in entries[:3]),
+                        min(first[e["entry"]] for e in entries[3:]))
+        # and the entries of a shard are applied in order
+        self.assertLess(first[entries[0]["entry"]],
+                        first[entries[2]["entry"]])
+        self.assertNotEqual(self.lookups, order)
+
+
+if __name__ == "__main__":
+    unittest.main()
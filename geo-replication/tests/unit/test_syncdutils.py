@@ -9,6 +9,7 @@
 #
 
 import unittest
+from unittest import mock
 
 from syncdaemon import syncdutils
 
@@ -27,3 +28,40 @@ class SyncdutilsTestCase(unittest.TestCase):
     def test_unescape(self):
         self.assertEqual(syncdutils.unescape("http%3A%2F%2Fgluster.org"),
                          "http://gluster.org")
+
+    def test_failed_gfid_paths(self):
+        gfid = "9f3c9a02-5c83-4dc6-8e0c-1ab1b1d4f1a7"
+        errors = ('rsync: [sender] read errors mapping ".gfid/%s": '
+                  'Input/output error (5)\n'
+                  'rsync error: some files/attrs were not transferred '
+                  '(see previous errors) (code 23) at main.c(1330)\n'
+                  % gfid)
+        self.assertEqual(syncdutils.failed_gfid_paths(errors),
+                         set([".gfid/" + gfid]))
+        self.assertEqual(syncdutils.failed_gfid_paths(""), set())
+
+    def test_failed_gfid_paths_unattributed(self):
+        gfid = "9f3c9a02-5c83-4dc6-8e0c-1ab1b1d4f1a7"
+        errors = ('rsync: [sender] read errors mapping ".gfid/%s": '
+                  'Input/output error (5)\n'
+                  'rsync: connection unexpectedly closed (0 bytes received '
+                  'so far) [sender]\n' % gfid)
+        self.assertIsNone(syncdutils.failed_gfid_paths(errors))
+
+    def test_gfid_memo(self):
+        disk = {".gfid/p/a": "ga", ".gfid/p/b": "gb"}
+        memo = syncdutils.GfidMemo()
+        with mock.patch.object(syncdutils, "get_gfid_from_mnt",
+                               side_effect=lambda path: disk.get(path, 2)):
+            self.assertTrue(memo.matching("ga", ".gfid/p/a"))
+            self.assertFalse(memo.matching("gb", ".gfid/p/a"))
+            # not found on the mount (ENOENT)
+            self.assertFalse(memo.matching("gc", ".gfid/p/c"))
+            self.assertEqual((memo.lookups, memo.saved), (2, 1))
+
+            # renamed, the path is looked up again once forgotten
+            disk[".gfid/p/a"] = "gb"
+            self.assertTrue(memo.matching("ga", ".gfid/p/a"))
+            memo.forget(".gfid/p/a")
+            self.assertTrue(memo.matching("gb", ".gfid/p/a"))
+            self.assertEqual((memo.lookups, memo.saved), (3, 2))